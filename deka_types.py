@@ -7,3 +7,20 @@ Circle = namedtuple('Circle', ['lat', 'lng', 'radius'])
 # a single result from a query to the Google Places Search API
 # it's just a type alias for annotations, with no run-time meaning
 Place = Dict
+
+# the types of venues we are interested in. https://developers.google.com/places/web-service/supported_types
+# used both when querying the API and when indexing the places in the datastore
+PLACES_TYPES = [
+    "bakery",
+    "bar",
+    "cafe",
+    "casino",
+    "department_store",
+    "meal_takeaway",
+    "movie_theater",
+    "museum",
+    "night_club",
+    "park",
+    "restaurant",
+    "shopping_mall",
+]
@@ -0,0 +1,177 @@
+"""
+Compares two sets of places (see sources.py) - e.g. two crawls of an area, or a crawl and what is loaded in Redis.
+
+Places are matched by place_id and compared by the hashes of their json. Only places whose hashes differ are decoded
+and compared as objects (different json libraries might encode the same place differently).
+* both sources sorted by place_id - a single merge pass, in constant memory
+* otherwise - the place_ids and hashes of the old source are kept in a dict, then the new source is streamed. memory is
+proportional to the number of places, not to their size - except for the sources which hold their places in memory
+(DictSource, e.g. a json output file).
+
+The changes are grouped by the geohash cell of the places, to tell which cells change often (churn) and which are
+stable.
+"""
+from collections import namedtuple
+from typing import Dict, Iterator
+
+from shared_utils import codec, geohash
+
+DEFAULT_CELL_PRECISION = 6
+
+
+class ChangeKind:
+    added = "added"
+    removed = "removed"
+    changed = "changed"
+
+
+# old/new are the places (decoded). None if the place is missing on that side
+PlaceChange = namedtuple("PlaceChange", ['kind', 'place_id', 'old', 'new'])
+
+
+class CellChurn:
+    __slots__ = ('unchanged', 'added', 'removed', 'changed')
+
+    def __init__(self):
+        self.unchanged = 0
+        self.added = 0
+        self.removed = 0
+        self.changed = 0
+
+    @property
+    def old_count(self):
+        return self.unchanged + self.changed + self.removed
+
+    @property
+    def new_count(self):
+        return self.unchanged + self.changed + self.added
+
+    @property
+    def churn(self) -> float:
+        """
+        :return: the share of the places of the cell which were added, removed or changed. 0..1
+        """
+        total = self.unchanged + self.changed + self.added + self.removed
+        return (self.added + self.removed + self.changed) / total if total else 0.0
+
+    def to_dict(self):
+        return {'old': self.old_count, 'new': self.new_count, 'added': self.added, 'removed': self.removed,
+                'changed': self.changed, 'churn': round(self.churn, 4)}
+
+
+def cell_of_place(place, precision) -> str:
+    """
+    :return: the geohash cell of the place. "" if the place has no location
+    """
+    location = place.get('geometry', {}).get('location') if place else None
+    if not location:
+        return ""
+    return geohash.encode(location['lat'], location['lng'], precision)
+
+
+class PlacesDiff:
+    """
+    Iterate over it to get the changes (PlaceChange). The churn of the cells (self.cells) is complete once the
+    iteration is over. Can be iterated once.
+    """
+
+    def __init__(self, old, new, cell_precision=DEFAULT_CELL_PRECISION):
+        """
+        :param old: a source (see sources.py)
+        :param new: a source
+        :param cell_precision: length of the geohash of a cell
+        """
+        self.old = old
+        self.new = new
+        self.cell_precision = cell_precision
+        # geohash -> CellChurn
+        self.cells: Dict[str, CellChurn] = {}
+        self.counts = {ChangeKind.added: 0, ChangeKind.removed: 0, ChangeKind.changed: 0, 'unchanged': 0}
+
+    def __iter__(self) -> Iterator[PlaceChange]:
+        if self.old.sorted_by_id and self.new.sorted_by_id:
+            return self._merge()
+        return self._hash_join()
+
+    def run(self):
+        """
+        Consumes the changes, only to compute the stats.
+        """
+        for _ in self:
+            pass
+        return self
+
+    def _merge(self):
+        old_entries, new_entries = self.old.entries(), self.new.entries()
+        old_entry, new_entry = next(old_entries, None), next(new_entries, None)
+        while old_entry is not None or new_entry is not None:
+            if new_entry is None or (old_entry is not None and old_entry[0] < new_entry[0]):
+                yield self._removed(old_entry[0], codec.loads(old_entry[2]))
+                old_entry = next(old_entries, None)
+            elif old_entry is None or new_entry[0] < old_entry[0]:
+                yield self._added(new_entry[0], codec.loads(new_entry[2]))
+                new_entry = next(new_entries, None)
+            else:
+                change = self._compare(new_entry[0], old_entry[1], new_entry[1],
+                                       lambda payload=old_entry[2]: codec.loads(payload), new_entry[2])
+                if change:
+                    yield change
+                old_entry, new_entry = next(old_entries, None), next(new_entries, None)
+
+    def _hash_join(self):
+        old_hashes = {place_id: payload_hash for place_id, payload_hash, _ in self.old.entries()}
+        for place_id, new_hash, new_payload in self.new.entries():
+            old_hash = old_hashes.pop(place_id, None)
+            if old_hash is None:
+                yield self._added(place_id, codec.loads(new_payload))
+                continue
+            change = self._compare(place_id, old_hash, new_hash, lambda place_id=place_id: self.old.get(place_id),
+                                   new_payload)
+            if change:
+                yield change
+        for place_id in old_hashes:
+            yield self._removed(place_id, self.old.get(place_id))
+
+    def _compare(self, place_id, old_hash, new_hash, get_old, new_payload):
+        new_place = codec.loads(new_payload)
+        cell = self._cell(new_place)
+        if old_hash != new_hash:
+            old_place = get_old()
+            if old_place != new_place:
+                cell.changed += 1
+                self.counts[ChangeKind.changed] += 1
+                return PlaceChange(ChangeKind.changed, place_id, old_place, new_place)
+        cell.unchanged += 1
+        self.counts['unchanged'] += 1
+        return None
+
+    def _added(self, place_id, place):
+        self._cell(place).added += 1
+        self.counts[ChangeKind.added] += 1
+        return PlaceChange(ChangeKind.added, place_id, None, place)
+
+    def _removed(self, place_id, place):
+        self._cell(place).removed += 1
+        self.counts[ChangeKind.removed] += 1
+        return PlaceChange(ChangeKind.removed, place_id, place, None)
+
+    def _cell(self, place) -> CellChurn:
+        cell = cell_of_place(place, self.cell_precision)
+        churn = self.cells.get(cell)
+        if churn is None:
+            churn = self.cells[cell] = CellChurn()
+        return churn
+
+    def cells_to_dict(self):
+        """
+        :return: geohash -> stats of the cell, as a dict
+        """
+        return {cell: churn.to_dict() for cell, churn in sorted(self.cells.items())}
+
+
+def diff_places(old, new, cell_precision=DEFAULT_CELL_PRECISION) -> PlacesDiff:
+    """
+    :param old: a source (see sources.py)
+    :param new: a source
+    """
+    return PlacesDiff(old, new, cell_precision=cell_precision)
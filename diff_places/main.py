@@ -0,0 +1,47 @@
+import argparse
+import logging as log
+
+from diff_places.diff import diff_places, DEFAULT_CELL_PRECISION
+from diff_places.sources import open_source
+from shared_utils import codec
+from shared_utils.file_utils import save_dict_to_file, get_directory_of_file
+from shared_utils.log import init_logger
+
+
+def main():
+    args = parse_args()
+    old, new = open_source(args.old), open_source(args.new)
+    log.info("Comparing %s to %s" % (old.name, new.name))
+
+    diff = diff_places(old, new, cell_precision=args.precision)
+    if args.changes:
+        with open(args.changes, 'wb') as changes_file:
+            for change in diff:
+                changes_file.write(codec.dumps(change._asdict()))
+                changes_file.write(b"\n")
+    else:
+        diff.run()
+    old.close()
+    new.close()
+
+    log.info("Changes: %s" % diff.counts)
+    if args.churn:
+        save_dict_to_file(diff.cells_to_dict(), args.churn)
+    print(codec.dumps(diff.counts).decode('utf-8'))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare two sets of places - outputs of get_places (json or indexed),"
+                                                 " or an output and an area loaded in Redis (redis:<area name>)")
+    parser.add_argument('--old', required=True, help="path to a file, or redis:<area name>")
+    parser.add_argument('--new', required=True, help="path to a file, or redis:<area name>")
+    parser.add_argument('--precision', type=int, default=DEFAULT_CELL_PRECISION,
+                        help="length of the geohash of the cells for which churn is computed")
+    parser.add_argument('--changes', help="write the added/removed/changed places to this file, one json per line")
+    parser.add_argument('--churn', help="write the churn of each cell to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    init_logger(get_directory_of_file(__file__))
+    main()
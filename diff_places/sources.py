@@ -0,0 +1,105 @@
+"""
+The sides of a diff. A source yields (place_id, hash, payload) for each of its places, where the payload is the json of
+the place and the hash is places_index.content_hash of it.
+Sources which yield their places sorted by place_id (sorted_by_id) are diffed with a merge, in constant memory.
+"""
+from shared_utils import codec
+from shared_utils.file_utils import readJSONFileAndConvertToDict
+from shared_utils.places_index import PlacesIndex, is_places_index, content_hash
+
+# e.g. "redis:london" - the places of london, as currently loaded in Redis
+REDIS_PREFIX = "redis:"
+
+
+class IndexedFileSource:
+    """
+    An output of get_places in the indexed format. The hashes are read from the file - no place is decoded.
+    """
+    sorted_by_id = True
+
+    def __init__(self, file_path):
+        self.name = file_path
+        self._index = PlacesIndex(file_path)
+
+    def entries(self):
+        return self._index.iter_entries()
+
+    def get(self, place_id):
+        return self._index.get(place_id)
+
+    def close(self):
+        self._index.close()
+
+
+class DictSource:
+    """
+    Places in memory, e.g. an output of get_places in the json format. Note that a json file is loaded whole - the json
+    libraries we use (see codec.py) don't parse incrementally. Use the indexed format for big areas.
+    """
+    sorted_by_id = False
+
+    def __init__(self, places, name="places", default=None):
+        """
+        :param places: place_id -> place
+        :param default: same as in codec.dumps
+        """
+        self.name = name
+        self._places = places
+        self._default = default
+
+    @classmethod
+    def from_file(cls, file_path):
+        return cls(readJSONFileAndConvertToDict(file_path)['places'], name=file_path)
+
+    def entries(self):
+        for place_id, place in self._places.items():
+            payload = codec.dumps(place, default=self._default)
+            yield place_id, content_hash(payload), payload
+
+    def get(self, place_id):
+        return self._places.get(place_id)
+
+    def close(self):
+        pass
+
+
+class RedisAreaSource:
+    """
+    The places of an area, as currently loaded in Redis. They are scanned, not fetched at once.
+    """
+    sorted_by_id = False
+
+    def __init__(self, area_name):
+        self.name = REDIS_PREFIX + area_name
+        self.area_name = area_name
+
+    def entries(self):
+        from load_data.datastore_adapter import RedisFacade
+
+        # HSCAN might return a place more than once
+        seen = set()
+        for place_id, serialized in RedisFacade.iter_places(self.area_name):
+            if place_id in seen:
+                continue
+            seen.add(place_id)
+            payload = serialized.encode('utf-8')
+            yield place_id, content_hash(payload), payload
+
+    def get(self, place_id):
+        from load_data.datastore_adapter import RedisFacade
+
+        return RedisFacade.get_place_data(self.area_name, place_id)
+
+    def close(self):
+        pass
+
+
+def open_source(spec):
+    """
+    :param spec: path to an output of get_places (json or indexed), or "redis:<area name>"
+    """
+    if spec.startswith(REDIS_PREFIX):
+        return RedisAreaSource(spec[len(REDIS_PREFIX):])
+    if is_places_index(spec):
+        return IndexedFileSource(spec)
+    return DictSource.from_file(spec)
@@ -1,27 +1,60 @@
 import os
 
+from dotenv import load_dotenv
+
+from deka_types import PLACES_TYPES
+
+load_dotenv()
+
+
+class _EnvironmentVariable:
+    """
+    A Config attribute which is read from the environment on access, not on import - e.g. a secret which is needed only
+    by some of the code paths.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return os.environ[self.name]
+
 
 class Config:
-    google_access_key = os.environ['DEKA_GOOGLE_ACCESS_KEY']
+    google_access_key = _EnvironmentVariable('DEKA_GOOGLE_ACCESS_KEY')
     google_places_api_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
     output_folder = "output"
 
+    """
+    Used to size the index of seen places, shared by the worker processes: <number of circles> * <this>.
+    A query returns at most 60 places, but circles overlap so the number of distinct places is lower.
+    """
+    dedup_places_per_circle = 60
+
+    """
+    Only a few fields of each place are kept in memory (see google_places_wrapper/place.py).
+    If set, the raw places, as returned by the API, are appended to files in this folder.
+    """
+    raw_places_folder = os.environ.get('DEKA_RAW_PLACES_FOLDER')
+
+    """
+    Incremental re-crawling (see recrawl.py). A circle is refreshed after recrawl_max_age_days if its result never
+    changes, and after recrawl_min_age_days if it changes on every crawl.
+    recrawl_churn_smoothing is the weight of the latest crawl in the churn of a circle.
+    """
+    recrawl_min_age_days = float(os.environ.get('DEKA_RECRAWL_MIN_AGE_DAYS', 7))
+    recrawl_max_age_days = float(os.environ.get('DEKA_RECRAWL_MAX_AGE_DAYS', 56))
+    recrawl_churn_smoothing = 0.3
+
+    """
+    The location of a request is rounded to this many decimal places (6 - ~0.1m). Identical requests (rounded location,
+    radius, type and page token) made at the same time by the threads of a worker are sent once (see single_flight.py).
+    """
+    request_location_precision = int(os.environ.get('DEKA_REQUEST_LOCATION_PRECISION', 6))
+
     """
     The type of venues that we're interested in. 
     Google allows us to query with only one type of places.
     Thus, we query for all types, and then filter.  
     """
-    places_types = [
-        "bakery",
-        "bar",
-        "cafe",
-        "casino",
-        "department_store",
-        "meal_takeaway",
-        "movie_theater",
-        "museum",
-        "night_club",
-        "park",
-        "restaurant",
-        "shopping_mall",
-    ]
+    places_types = PLACES_TYPES
@@ -1,51 +1,159 @@
 
 import argparse
-import json
 import logging as log
+import os
+from contextlib import closing
 from datetime import datetime as dt
 
-from boto3 import session
-
 from deka_types import Circle
 from get_places.config import Config
-from get_places.google_places_wrapper.wrapper import query_google_places
-from shared_utils.file_utils import readJSONFileAndConvertToDict, save_dict_to_file
+from get_places.google_places_wrapper.dedup import SeenPlacesIndex, overlap_stats_to_dict
+from get_places.google_places_wrapper.place import encode_place
+from get_places.google_places_wrapper.wrapper import query_google_places, iter_google_places
+from get_places.recrawl import CrawlHistory, merge_with_previous, succeeded_circles
+from get_places.sharding import parse_shard, shard_circles, shard_to_str
+from shared_utils import codec, profiling
+from shared_utils.file_utils import readJSONFileAndConvertToDict, save_dict_to_file, read_places_file, \
+    get_directory_of_file, PlacesFileWriter
+from shared_utils.log import init_logger
+from shared_utils.places_index import write_places_index, PlacesIndexWriter, FILE_EXTENSION as INDEXED_FILE_EXTENSION
 
 class InputFileType:
     local_file = "file"
     remote_s3 = "s3"
 
 
+class OutputFormat:
+    # a single json file. see README.md
+    json = "json"
+    # see shared_utils/places_index.py
+    indexed = "indexed"
+
+
 def main():
+    args = parse_args()
+    if args.profile:
+        profiling.enable(args.profile)
+    with profiling.process_profile("get_places"):
+        crawl(args)
+    if args.profile:
+        profiling.merge_profiles()
+
+
+def crawl(args):
     log.info("Starting at %s" % dt.now().isoformat())
 
-    input_circles_coords, metadata = read_input()
+    with profiling.span("read_input"):
+        input_circles_coords, metadata = read_input(args)
+    if args.shard:
+        # only the circles of this shard. see sharding.py
+        input_circles_coords = shard_circles(input_circles_coords, args.shard)
+        metadata['shard'] = shard_to_str(args.shard)
+
+    now = dt.now()
+    history = CrawlHistory.load(args.history) if args.history else None
+    circles_to_query = input_circles_coords
+    if history is not None:
+        circles_to_query = history.due_circles(input_circles_coords, now=now, max_circles=args.max_circles)
+        if len(circles_to_query) < len(input_circles_coords) and not args.previous:
+            raise Exception("Only some circles are due for a refresh - pass the previous output with --previous")
+
+    # shared by the worker processes to drop places which were already fetched for an overlapping circle
+    seen_index = SeenPlacesIndex(capacity=len(circles_to_query) * Config.dedup_places_per_circle)
 
     # query the Google Places API to get all places within the input geographical circles
-    all_places = query_google_places(circles_coords=input_circles_coords)
+    if args.previous:
+        # the fresh places are merged with the previous ones, so they are all collected first
+        with profiling.span("query"):
+            all_places = query_google_places(circles_coords=circles_to_query,
+                                             seen_index=seen_index) if circles_to_query else {}
+
+        log.info("All batches are processed. %i places obtained" % len(all_places))
+        # the previous places of the circles whose query failed are kept, and the circles stay due
+        crawled = succeeded_circles(circles_to_query, seen_index.overlap)
+
+        with profiling.span("merge_with_previous"):
+            all_places = merge_with_previous(previous=read_places_file(args.previous)['places'], fresh=all_places,
+                                             crawled=crawled)
+        with profiling.span("save"):
+            file_path = save_output(all_places, metadata, output_format=args.format)
+    else:
+        # the places are saved as the workers send them, so they are never all in memory
+        with profiling.span("query_and_save"):
+            # closed even if saving fails, so that the workers are stopped
+            with closing(iter_google_places(circles_coords=circles_to_query, seen_index=seen_index)) as chunks:
+                file_path = stream_output(chunks, metadata, output_format=args.format)
+        seen_index.log_summary()
+
+    if history is not None:
+        history.update(circles_to_query, seen_index.overlap, now=now)
+        history.save(args.history)
+
+    # how much each circle overlaps with the rest. useful when planning the grid for future crawls
+    overlap_file_path = os.path.splitext(file_path)[0] + "_overlap.json"
+    log.info("Saving the overlap statistics of the circles to %s" % overlap_file_path)
+    save_dict_to_file(data=overlap_stats_to_dict(seen_index.overlap), file_path=overlap_file_path)
+
+    # important that the last line of the stdout contains the path to the output file
+    print(file_path)
+
 
-    log.info("All batches are processed. %i places obtained" % len(all_places))
+def save_output(places, metadata, output_format=OutputFormat.json):
+    """
+    Save the places of the area to a new file in Config.output_folder
+    :return: the path of the file
+    """
+    file_path = output_file_path(metadata, num_places=len(places), output_format=output_format)
+    log.info("Saving %i places to %s" % (len(places), file_path))
+    if output_format == OutputFormat.indexed:
+        os.makedirs(Config.output_folder, exist_ok=True)
+        write_places_index(file_path, places=places, metadata=metadata, default=encode_place)
+    else:
+        to_save = {
+            'metadata': metadata,
+            'places': places,
+        }
+        save_dict_to_file(data=to_save, file_path=file_path, default=encode_place)
+    return file_path
 
-    file_path = "{folder}/{area}_count{num_places}_r{radius}_{date}.json".format(
+
+def stream_output(chunks, metadata, output_format=OutputFormat.json):
+    """
+    Same as save_output, but the places are written as they arrive, so they don't have to be all in memory.
+    The file is written under a temporary name, and renamed once the number of places is known.
+    :param chunks: an iterable of dicts of places. a place in more than one chunk is saved once
+    :return: the path of the file
+    """
+    os.makedirs(Config.output_folder, exist_ok=True)
+    partial_path = os.path.join(Config.output_folder, ".%s_%i.partial" % (metadata['area_name'], os.getpid()))
+    writer_class = PlacesIndexWriter if output_format == OutputFormat.indexed else PlacesFileWriter
+    try:
+        with writer_class(partial_path, metadata=metadata, default=encode_place) as writer:
+            for chunk in chunks:
+                writer.add(chunk)
+        file_path = output_file_path(metadata, num_places=len(writer), output_format=output_format)
+        log.info("Saved %i places to %s" % (len(writer), file_path))
+        os.replace(partial_path, file_path)
+    except BaseException:
+        os.remove(partial_path)
+        raise
+    return file_path
+
+
+def output_file_path(metadata, num_places, output_format=OutputFormat.json):
+    return "{folder}/{area}_count{num_places}_r{radius}_{date}{shard}{extension}".format(
         folder=Config.output_folder,
         area=metadata['area_name'],
-        num_places=len(all_places),
+        num_places=num_places,
         radius=metadata['circle_radius'],
-        date=dt.now().replace(microsecond=0).isoformat().replace(":", "_").replace("-", "_")
+        date=dt.now().replace(microsecond=0).isoformat().replace(":", "_").replace("-", "_"),
+        shard="_shard%s" % metadata['shard'].replace("/", "of") if 'shard' in metadata else "",
+        extension=INDEXED_FILE_EXTENSION if output_format == OutputFormat.indexed else ".json"
     )
-    log.info("Saving %i places to %s" % (len(all_places), file_path))
-    to_save = {
-        'metadata': metadata,
-        'places': all_places,
-    }
-    save_dict_to_file(data=to_save, file_path=file_path)
-
-    # important that the last line of the stdout contains the path to the output file
-    print(file_path)
 
 
-def read_input():
-    input_type, input_path = parse_args()
+def read_input(args):
+    input_type, input_path = (InputFileType.remote_s3, args.s3) if args.s3 else (InputFileType.local_file, args.file)
 
     if input_type == InputFileType.local_file:
         raw_input = readJSONFileAndConvertToDict(input_path)
@@ -61,16 +169,30 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--file', help="specify path to a local file")
     parser.add_argument('--s3', help="specify path to a file on S3 <bucket>/<file>")
-
-    args = parser.parse_args()
-    return ("s3", args.s3) if args.s3 else ("file", args.file)
+    parser.add_argument('--format', choices=[OutputFormat.json, OutputFormat.indexed], default=OutputFormat.json,
+                        help="format of the output file")
+    parser.add_argument('--history', help="path to the crawl history of the area (see recrawl.py). if given, only the "
+                                          "circles due for a refresh are queried, and the history is updated")
+    parser.add_argument('--previous', help="path to the previous output for the area. the places of the circles "
+                                           "which are not queried are taken from it")
+    parser.add_argument('--max-circles', type=int, help="with --history, query at most this many circles")
+    parser.add_argument('--shard', type=parse_shard,
+                        help="<index>/<count> - crawl only one of <count> parts of the area, e.g. 0/4. "
+                             "see sharding.py and merge_shards.py")
+    parser.add_argument('--profile', help="profile the run (all processes) and save the profiles to this directory. "
+                                          "see shared_utils/profiling.py")
+
+    return parser.parse_args()
 
 
 def read_from_s3(s3_url):
+    # imported here - boto3 is slow to import and is needed only for input from S3
+    from boto3 import session
+
     bucket, file = s3_url.split("/")
     s3 = session.Session().client('s3')
     obj = s3.get_object(Bucket=bucket, Key=file, ResponseContentType='application/json')
-    return json.loads(obj['Body'].read().decode('utf-8'))
+    return codec.loads(obj['Body'].read())
 
 
 def prepare_raw_input(raw_input):
@@ -95,4 +217,5 @@ def prepare_raw_input(raw_input):
 
 
 if __name__ == "__main__":
+    init_logger(get_directory_of_file(__file__))
     main()
@@ -0,0 +1,160 @@
+"""
+Adjacent circles of the input grid overlap, so the same place is returned by the API for several circles.
+Without deduplication, each copy is filtered, pickled and sent to the main process, only to be collapsed by key
+when merged into the final dict.
+
+The SeenPlacesIndex is a hash set of place ids which lives in shared memory, so that all worker processes (and their
+threads) can check whether a place has already been fetched by another circle and drop it early.
+We don't store the place ids themselves, only a 64-bit hash of them - collisions are negligible for our volumes
+(millions of places at most). The set is an open-addressing table with linear probing, backed by a RawArray.
+
+The index also keeps overlap statistics for each circle (how many places were fetched and how many of them were
+already seen). They are useful when planning the grid of future crawls - a circle whose places are almost all
+duplicates is likely redundant. The stats include a hash of the ids of the places of the circle and whether the circle
+was saturated, which tell whether the circle changed since the previous crawl (see get_places/recrawl.py).
+"""
+import logging as log
+from collections import namedtuple
+from ctypes import c_uint64
+from hashlib import blake2b
+from multiprocessing import Lock, RawArray, RawValue
+from threading import Lock as ThreadLock
+from typing import Dict
+
+from deka_types import Circle, Place
+
+# fetched - number of places the API returned for the circle. duplicates - how many of them were already seen.
+# result_hash - a hash of the ids of all places returned for the circle, independent of their order.
+# saturated - the API returned the max number of places for the circle, so it was queried per type.
+# failed - a request for the circle failed, so its places might be incomplete.
+OverlapStats = namedtuple('OverlapStats', ['fetched', 'duplicates', 'result_hash', 'saturated', 'failed'],
+                          defaults=(0, False, False))
+
+_HASH_MASK = (1 << 64) - 1
+
+# a slot with this value is empty
+_EMPTY = 0
+
+# stop inserting when the table is this full - linear probing degrades quickly after that
+_MAX_LOAD_FACTOR = 0.75
+
+
+def hash_place_id(place_id: str) -> int:
+    h = int.from_bytes(blake2b(place_id.encode('utf-8'), digest_size=8).digest(), 'little')
+    # 0 marks an empty slot
+    return h or 1
+
+
+class SeenPlacesIndex:
+    def __init__(self, capacity: int):
+        """
+        :param capacity: the expected number of distinct places. The table is sized so that it's at most half full
+        when that many places are added.
+        """
+        size = 1
+        while size < capacity * 2:
+            size <<= 1
+        self._mask = size - 1
+        self._max_items = int(size * _MAX_LOAD_FACTOR)
+        self._slots = RawArray(c_uint64, size)
+        self._items = RawValue(c_uint64, 0)
+        # guards the table. it's held for a whole result set of a query, so contention is low
+        self._lock = Lock()
+        # circle -> OverlapStats. it's local to the process, the parent collects the stats of all workers
+        self.overlap = {}
+        self._overlap_lock = ThreadLock()
+
+    def __len__(self):
+        return self._items.value
+
+    def __getstate__(self):
+        # the thread lock can't be pickled (when the index is passed to a spawned process)
+        state = self.__dict__.copy()
+        del state['_overlap_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._overlap_lock = ThreadLock()
+
+    def _add(self, h: int) -> bool:
+        """
+        Must be called with the lock acquired.
+        :return: True if the hash was not in the set
+        """
+        slots = self._slots
+        i = h & self._mask
+        while True:
+            current = slots[i]
+            if current == h:
+                return False
+            if current == _EMPTY:
+                break
+            i = (i + 1) & self._mask
+
+        if self._items.value >= self._max_items:
+            # full. treat the place as unseen - we'd rather have a duplicate than lose a place.
+            return True
+        slots[i] = h
+        self._items.value += 1
+        return True
+
+    def drop_seen(self, places: Dict[str, Place], circle: Circle = None) -> Dict[str, Place]:
+        """
+        Mark all places as seen and return only the ones which haven't been seen before.
+
+        :param places: place_id -> place dict, as returned by a query for a circle
+        :param circle: the queried circle. if given, overlap statistics are recorded for it.
+        :return: the subset of @places which were not seen before
+        """
+        hashes = [(place_id, hash_place_id(place_id)) for place_id in places]
+        with self._lock:
+            new_ids = [place_id for place_id, h in hashes if self._add(h)]
+
+        if len(new_ids) == len(places):
+            unseen = places
+        else:
+            unseen = {place_id: places[place_id] for place_id in new_ids}
+
+        if circle is not None:
+            self.record_overlap(circle, fetched=len(places), duplicates=len(places) - len(new_ids),
+                                result_hash=sum(h for _, h in hashes))
+        return unseen
+
+    def record_overlap(self, circle: Circle, fetched: int, duplicates: int, result_hash=0, saturated=False,
+                       failed=False):
+        """
+        Adds to the stats of @circle - a circle might be queried more than once (e.g. per type, when saturated).
+        """
+        with self._overlap_lock:
+            previous = self.overlap.get(circle, OverlapStats(fetched=0, duplicates=0))
+            self.overlap[circle] = OverlapStats(fetched=previous.fetched + fetched,
+                                                duplicates=previous.duplicates + duplicates,
+                                                result_hash=(previous.result_hash + result_hash) & _HASH_MASK,
+                                                saturated=previous.saturated or saturated,
+                                                failed=previous.failed or failed)
+
+    def log_summary(self):
+        fetched = sum(stats.fetched for stats in self.overlap.values())
+        duplicates = sum(stats.duplicates for stats in self.overlap.values())
+        log.info("%i places fetched, %i of them were duplicates from overlapping circles. %i distinct places seen"
+                 % (fetched, duplicates, len(self)))
+        if len(self) >= self._max_items:
+            log.warning("The index of seen places got full. Consider increasing Config.dedup_places_per_circle")
+
+
+def overlap_stats_to_dict(overlap: Dict[Circle, OverlapStats]) -> Dict:
+    """
+    :return: a json-serializable dict with
+    "<lat>,<lng>" -> {"radius":.., "fetched":.., "duplicates":.., "result_hash":.., "saturated":.., "failed":..}
+    """
+    return {
+        "%s,%s" % (circle.lat, circle.lng): {
+            "radius": circle.radius,
+            "fetched": stats.fetched,
+            "duplicates": stats.duplicates,
+            "result_hash": stats.result_hash,
+            "saturated": stats.saturated,
+            "failed": stats.failed,
+        } for circle, stats in overlap.items()
+    }
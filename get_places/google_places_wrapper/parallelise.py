@@ -3,100 +3,257 @@ The input is a potentially large list of items (circles). The work to be done is
 Each request results in a dictionary of place_id -> place_data.
 
 We split the list into batches - equal to the number of cpu cores.
-Then we spawn a new Process for each batch. We pass to the Process a single batch and a reference to a dictionary in which
-to store the results ("global results dictionary").
+Then we spawn a new Process for each batch. We pass to the Process a single batch and the writing end of a pipe
+("result channel"), through which the process streams its results back to the main process.
 
 Each process itself spawn N threads (~20). Each thread is given a mini-batch (part of a batch, i.e. a sub-batch).
 Then each thread sequentially processes the circles in its subbatch and collects the results of each query.
-Only when the thread has processes all of its assigned circles, it will push the result to the global result dictionary
+Once a thread has collected enough places (or when it's done), it encodes them to a compact chunk and sends it
+over the result channel of its process.
 
 The rationale for this is that we take advantage of the multiple cores of the CPU by splitting to Processes.
 However, within a single process we can further optimise by using lighter-weight Threads.
-The thread only pushes once it has all of its data to minise the number of calls to the shared results dictionary.
-The intuition is that calls to this process-shared dictionary are expensive, so it's better to do them more rarely.
-The different threads will finish at different times - the larger the mini-batches threads need to process,
-the larger the gap between when they finish. This is good because threads wouldn't need to wait for each other
-when they want to publish their results to the global results dictionary.
+The main process waits on the reading ends of all pipes and passes on the chunks as they arrive - iter_parallelise
+yields them (e.g. to filter or save them while the crawl goes on), parallelise merges them into the final result.
+CompactPlaces are sent as rows of values (without the names of the fields), other places as they are.
+Each process has its own pipe, so there's no single server process which all workers must go through
+(as is the case with a Manager dict), and the results are not kept in memory twice - in the manager and in the
+final result.
+
+Optionally, a SeenPlacesIndex (see dedup.py) can be shared by all processes. It's passed on to the query function,
+which uses it to drop places already fetched for another (overlapping) circle before they are sent to the main process.
+Each process sends the overlap statistics it collected once it's done.
 """
 
 import logging as log
-from multiprocessing import Manager, Process, current_process
-from threading import Thread
-from typing import List, Callable
+from functools import partial
+from multiprocessing import Event, Pipe, Process, Semaphore, current_process
+from multiprocessing.connection import Connection, wait
+from threading import Lock, Thread
+from time import time
+from typing import List, Callable, Dict, Iterator
 
 from deka_types import Circle, Place
 from get_places.deka_utils.misc import split_to_batches
+from get_places.google_places_wrapper.dedup import SeenPlacesIndex, OverlapStats
+from get_places.google_places_wrapper.place import CompactPlace
+from shared_utils import codec, profiling
+
+# a thread sends its places over the result channel once it has collected at least that many
+CHUNK_SIZE = 500
+# a worker sends a chunk only if it has less than that many chunks which the consumer hasn't taken yet
+MAX_CHUNKS_IN_FLIGHT = 4
+# when the iteration is stopped early, the workers have that many seconds to finish their current requests and exit.
+# the ones which don't are terminated
+STOP_TIMEOUT = 30
+# how often (seconds) a worker waiting to send a chunk checks if it should stop
+_STOP_POLL_INTERVAL = 0.1
+
+# the first byte of each message on the result channel says what the message holds
+_PLACES_MESSAGE = b'P'
+_OVERLAP_MESSAGE = b'O'
+_DONE_MESSAGE = b'D'
+
+
+def parallelise(batches: List[List[Circle]], single_query_function: Callable[[Circle], Place],
+                seen_index: SeenPlacesIndex = None):
+    """
+    Same as iter_parallelise, but the chunks are merged in a single dict.
+
+    :return: a single dict with *all* places within the circles from the batches
+    """
+    final_result = {}
+    for chunk in iter_parallelise(batches, single_query_function=single_query_function, seen_index=seen_index):
+        final_result.update(chunk)
+    return final_result
 
 
-def parallelise(batches: List[List[Circle]], single_query_function: Callable[[Circle], Place]):
+def iter_parallelise(batches: List[List[Circle]], single_query_function: Callable[[Circle], Place],
+                     seen_index: SeenPlacesIndex = None) -> Iterator[Dict[str, Place]]:
     """
     Spawn a new worker Process for each batch.
     Pass the batch to the process.
-    The Process writes its output to a dictionary, created by the main process.
+    The Process streams its output over a pipe, from which the main process reads.
+
+    A worker sends a chunk only while less than MAX_CHUNKS_IN_FLIGHT of its chunks haven't been taken by the
+    consumer yet, and blocks otherwise. So a slow consumer throttles the workers - the places in flight are bounded by
+    MAX_CHUNKS_IN_FLIGHT chunks per worker and the unsent chunks of the threads, not by the size of the area.
+    If the iteration is stopped early, the workers are asked to stop, and exit once their current requests are done.
+    Only the ones which are still running after STOP_TIMEOUT seconds are terminated.
 
     :param batches: a list of batches. Each batch is a list of Circle objects
     :param single_query_function - a method which receives a Circle as an argument and returns a str-> place dict
     this method will be called to perform a query for a single circle.
+    :param seen_index - optional. if given, it's passed to @single_query_function as a `seen_index` kwarg and
+    the overlap statistics of all processes are collected in seen_index.overlap
 
-    :return: a single dict with *all* places within the circles from the batches
+    :return: yields the chunks of places (dicts) as the workers send them. a place can be in more than one chunk
+    (e.g. if there's no @seen_index)
     """
-    with Manager() as manager:
-        # all sub-processes will use the final_result to store their results
-        final_result = manager.dict()
+    procs = []
+    readers = []
+    # the chunks each worker can still send before the consumer takes one of them, by reader
+    credits = {}
+    stop = Event()
+    for batch in batches:
+        reader, writer = Pipe(duplex=False)
+        credits[reader] = Semaphore(MAX_CHUNKS_IN_FLIGHT)
+        p = Process(target=_query_batch,
+                    kwargs={"batch": batch, "result_channel": writer, "query_function": single_query_function,
+                            "seen_index": seen_index, "credits": credits[reader], "stop": stop})
+        procs.append(p)
+        p.start()
+        # only the worker writes. closing our end makes sure that we get an EOFError if the worker dies
+        writer.close()
+        readers.append(reader)
 
-        procs = []
-        for batch in batches:
-            p = Process(target=_query_batch,
-                        kwargs={"batch": batch, "result_store": final_result, "query_function": single_query_function})
-            procs.append(p)
-            p.start()
+    log.debug("Launched %i processes", len(procs))
 
-        log.debug("Launched %i processes" % len(procs))
+    try:
+        # pass on the chunks as they arrive, until all processes are done
+        while readers:
+            for reader in wait(readers):
+                try:
+                    message = reader.recv_bytes()
+                except EOFError:
+                    log.critical("A worker process exited without sending all of its results")
+                    message = _DONE_MESSAGE
 
-        # wait for all processes to finish
+                kind, payload = message[:1], message[1:]
+                if kind == _PLACES_MESSAGE:
+                    yield _decode_places(payload)
+                    # the consumer took the chunk
+                    credits[reader].release()
+                elif kind == _OVERLAP_MESSAGE and seen_index is not None:
+                    seen_index.overlap.update(_decode_overlap(payload))
+                elif kind == _DONE_MESSAGE:
+                    readers.remove(reader)
+                    reader.close()
+    finally:
+        if readers:
+            # the consumer stopped early (or failed). ask the workers to stop, and read their pipes until they are
+            # done, so none of them blocks on a full pipe
+            log.debug("Stopping %i worker processes", len(readers))
+            stop.set()
+            deadline = time() + STOP_TIMEOUT
+            _drain(readers, deadline)
+            for p in procs:
+                p.join(timeout=max(deadline - time(), 0))
+                if p.is_alive():
+                    log.warning("Worker process %s didn't stop within %i seconds, terminating it", p.name,
+                                STOP_TIMEOUT)
+                    p.terminate()
         [p.join() for p in procs]
 
-        # final_result is a proxy dict managed by the Manager.
-        # convert it to a normal dict before exiting the "with
-        return dict(final_result)
+
+def _drain(readers: List[Connection], deadline: float) -> None:
+    """
+    Read and drop the messages on @readers until their workers are done, or until @deadline (a time()).
+    Close the readers.
+    """
+    while readers:
+        ready = wait(readers, timeout=max(deadline - time(), 0))
+        if not ready:
+            break
+        for reader in ready:
+            try:
+                message = reader.recv_bytes()
+            except EOFError:
+                message = _DONE_MESSAGE
+            if message[:1] == _DONE_MESSAGE:
+                readers.remove(reader)
+                reader.close()
+    [reader.close() for reader in readers]
 
 
-def _query_batch(batch: List[Circle], result_store: dict, query_function) -> None:
+@profiling.profiled_process("worker")
+def _query_batch(batch: List[Circle], result_channel: Connection, query_function,
+                 seen_index: SeenPlacesIndex = None, credits: Semaphore = None, stop: Event = None) -> None:
     """
     Inception.
     This  method will run in its own process. To speed up things, in this worker process,
     we will spawn couple of threads and distribute the @batch to them - each thread gets a mini batch :)
 
-    The threads will push their results directly to the @result_store, which is held by the main process.
+    The threads send their results over the @result_channel, which is read by the main process.
 
     :param batch
     :param query_function - the function which will perform the actual action of querying the API for a single area (circle)
-    :param result_store - this method will publish its output to this dict .duplicates are fine since it's a dict
+    :param result_channel - the writing end of a pipe. this method will publish its output to it.
+    duplicates are fine since the main process merges the results in a dict
+    :param seen_index - optional index of already fetched places, shared by all processes
+    :param credits - optional. acquired before each chunk of places is sent, and released by the main process once
+    the consumer takes the chunk
+    :param stop - optional. once it's set, the threads stop querying and drop their unsent places
     :return: None
     """
     process_name = current_process().name
+    if seen_index is not None:
+        query_function = partial(query_function, seen_index=seen_index)
+
+    # the connection is not thread-safe
+    channel_lock = Lock()
+
+    def send(message: bytes):
+        with channel_lock:
+            result_channel.send_bytes(message)
+
+    def stopped():
+        return stop is not None and stop.is_set()
+
+    def send_places(places: Dict[str, Place]):
+        if credits is not None:
+            while not credits.acquire(timeout=_STOP_POLL_INTERVAL):
+                if stopped():
+                    return
+        if not stopped():
+            send(_PLACES_MESSAGE + _encode_places(places))
 
     def sub_batch(mini_batch):
         """runs in a thread. sequentially process all queries in the mini_batch"""
 
         thread_result = {}
-        # query_function returns a dict. collect all the dicts in a list
+        for circle in mini_batch:
+            if stopped():
+                return
+            # query_function returns a dict. collect all the dicts in a single dict
+            thread_result.update(query_function(circle=circle))
+            if len(thread_result) >= CHUNK_SIZE:
+                send_places(thread_result)
+                thread_result = {}
 
-        list_of_places = [query_function(circle=circle) for circle in mini_batch]
-        # combine all dicts in a single dict
-        for places in list_of_places:
-            thread_result.update(places)
-        # merge the results of this thread to the global result (result_store is shared b/w multiple processes)
-
-        result_store.update(thread_result)
+        if thread_result:
+            send_places(thread_result)
 
     threads = []
     sub_batches = split_to_batches(batch, items_per_batch=len(batch) // 30)  # ~ 20 threads/process
     for sub in sub_batches:
-        t = Thread(target=sub_batch, kwargs={'mini_batch': sub})
+        t = Thread(target=profiling.profiled_thread_target(sub_batch), kwargs={'mini_batch': sub})
         threads.append(t)
         t.start()
 
-    log.debug("Process %s started %i threads" % (process_name, len(threads)))
+    log.debug("Process %s started %i threads", process_name, len(threads))
     [t.join() for t in threads]
-    log.debug("[DONE] Process %s is done" % process_name)
+    if seen_index is not None:
+        send(_OVERLAP_MESSAGE + _encode_overlap(seen_index.overlap))
+    send(_DONE_MESSAGE)
+    result_channel.close()
+    log.debug("[DONE] Process %s is done", process_name)
+
+
+def _encode_places(places: Dict[str, Place]) -> bytes:
+    return codec.dumps({place_id: place.to_row() if isinstance(place, CompactPlace) else place
+                        for place_id, place in places.items()})
+
+
+def _decode_places(payload: bytes) -> Dict[str, Place]:
+    return {place_id: CompactPlace.from_row(place) if isinstance(place, list) else place
+            for place_id, place in codec.loads(payload).items()}
+
+
+def _encode_overlap(overlap: Dict[Circle, OverlapStats]) -> bytes:
+    return codec.dumps([list(circle) + list(stats) for circle, stats in overlap.items()])
+
+
+def _decode_overlap(payload: bytes) -> Dict[Circle, OverlapStats]:
+    return {Circle(lat=lat, lng=lng, radius=radius): OverlapStats(*stats)
+            for lat, lng, radius, *stats in codec.loads(payload)}
@@ -0,0 +1,118 @@
+"""
+A place, as returned by the Google Places API, is a large nested dict - photos, attributions, viewport, icons, etc.
+During crawling we hold (tens of) thousands of them, most of which is data that neither the loader nor the consumers
+of the datastore use.
+
+CompactPlace keeps only the fields we need, in a __slots__ object. The strings which repeat across places (types,
+business status) are interned, so all places share a single copy of them.
+If the full payloads are needed, set Config.raw_places_folder - the raw places are then appended to files there
+(one json object per line) instead of being kept in memory.
+"""
+import os
+from sys import intern
+from threading import Lock
+
+from get_places.config import Config
+from shared_utils import codec
+
+
+class CompactPlace:
+    # the order of the fields is the order of the values in a row (see to_row())
+    __slots__ = ('place_id', 'name', 'lat', 'lng', 'types', 'vicinity', 'rating', 'user_ratings_total',
+                 'price_level', 'business_status')
+
+    def __init__(self, place_id, name=None, lat=None, lng=None, types=(), vicinity=None, rating=None,
+                 user_ratings_total=None, price_level=None, business_status=None):
+        self.place_id = place_id
+        self.name = name
+        self.lat = lat
+        self.lng = lng
+        self.types = tuple(intern(t) for t in types)
+        self.vicinity = vicinity
+        self.rating = rating
+        self.user_ratings_total = user_ratings_total
+        self.price_level = price_level
+        self.business_status = intern(business_status) if business_status else None
+
+    @classmethod
+    def from_api(cls, place: dict) -> 'CompactPlace':
+        """
+        :param place: a place as returned by the Google Places API
+        """
+        location = place.get('geometry', {}).get('location', {})
+        return cls(place_id=place['place_id'],
+                   name=place.get('name'),
+                   lat=location.get('lat'),
+                   lng=location.get('lng'),
+                   types=place.get('types', ()),
+                   vicinity=place.get('vicinity'),
+                   rating=place.get('rating'),
+                   user_ratings_total=place.get('user_ratings_total'),
+                   price_level=place.get('price_level'),
+                   business_status=place.get('business_status'))
+
+    def to_dict(self) -> dict:
+        """
+        :return: the place in the shape of the Google Places API (only with the fields we keep)
+        """
+        result = {'place_id': self.place_id, 'types': list(self.types)}
+        if self.lat is not None:
+            result['geometry'] = {'location': {'lat': self.lat, 'lng': self.lng}}
+        for field in ('name', 'vicinity', 'rating', 'user_ratings_total', 'price_level', 'business_status'):
+            value = getattr(self, field)
+            if value is not None:
+                result[field] = value
+        return result
+
+    def to_row(self) -> list:
+        """
+        :return: the values of all fields, without their names. used when sending places between processes.
+        """
+        return [getattr(self, field) for field in self.__slots__]
+
+    @classmethod
+    def from_row(cls, row) -> 'CompactPlace':
+        return cls(*row)
+
+    def __eq__(self, other):
+        return isinstance(other, CompactPlace) and self.to_row() == other.to_row()
+
+    def __repr__(self):
+        return "CompactPlace(%s)" % self.to_dict()
+
+
+def encode_place(obj):
+    """
+    Use as the `default` of codec.dump/dumps to serialize CompactPlaces as dicts.
+    """
+    if isinstance(obj, CompactPlace):
+        return obj.to_dict()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+class RawPlacesSink:
+    """
+    Appends raw places (as returned by the API) to a file in @folder. Each process writes to its own file.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = Lock()
+        self._file = None
+        self._pid = None
+
+    def write(self, places):
+        with self._lock:
+            if self._pid != os.getpid():
+                # first write in this process (the sink might have been inherited by a forked worker)
+                os.makedirs(self.folder, exist_ok=True)
+                self._file = open(os.path.join(self.folder, "raw_places_%i.jsonl" % os.getpid()), 'ab')
+                self._pid = os.getpid()
+            for place in places:
+                self._file.write(codec.dumps(place))
+                self._file.write(b"\n")
+            self._file.flush()
+
+
+# None if the raw places should not be kept
+raw_places_sink = RawPlacesSink(Config.raw_places_folder) if Config.raw_places_folder else None
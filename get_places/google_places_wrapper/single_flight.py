@@ -0,0 +1,58 @@
+"""
+Coalescing of identical in-flight requests.
+
+In dense grids the same request can be made by several threads of a worker process at the same time - duplicate
+circles in the input, or neighbouring saturated circles whose centres are the same once rounded, which are then
+queried for the same types (see handle_busy_circle). With a SingleFlight, the first of the threads makes the request
+and the rest wait for it and share its result (or its exception), instead of spending API quota on the same query.
+
+Only requests which are in flight are coalesced - a result is not kept once its request is done. Each worker process
+has its own SingleFlight, requests are not coalesced across processes.
+"""
+import threading
+from typing import Callable, Hashable
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # the number of calls which shared the result of another call
+        self.coalesced = 0
+
+    def do(self, key: Hashable, function: Callable):
+        """
+        Call @function, unless a call with the same @key is in flight. Then wait for that call and share its result.
+        :return: the result of @function. raises its exception
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+            return call.result
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
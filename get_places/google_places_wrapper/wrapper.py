@@ -2,18 +2,21 @@ import logging as log
 from datetime import datetime as dt
 from multiprocessing import cpu_count
 from time import sleep
-from typing import Dict
-
-import requests
+from typing import Dict, Iterator
 
 from deka_types import Circle
 from get_places.config import Config
 from get_places.deka_utils.misc import split_to_batches
+from get_places.google_places_wrapper.place import CompactPlace, raw_places_sink
+from get_places.google_places_wrapper.single_flight import SingleFlight
+from shared_utils import codec
+from shared_utils.log import sampled_logger
 
 # hide INFO logs from urllib3, used by requests
 log.getLogger("urllib3").setLevel(log.WARNING)
 
-_GOOGLE_API_ACCESS_CODE = Config.google_access_key.strip()
+# for the debug logs of each request - there are too many of them to log them all
+_request_log = sampled_logger("deka_minion.requests")
 
 # returned by google places api to signify that there's a next page of result for the query
 NEXT_PAGE_TOKEN_RESPONSE_KEY = "next_page_token"
@@ -29,27 +32,59 @@ MAX_RESULTS_PER_QUERY = 60
 
 interesting_venue_types = set(Config.places_types)
 
+# the requests in flight in this (worker) process
+_in_flight = SingleFlight()
 
-def query_google_places(circles_coords):
-    from .parallelise import parallelise
 
+def query_google_places(circles_coords, seen_index=None):
+    """
+    :param circles_coords: list of Circles to query
+    :param seen_index: optional SeenPlacesIndex. if given, places fetched for more than one (overlapping) circle are
+    dropped early in the worker processes and the overlap statistics per circle are collected in seen_index.overlap
+    :return: dict with all places within the circles
+    """
     start = dt.now()
 
-    # split to batches to parallelise querying
-    items_per_batch = len(circles_coords) // cpu_count()
-    batches = list(split_to_batches(circles_coords, items_per_batch=items_per_batch))
-    log.info("%i batches of circles will be processed now" % len(batches))
-    log.info("Result will contain venues of types [%s]" % str(interesting_venue_types))
-
-    result = parallelise(batches, single_query_function=_query_single_circle)
+    result = {}
+    for chunk in iter_google_places(circles_coords, seen_index=seen_index):
+        result.update(chunk)
+    if seen_index is not None:
+        seen_index.log_summary()
 
     end = dt.now()
-    log.info("Finished in %s seconds" % str((end - start).seconds))
+    log.info("Finished in %s seconds", (end - start).seconds)
 
     return result
 
 
-def _query_single_circle(circle: Circle, type=None) -> Dict:
+def iter_google_places(circles_coords, seen_index=None) -> Iterator[Dict]:
+    """
+    Same as query_google_places, but the places are yielded in chunks, as soon as the workers send them. The workers
+    are throttled if the chunks are consumed slower than they are fetched (see iter_parallelise).
+    The overlap statistics are complete in seen_index.overlap once the iteration is done.
+    If the iteration may stop early (e.g. the consumer fails), close the generator (contextlib.closing) - it stops
+    the workers.
+    :return: yields dicts of places. a place can be in more than one chunk
+    """
+    from .parallelise import iter_parallelise
+
+    if not circles_coords:
+        return
+    unique_circles = list(dict.fromkeys(circles_coords))
+    if len(unique_circles) < len(circles_coords):
+        log.info("%i duplicate circles in the input are dropped", len(circles_coords) - len(unique_circles))
+    circles_coords = unique_circles
+
+    # split to batches to parallelise querying
+    items_per_batch = len(circles_coords) // cpu_count()
+    batches = list(split_to_batches(circles_coords, items_per_batch=items_per_batch))
+    log.info("%i batches of circles will be processed now", len(batches))
+    log.info("Result will contain venues of types [%s]", interesting_venue_types)
+
+    yield from iter_parallelise(batches, single_query_function=_query_single_circle, seen_index=seen_index)
+
+
+def _query_single_circle(circle: Circle, type=None, seen_index=None) -> Dict:
     """
     Given the coordinates of an area (defined by a Circle),
     query the Google Places API for a list of all venues there.
@@ -63,26 +98,24 @@ def _query_single_circle(circle: Circle, type=None) -> Dict:
     https://developers.google.com/places/web-service/
     :param circle:
     :param type: one of https://developers.google.com/places/web-service/supported_types
-    :return: Dictionary of places.
+    :param seen_index: optional SeenPlacesIndex. places which were already fetched (e.g. for an overlapping circle)
+    are dropped from the result.
+    :return: Dictionary of places. The places are CompactPlaces.
     """
     all_pages_result = {}
 
     next_page_token = None
     has_next_page = True
-    url = ""
+    failed = False
 
     while has_next_page:
-        params = {"location": "%s,%s" % (circle.lat, circle.lng), "radius": circle.radius}
-        if next_page_token:
-            params[NEXT_PAGE_TOKEN_REQUEST_KEY] = next_page_token
-        if type:
-            params['type'] = type
-
-        url = _build_api_url(params)
+        params = _request_params(circle, type=type, next_page_token=next_page_token)
 
         try:
-            page_result = _make_http_request(url)
+            page_result = _make_coalesced_request(params)
             list_of_places = page_result['results']
+            _request_log.debug("%s, type %s: a page with %i places", circle, type, len(list_of_places),
+                               extra={"circle": list(circle), "place_type": type, "places": len(list_of_places)})
             places_dict = {place['place_id']: place for place in list_of_places}  # Dict comprehension
 
             all_pages_result.update(places_dict)
@@ -90,25 +123,36 @@ def _query_single_circle(circle: Circle, type=None) -> Dict:
             has_next_page = _api_response_has_more_pages(page_result)
             next_page_token = page_result[NEXT_PAGE_TOKEN_RESPONSE_KEY] if has_next_page else None
         except Exception as ex:
-            log.critical('Failed API request. Exception: %s' % str(ex))
+            log.critical('Failed API request. Exception: %s', ex)
             has_next_page = False
+            failed = True
 
     if (len(all_pages_result) == MAX_RESULTS_PER_QUERY):
         # the query returned the max allowed items. probs there are more.
         # we're gonna run the same query several times now for specific types and combine the results
         log.debug("A Query has returned MAX_RESULTS_PER_QUERY results. "
-                  "Highly likely that there are more places within this area. [%s]" % url)
+                  "Highly likely that there are more places within this area. [%s]", circle)
         if not type:
             # guard agains infinete recursion. don't run the extended search if we are already doing it.
-            return handle_busy_circle(circle)
+            return handle_busy_circle(circle, seen_index=seen_index)
         else:
             log.critical(
-                "A query for a specific venue type returned MAX_RESULTS_PER_QUERY %s" % url)
+                "A query for a specific venue type returned MAX_RESULTS_PER_QUERY %s %s", circle, type)
+    if seen_index is not None:
+        # drop the places we already have before filtering them and sending them to the main process
+        all_pages_result = seen_index.drop_seen(all_pages_result, circle=circle)
+        if failed:
+            # the circle isn't considered crawled (see recrawl.py). the places fetched until the failure are kept
+            seen_index.record_overlap(circle, fetched=0, duplicates=0, failed=True)
+
     # filter-out some places
-    return {place_id: place for place_id, place in all_pages_result.items() if should_keep_place(place)}
+    kept = [place for place in all_pages_result.values() if should_keep_place(place)]
+    if raw_places_sink is not None:
+        raw_places_sink.write(kept)
+    return {place['place_id']: CompactPlace.from_api(place) for place in kept}
 
 
-def handle_busy_circle(circle) -> Dict:
+def handle_busy_circle(circle, seen_index=None) -> Dict:
     """
     tl;dr wrapper around _query_sincle_circle which will 1) sequentially query @circle for all interesting_venue_types,
     2) combine the result and 3) return it.
@@ -123,12 +167,16 @@ def handle_busy_circle(circle) -> Dict:
     to the known maximum returned by the Google API. In this case, this method will make N sequential queries to
     the API where N == len(interesting_venue_types).
     :param circle: same as _query_single_circle
+    :param seen_index: same as _query_single_circle
     :return: same as _query_single_circle
     """
-    log.debug("Starting an extended search for %s" % str(circle))
+    log.debug("Starting an extended search for %s", circle)
+    if seen_index is not None:
+        seen_index.record_overlap(circle, fetched=0, duplicates=0, saturated=True)
     combined_types_of_places = {}
     # each result is a dict containing places of only one type
-    sequential_results = [_query_single_circle(circle, type=type) for type in interesting_venue_types]
+    sequential_results = [_query_single_circle(circle, type=type, seen_index=seen_index)
+                          for type in interesting_venue_types]
     # merge it all into a single dict
     for single_type_result in sequential_results:
         combined_types_of_places.update(single_type_result)
@@ -158,6 +206,25 @@ def should_keep_place(place):
     return True
 
 
+def _request_params(circle: Circle, type=None, next_page_token=None) -> Dict:
+    precision = Config.request_location_precision
+    params = {"location": "%s,%s" % (round(circle.lat, precision), round(circle.lng, precision)),
+              "radius": circle.radius}
+    if next_page_token:
+        params[NEXT_PAGE_TOKEN_REQUEST_KEY] = next_page_token
+    if type:
+        params['type'] = type
+    return params
+
+
+def _make_coalesced_request(params):
+    """
+    Same as _make_http_request, but if the same request (same @params) is already in flight, wait for its result
+    instead of making it again. The result is shared, it must not be modified.
+    """
+    return _in_flight.do(tuple(sorted(params.items())), lambda: _make_http_request(_build_api_url(params)))
+
+
 def _api_response_has_more_pages(query_result):
     return NEXT_PAGE_TOKEN_RESPONSE_KEY in query_result
 
@@ -166,10 +233,13 @@ retriable_statuses = ["INVALID_REQUEST", "UNKNOWN_ERROR"]
 
 
 def _make_http_request(url, retries_left=6):
+    # imported here - it's slow to import and not needed until the first query
+    import requests
+
     result = requests.get(url, timeout=4)
     if result.status_code != 200:
         raise Exception("Google API returned non-200 code for query %s" % url)
-    parsed = result.json()
+    parsed = codec.loads(result.content)
 
     status = parsed['status']
     if status in retriable_statuses:
@@ -177,19 +247,19 @@ def _make_http_request(url, retries_left=6):
         # UNKNOWN_ERROR indicates a server-side error; trying again may be successful.
 
         if retries_left > 0:
-            # log.debug("Going to retry query %s" % url)
+            _request_log.debug("Going to retry a query. Google responded with [%s]", status)
             sleep(1)
             return _make_http_request(url, retries_left=retries_left - 1)
         else:
             raise Exception(
                 "Google responded with [%s] for query [%s]. The retries were exceeded." % (status, url))
 
-    return result.json()
+    return parsed
 
 
 def _build_api_url(params):
     base = "{google_api_url}?key={key}".format(
-        key=_GOOGLE_API_ACCESS_CODE,
+        key=Config.google_access_key.strip(),
         google_api_url=_endpoint_url
     )
     for k, v in params.items():
@@ -0,0 +1,34 @@
+"""
+Merges the outputs of the shards of a crawl (see sharding.py) into a single output for the area, as if it was crawled
+by a single get_places_data.py run.
+"""
+import argparse
+import logging as log
+
+from get_places.get_places_data import OutputFormat, save_output
+from get_places.sharding import merge_shard_outputs
+from shared_utils.file_utils import get_directory_of_file
+from shared_utils.log import init_logger
+
+
+def main():
+    args = parse_args()
+    places, metadata = merge_shard_outputs(args.files)
+    log.info("%i places in the %i shards of %s" % (len(places), len(args.files), metadata['area_name']))
+
+    file_path = save_output(places, metadata, output_format=args.format)
+    # important that the last line of the stdout contains the path to the output file
+    print(file_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+', help="the outputs of all shards (json or indexed)")
+    parser.add_argument('--format', choices=[OutputFormat.json, OutputFormat.indexed], default=OutputFormat.json,
+                        help="format of the output file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    init_logger(get_directory_of_file(__file__))
+    main()
@@ -0,0 +1,162 @@
+"""
+Incremental re-crawling. Most circles of an area return the same places week after week, so re-querying all of them
+wastes API quota and time.
+
+The history of each circle is kept in a json file - when it was last crawled, a hash of the ids of its places, whether
+it was saturated and its churn - an exponential moving average of whether its result changed between crawls.
+Only the circles due for a refresh are queried, and the places of the rest are taken from the previous output.
+
+A circle is due if it was never crawled, or if it's older than its refresh interval. The interval shrinks from
+Config.recrawl_max_age_days (the result never changes) to Config.recrawl_min_age_days (it changes on every crawl)
+with the churn. Saturated circles (see handle_busy_circle) use the min age.
+"""
+import logging as log
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from deka_types import Circle, Place
+from get_places.config import Config
+from get_places.google_places_wrapper.dedup import OverlapStats
+from shared_utils import geohash
+from shared_utils.file_utils import readJSONFileAndConvertToDict, save_dict_to_file
+
+# last_crawl - iso datetime. result_hash, saturated - see OverlapStats. crawls - how many times it was crawled
+CircleHistory = namedtuple('CircleHistory', ['last_crawl', 'result_hash', 'saturated', 'churn', 'crawls'])
+
+# the churn of a circle crawled for the first time. in the middle, until we learn more
+_INITIAL_CHURN = 0.5
+
+
+def circle_key(circle: Circle) -> str:
+    return "%s,%s,%s" % (circle.lat, circle.lng, circle.radius)
+
+
+class CrawlHistory:
+    def __init__(self, circles: Dict[str, CircleHistory] = None):
+        """
+        :param circles: circle_key -> CircleHistory
+        """
+        self.circles = circles or {}
+
+    @classmethod
+    def load(cls, file_path) -> 'CrawlHistory':
+        """
+        :return: the history saved in @file_path. empty if the file doesn't exist (nothing was crawled yet)
+        """
+        if not os.path.exists(file_path):
+            return cls()
+        raw = readJSONFileAndConvertToDict(file_path)
+        return cls({key: CircleHistory(**history) for key, history in raw.items()})
+
+    def save(self, file_path):
+        save_dict_to_file({key: history._asdict() for key, history in self.circles.items()}, file_path)
+
+    def __len__(self):
+        return len(self.circles)
+
+    @staticmethod
+    def refresh_interval(history: CircleHistory) -> timedelta:
+        min_age, max_age = Config.recrawl_min_age_days, Config.recrawl_max_age_days
+        if history.saturated:
+            return timedelta(days=min_age)
+        return timedelta(days=max_age - (max_age - min_age) * history.churn)
+
+    def due_circles(self, circles: List[Circle], now: datetime, max_circles=None) -> List[Circle]:
+        """
+        :param max_circles: optional. query at most this many circles - the most overdue ones
+        :return: the circles which should be queried now. never crawled circles come first
+        """
+        overdue = []
+        for circle in circles:
+            history = self.circles.get(circle_key(circle))
+            if history is None:
+                overdue.append((float('inf'), circle))
+                continue
+            age = now - datetime.fromisoformat(history.last_crawl)
+            ratio = age / self.refresh_interval(history)
+            if ratio >= 1:
+                overdue.append((ratio, circle))
+
+        overdue.sort(key=lambda item: item[0], reverse=True)
+        due = [circle for _, circle in overdue[:max_circles]]
+        log.info("%i of %i circles are due for a refresh, %i of them will be queried"
+                 % (len(overdue), len(circles), len(due)))
+        return due
+
+    def update(self, crawled: List[Circle], overlap: Dict[Circle, OverlapStats], now: datetime):
+        """
+        Record the results of a crawl. The circles whose query failed stay due.
+        :param crawled: the circles which were queried
+        :param overlap: the stats of the queried circles. see SeenPlacesIndex.overlap
+        """
+        alpha = Config.recrawl_churn_smoothing
+        changed = 0
+        for circle in succeeded_circles(crawled, overlap):
+            stats = overlap[circle]
+            key = circle_key(circle)
+            previous = self.circles.get(key)
+            if previous is None:
+                churn, crawls = _INITIAL_CHURN, 1
+            else:
+                has_changed = previous.result_hash != stats.result_hash
+                changed += has_changed
+                churn, crawls = previous.churn * (1 - alpha) + alpha * has_changed, previous.crawls + 1
+            self.circles[key] = CircleHistory(last_crawl=now.isoformat(), result_hash=stats.result_hash,
+                                              saturated=stats.saturated, churn=round(churn, 4), crawls=crawls)
+        log.info("The results of %i of the %i queried circles changed since their previous crawl"
+                 % (changed, len(crawled)))
+
+
+def succeeded_circles(crawled: List[Circle], overlap: Dict[Circle, OverlapStats]) -> List[Circle]:
+    """
+    :return: the circles of @crawled whose query succeeded - they have stats and none of their requests failed
+    """
+    succeeded = [circle for circle in crawled if circle in overlap and not overlap[circle].failed]
+    if len(succeeded) < len(crawled):
+        log.warning("The queries of %i of the %i circles failed" % (len(crawled) - len(succeeded), len(crawled)))
+    return succeeded
+
+
+def merge_with_previous(previous: Dict[str, Place], fresh: Dict[str, Place], crawled: List[Circle]) -> Dict:
+    """
+    :param previous: the places of the previous output
+    :param fresh: the places of the circles which were just queried
+    :param crawled: the circles which were just queried successfully (see succeeded_circles). the previous places
+    of the failed circles are kept
+    :return: the previous places, where the places within the queried circles are replaced by the fresh ones
+    """
+    within_crawled = _CirclesLookup(crawled)
+    merged = {place_id: place for place_id, place in previous.items() if not within_crawled.contains(place)}
+    log.info("%i places kept from the previous output, %i fresh places" % (len(merged), len(fresh)))
+    merged.update(fresh)
+    return merged
+
+
+class _CirclesLookup:
+    """
+    Finds whether a place is within any of a set of circles, by checking only the circles near the place - the circles
+    are bucketed by the geohash cells they intersect.
+    """
+
+    def __init__(self, circles: List[Circle]):
+        radius = max((circle.radius for circle in circles), default=0)
+        # the longest geohash whose cells are still bigger than the circles - a circle intersects only a few cells
+        self._precision = 1
+        while self._precision < 12 and \
+                geohash.cell_size(self._precision + 1)[0] * geohash.METRES_PER_DEGREE >= radius:
+            self._precision += 1
+        self._cells = {}
+        for circle in circles:
+            bbox = geohash.circle_bbox(circle.lat, circle.lng, circle.radius)
+            for cell in geohash.cover(*bbox, precision=self._precision):
+                self._cells.setdefault(cell, []).append(circle)
+
+    def contains(self, place: Place) -> bool:
+        location = place.get('geometry', {}).get('location')
+        if not location or not self._cells:
+            return False
+        lat, lng = location['lat'], location['lng']
+        nearby = self._cells.get(geohash.encode(lat, lng, self._precision), ())
+        return any(geohash.distance(lat, lng, circle.lat, circle.lng) <= circle.radius for circle in nearby)
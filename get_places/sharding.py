@@ -0,0 +1,85 @@
+"""
+Crawling an area on several machines. The circles of the input are partitioned in N shards, each one crawled
+independently (get_places_data.py --shard i/N), and the outputs of the shards are merged into a single output for
+the area (merge_shards.py).
+
+The circles are sorted by their geohash and split in N ranges of (almost) the same number of circles. Thus the
+partition depends only on the circles and N - every machine computes the same one from the same input - and each
+shard is a compact region, so few places are fetched by more than one shard (at the borders).
+"""
+import logging as log
+from collections import namedtuple
+from typing import List, Dict, Tuple
+
+from deka_types import Circle
+from shared_utils import geohash
+from shared_utils.file_utils import read_places_file
+
+# index - 0..count-1
+Shard = namedtuple('Shard', ['index', 'count'])
+
+
+def parse_shard(value: str) -> Shard:
+    """
+    :param value: "<index>/<count>", e.g. "0/4" for the first of four shards
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError("A shard is <index>/<count>, e.g. 0/4. Got %s" % value)
+    if not 0 <= index < count:
+        raise ValueError("The shard index must be in [0, %i). Got %i" % (count, index))
+    return Shard(index=index, count=count)
+
+
+def shard_to_str(shard: Shard) -> str:
+    return "%i/%i" % (shard.index, shard.count)
+
+
+def shard_circles(circles: List[Circle], shard: Shard) -> List[Circle]:
+    """
+    :return: the circles of @shard
+    """
+    ordered = sorted(circles, key=lambda circle: (geohash.to_int(geohash.encode(circle.lat, circle.lng)),) + circle)
+    start = len(ordered) * shard.index // shard.count
+    end = len(ordered) * (shard.index + 1) // shard.count
+    log.info("Shard %s has %i of the %i circles" % (shard_to_str(shard), end - start, len(circles)))
+    return ordered[start:end]
+
+
+def merge_shard_outputs(file_paths: List[str]) -> Tuple[Dict, Dict]:
+    """
+    :param file_paths: the outputs of all shards of a crawl (json or indexed)
+    :return: (places, metadata) of the whole area. a place fetched by more than one shard is kept once
+    """
+    places = {}
+    metadata = None
+    shards = set()
+    for file_path in file_paths:
+        output = read_places_file(file_path)
+        shard_metadata = dict(output['metadata'])
+        if 'shard' not in shard_metadata:
+            raise ValueError("%s is not the output of a shard" % file_path)
+        shard = parse_shard(shard_metadata.pop('shard'))
+        if metadata is None:
+            metadata, count = shard_metadata, shard.count
+        elif shard_metadata['area_name'] != metadata['area_name'] or shard.count != count:
+            raise ValueError("%s is the output of another crawl - area %s, %i shards"
+                             % (file_path, shard_metadata['area_name'], shard.count))
+        if shard.index in shards:
+            raise ValueError("Shard %s is given more than once" % shard_to_str(shard))
+        shards.add(shard.index)
+
+        shard_places = output['places']
+        duplicates = len(shard_places.keys() & places.keys())
+        log.info("%s - shard %s, %i places, %i of them fetched by other shards too"
+                 % (file_path, shard_to_str(shard), len(shard_places), duplicates))
+        for place_id, place in shard_places.items():
+            places.setdefault(place_id, place)
+
+    if metadata is None:
+        raise ValueError("No shard outputs are given")
+    missing = sorted(set(range(count)) - shards)
+    if missing:
+        raise ValueError("The outputs of shards %s are missing" % ", ".join("%i/%i" % (i, count) for i in missing))
+    return places, metadata
@@ -1,4 +1,75 @@
+import os
+
+from deka_types import PLACES_TYPES
+
+
+def _env_flag(name, default=False):
+    return os.environ.get(name, str(default)).lower() in ("1", "true", "yes")
+
+
 class Config:
-    REDIS_HOST = "127.0.0.1"
-    REDIST_PORT = 6379
-    REDIS_DB = 0
+    """
+    Everything is configured via the environment. The redis clients are created on first use (not on import),
+    so changes to the Config before that are respected too.
+    """
+    REDIS_HOST = os.environ.get("DEKA_REDIS_HOST", "127.0.0.1")
+    REDIST_PORT = int(os.environ.get("DEKA_REDIS_PORT", 6379))
+    REDIS_DB = int(os.environ.get("DEKA_REDIS_DB", 0))
+
+    """
+    If true, REDIS_HOST:REDIST_PORT is a node of a Redis Cluster, used to discover the rest of the cluster.
+    Note that a cluster has only db 0.
+    """
+    REDIS_CLUSTER = _env_flag("DEKA_REDIS_CLUSTER")
+
+    """
+    Route reads (RedisFacade.get_*) to replicas. In a cluster, the replicas are discovered.
+    For a standalone node, list them in REDIS_REPLICAS - "<host>:<port>,<host>:<port>"
+    """
+    REDIS_READ_FROM_REPLICAS = _env_flag("DEKA_REDIS_READ_FROM_REPLICAS")
+    REDIS_REPLICAS = os.environ.get("DEKA_REDIS_REPLICAS", "")
+
+    # connection pool. in a cluster, each node has its own pool
+    REDIS_MAX_CONNECTIONS = int(os.environ.get("DEKA_REDIS_MAX_CONNECTIONS", 32))
+    REDIS_SOCKET_TIMEOUT = float(os.environ.get("DEKA_REDIS_SOCKET_TIMEOUT", 30))
+    REDIS_SOCKET_CONNECT_TIMEOUT = float(os.environ.get("DEKA_REDIS_SOCKET_CONNECT_TIMEOUT", 5))
+    REDIS_SOCKET_KEEPALIVE = _env_flag("DEKA_REDIS_SOCKET_KEEPALIVE", default=True)
+    REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("DEKA_REDIS_HEALTH_CHECK_INTERVAL", 30))
+
+    """
+    0 - each area is stored under a single places hash and a single coordinates geo set.
+    N > 0 - the places of an area are split in shards by the first N characters of their geohash.
+    Each shard has its own keys, hash-tagged so that a Redis Cluster can spread them across nodes.
+    e.g. with 5, a shard covers a cell of ~4.9km x 4.9km.
+    """
+    SHARD_GEOHASH_PRECISION = int(os.environ.get("DEKA_REDIS_SHARD_PRECISION", 0))
+
+    """
+    Load the places with Lua scripts (see datastore_adapter/scripts.py) - a chunk of LOAD_CHUNK_SIZE places per call,
+    and promote the area with a single atomic call.
+    """
+    REDIS_USE_SCRIPTS = _env_flag("DEKA_REDIS_USE_SCRIPTS", default=True)
+    LOAD_CHUNK_SIZE = int(os.environ.get("DEKA_LOAD_CHUNK_SIZE", 500))
+
+    """
+    Load the places with asyncio (see datastore_adapter/async_loader.py) - a pipeline per chunk of LOAD_CHUNK_SIZE
+    places, with up to ASYNC_MAX_PIPELINES of them in flight while the next chunk is encoded.
+    """
+    REDIS_ASYNC_LOAD = _env_flag("DEKA_REDIS_ASYNC_LOAD")
+    ASYNC_MAX_PIPELINES = int(os.environ.get("DEKA_ASYNC_MAX_PIPELINES", 8))
+
+    """
+    The read queries (see datastore_adapter/query.py). The candidates of a query are cached for QUERY_CACHE_TTL seconds
+    (0 disables the cache), for all queries of the same shape whose centre is in the same geohash cell of
+    QUERY_CACHE_PRECISION characters (7 - ~150m x 150m). Results with more than QUERY_CACHE_MAX_CANDIDATES places are
+    not cached.
+    """
+    QUERY_PAGE_SIZE = int(os.environ.get("DEKA_QUERY_PAGE_SIZE", 20))
+    QUERY_CACHE_TTL = int(os.environ.get("DEKA_QUERY_CACHE_TTL", 60))
+    QUERY_CACHE_PRECISION = int(os.environ.get("DEKA_QUERY_CACHE_PRECISION", 7))
+    QUERY_CACHE_MAX_CANDIDATES = int(os.environ.get("DEKA_QUERY_CACHE_MAX_CANDIDATES", 5000))
+
+    """
+    For each of these types, a geo set with only the places of the type is built (see README.md)
+    """
+    PLACES_TYPES = PLACES_TYPES
@@ -1 +1,2 @@
 from .redis import load_to_datastore, RedisFacade
+from .query import search_places
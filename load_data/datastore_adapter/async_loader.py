@@ -0,0 +1,142 @@
+"""
+An asyncio (redis.asyncio) variant of load_to_temporary.
+
+The synchronous loader encodes all places into a single pipeline, then waits for a single round-trip. Here each chunk
+of Config.LOAD_CHUNK_SIZE places is a pipeline of its own, sent as soon as it's encoded. While up to
+Config.ASYNC_MAX_PIPELINES pipelines are in flight, the next chunk is encoded - the encoding (CPU) overlaps with the
+network round-trips and the work of Redis.
+
+In a cluster, a chunk which is loaded with the ingest script is a call of the script instead of a pipeline, since
+a cluster pipeline can't call scripts (see scripts.py). The script is loaded on all primaries first.
+
+The chunks write to the temp keys only, so their order doesn't matter. The area is promoted atomically afterwards,
+the same way as with the synchronous loader (promote_temp_to_official).
+"""
+import asyncio
+import logging as log
+from typing import Dict
+
+from load_data.config import Config
+from load_data.datastore_adapter import scripts
+from load_data.datastore_adapter.connection import create_async_client, same_slot
+from load_data.datastore_adapter.redis import KeyConverter, RedisFacade, area_key, sharded_templates, \
+    split_to_shards, pack_records, temp_stage_keys, cities_shards_template_key
+from load_data.deka_types import Metadata
+
+
+async def load_to_temporary_async(places: Dict, metadata: Metadata):
+    """
+    Same as load_to_temporary.
+    """
+    temp_area_name = KeyConverter.to_temp(metadata.area_name)
+    client = create_async_client()
+    in_flight = _RequestsInFlight(Config.ASYNC_MAX_PIPELINES)
+    try:
+        if Config.SHARD_GEOHASH_PRECISION:
+            shards = split_to_shards(places, Config.SHARD_GEOHASH_PRECISION)
+            log.info("The places are split in %i shards" % len(shards))
+        else:
+            shards = {None: places}
+
+        # the leftovers of a failed load would be promoted with the new data. see delete_temp_stage
+        old_shards = await client.smembers(cities_shards_template_key + temp_area_name)
+        pipe = client.pipeline(transaction=False)
+        for key in temp_stage_keys(metadata.area_name, [shard for shard in shards if shard is not None], old_shards):
+            pipe.delete(key)
+        RedisFacade.add_boundaries(area_name=temp_area_name, boundaries_rectangle=metadata.bounding_rectangle,
+                                   pipe=pipe)
+        if Config.SHARD_GEOHASH_PRECISION:
+            RedisFacade.add_shards(area_name=temp_area_name, shards=shards.keys(), pipe=pipe)
+        await pipe.execute(raise_on_error=True)
+
+        ingest_sha = await client.script_load(scripts.INGEST) if Config.REDIS_USE_SCRIPTS else None
+        for shard, shard_places in shards.items():
+            for request in _chunks(client, temp_area_name, shard_places, shard, ingest_sha):
+                await in_flight.send(request)
+        await in_flight.wait()
+        log.info("Added new data in a temporary stage [%s] with %i pipelines"
+                 % (metadata.area_name, in_flight.sent))
+    except Exception:
+        log.exception('failed to persist to temporary')
+        raise
+    finally:
+        # e.g. after a request failed, the rest of the requests in flight must not run on a closed client
+        await in_flight.settle()
+        await client.aclose()
+
+
+def _chunks(client, area_name, places: Dict, shard, ingest_sha):
+    """
+    Yields a request (an awaitable) for each chunk of the places - the execution of a pipeline, or a call of the
+    ingest script in a cluster. A chunk is encoded only when the next request is requested.
+
+    :param ingest_sha: the sha of the ingest script (see scripts.py) if it's loaded. None to load without scripts
+    """
+    keys = [area_key(template_key, area_name, shard) for template_key in sharded_templates()]
+    if ingest_sha and (not Config.REDIS_CLUSTER or same_slot(*keys)):
+        records_per_chunk = min(Config.LOAD_CHUNK_SIZE, scripts.MAX_RECORDS_PER_CHUNK)
+        for records in pack_records(places, records_per_chunk):
+            if Config.REDIS_CLUSTER:
+                yield client.evalsha(ingest_sha, len(keys), *keys, *records)
+                continue
+            pipe = client.pipeline(transaction=False)
+            pipe.evalsha(ingest_sha, len(keys), *keys, *records)
+            yield pipe.execute(raise_on_error=True)
+        return
+
+    place_ids = list(places)
+    for start in range(0, len(place_ids), Config.LOAD_CHUNK_SIZE):
+        chunk = {place_id: places[place_id] for place_id in place_ids[start:start + Config.LOAD_CHUNK_SIZE]}
+        pipe = client.pipeline(transaction=False)
+        RedisFacade.add_places(area_name=area_name, places=chunk, pipe=pipe, shard=shard)
+        RedisFacade.add_coordinates(area_name=area_name, places=chunk, pipe=pipe, shard=shard)
+        RedisFacade.add_indexes(area_name=area_name, places=chunk, pipe=pipe, shard=shard)
+        yield pipe.execute(raise_on_error=True)
+
+
+class _RequestsInFlight:
+    """
+    Executes requests (e.g. pipelines) concurrently - at most @limit at a time. send() waits while the limit is reached.
+    """
+
+    def __init__(self, limit):
+        self._slots = asyncio.Semaphore(limit)
+        self._tasks = []
+        self._error = None
+        self.sent = 0
+
+    async def send(self, request):
+        """
+        :param request: an awaitable, e.g. pipe.execute()
+        """
+        await self._slots.acquire()
+        if self._error is not None:
+            self._slots.release()
+            # it won't be awaited
+            request.close()
+            raise self._error
+        self._tasks.append(asyncio.create_task(self._execute(request)))
+        self.sent += 1
+        # let the request be written to the socket before the caller encodes the next chunk
+        await asyncio.sleep(0)
+
+    async def _execute(self, request):
+        try:
+            await request
+        except Exception as ex:
+            self._error = self._error or ex
+            raise
+        finally:
+            self._slots.release()
+
+    async def settle(self):
+        """
+        Wait for all requests, whether they fail or not. Their errors are dropped.
+        """
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def wait(self):
+        results = await asyncio.gather(*self._tasks, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
@@ -0,0 +1,146 @@
+"""
+The redis clients used by the adapter. They are created on first use from the Config.
+
+There are two clients:
+* the primary client - used for all writes, and for reads which must see the latest writes (e.g. during promotion)
+* the read client - used by the readers (RedisFacade.get_*). If Config.REDIS_READ_FROM_REPLICAS is set, it's
+connected to the replicas, so that reads scale with them. Otherwise it's the primary client.
+
+Each client has its own connection pool, which is thread-safe, so the clients can be shared by all threads of
+a process. A forked process must not share the sockets of its parent though - the clients are re-created in it.
+
+The asyncio clients (create_async_client) are bound to an event loop, so they are not shared - the caller creates one
+per loop and closes it.
+"""
+import logging as log
+import os
+import random
+from threading import RLock
+
+from redis import ConnectionPool, StrictRedis
+from redis.cluster import RedisCluster
+from redis.crc import key_slot
+
+from load_data.config import Config
+
+# re-entrant, since the read client might be the primary client
+_lock = RLock()
+_clients = {}
+# the pid of the process which created the clients
+_owner_pid = None
+
+
+def _connection_kwargs():
+    return {
+        "decode_responses": True,
+        "socket_timeout": Config.REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": Config.REDIS_SOCKET_CONNECT_TIMEOUT,
+        "socket_keepalive": Config.REDIS_SOCKET_KEEPALIVE,
+        "health_check_interval": Config.REDIS_HEALTH_CHECK_INTERVAL,
+    }
+
+
+def _create_standalone_client(host, port):
+    pool = ConnectionPool(host=host, port=port, db=Config.REDIS_DB, max_connections=Config.REDIS_MAX_CONNECTIONS,
+                          **_connection_kwargs())
+    return StrictRedis(connection_pool=pool)
+
+
+def _create_cluster_client(read_from_replicas):
+    return RedisCluster(host=Config.REDIS_HOST, port=Config.REDIST_PORT, read_from_replicas=read_from_replicas,
+                        max_connections=Config.REDIS_MAX_CONNECTIONS, **_connection_kwargs())
+
+
+def create_async_client():
+    """
+    :return: a new redis.asyncio client for writes, configured like the primary client
+    """
+    if Config.REDIS_CLUSTER:
+        from redis.asyncio.cluster import RedisCluster as AsyncRedisCluster
+
+        return AsyncRedisCluster(host=Config.REDIS_HOST, port=Config.REDIST_PORT,
+                                 max_connections=Config.REDIS_MAX_CONNECTIONS, **_connection_kwargs())
+
+    from redis.asyncio import ConnectionPool as AsyncConnectionPool, Redis as AsyncRedis
+
+    pool = AsyncConnectionPool(host=Config.REDIS_HOST, port=Config.REDIST_PORT, db=Config.REDIS_DB,
+                               max_connections=Config.REDIS_MAX_CONNECTIONS, **_connection_kwargs())
+    # the client owns the pool - it's closed with the client
+    return AsyncRedis.from_pool(pool)
+
+
+def _create_read_client():
+    if not Config.REDIS_READ_FROM_REPLICAS:
+        return get_client()
+    if Config.REDIS_CLUSTER:
+        return _create_cluster_client(read_from_replicas=True)
+
+    replicas = [replica.strip() for replica in Config.REDIS_REPLICAS.split(",") if replica.strip()]
+    if not replicas:
+        log.warning("REDIS_READ_FROM_REPLICAS is set, but no REDIS_REPLICAS are given. Reading from the primary.")
+        return get_client()
+    # spread the readers (processes) across the replicas
+    host, port = random.choice(replicas).rsplit(":", 1)
+    return _create_standalone_client(host, int(port))
+
+
+_factories = {
+    "primary": lambda: (_create_cluster_client(read_from_replicas=False) if Config.REDIS_CLUSTER
+                        else _create_standalone_client(Config.REDIS_HOST, Config.REDIST_PORT)),
+    "read": _create_read_client,
+}
+
+
+def _get(name):
+    global _owner_pid
+    with _lock:
+        if _owner_pid != os.getpid():
+            # first use in this process. don't reuse the connections of the parent process
+            _clients.clear()
+            _owner_pid = os.getpid()
+        if name not in _clients:
+            _clients[name] = _factories[name]()
+        return _clients[name]
+
+
+def get_client():
+    """
+    :return: the client for writes
+    """
+    return _get("primary")
+
+
+def get_read_client():
+    """
+    :return: the client for reads. it might be connected to a replica, so it might lag behind the primary.
+    """
+    return _get("read")
+
+
+def reset_clients():
+    """
+    Drop the clients, e.g. after the Config has changed. They are re-created on next use.
+    """
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def same_slot(*keys):
+    """
+    :return: True if all keys map to the same slot of a Redis Cluster (multi-key commands require it)
+    """
+    return len({key_slot(key.encode("utf-8")) for key in keys}) == 1
+
+
+class LazyClient:
+    """
+    Behaves like the client returned by @factory, but the client is created only on first use.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
@@ -0,0 +1,215 @@
+"""
+The read queries - the places of an area within a radius (or a box) around a point, optionally only of a type and with
+a min rating, sorted by distance and paginated.
+
+A query is answered in two steps:
+* the candidates - the places within a slightly bigger circle (box) around the centre of the geohash cell of the query
+(Config.QUERY_CACHE_PRECISION), with their coordinates and ratings. They are read from the geo sets (the type index,
+if a type is given) and the ratings index, only from the shards which intersect the query in the sharded layout.
+* the exact result - the candidates within the query, filtered by rating and sorted by (distance, place_id).
+
+The candidates depend only on the cell, the shape and the type of the query, so they are cached in Redis for
+Config.QUERY_CACHE_TTL seconds and shared by all readers - the queries of users near each other (in the same cell)
+are answered without searching the geo sets. The cache keys include the generation of the area, which is incremented
+when the area is promoted (see promote_temp_to_official), so the cached candidates of the old data aren't used.
+
+The pages are keyset-paginated - the cursor is the (distance, place_id) of the last place of the page, and the next
+page starts after it. Thus a cursor stays valid (the next page doesn't skip or repeat places) when the area is
+promoted between the pages. The distances are approximated the same way as shared_utils.geohash.distance.
+"""
+import bisect
+import logging as log
+from collections import namedtuple
+from math import cos, radians
+from typing import List, Optional
+
+from load_data.config import Config
+from load_data.datastore_adapter.connection import get_client, get_read_client
+from load_data.datastore_adapter.redis import RedisFacade, area_key, type_template_key, deserialize, serialize, \
+    cities_coordinates_template_key, cities_places_template_key, cities_ratings_template_key, \
+    cities_generation_template_key, cities_query_cache_template_key
+from shared_utils import geohash
+
+# distance - in metres from the centre of the query. place - as loaded
+FoundPlace = namedtuple('FoundPlace', ['place_id', 'distance', 'place'])
+# next_cursor - pass it to get the next page. None if it's the last page
+QueryPage = namedtuple('QueryPage', ['places', 'next_cursor'])
+
+# a place within the candidates of a query. rating is None if the place has no rating. shard is None if the area is
+# not sharded
+_Candidate = namedtuple('_Candidate', ['place_id', 'lat', 'lng', 'rating', 'shard'])
+
+# the candidates are searched in a slightly bigger area than needed, so that the approximations of the distances
+# (ours and the one of redis) don't leave out places at the border
+_MARGIN_RATIO = 1.01
+_MARGIN_METRES = 1
+
+
+def search_places(area_name, lat, lng, radius=None, box=None, place_type=None, min_rating=None, limit=None,
+                  cursor=None) -> QueryPage:
+    """
+    :param radius: in metres. the places within the circle around (@lat, @lng)
+    :param box: (width, height) in metres. the places within the box centred at (@lat, @lng). either @radius or @box
+    :param place_type: optional. one of Config.PLACES_TYPES - only places of this type
+    :param min_rating: optional. only places with at least this rating (places without a rating are left out)
+    :param limit: the max number of places in the page. Config.QUERY_PAGE_SIZE by default
+    :param cursor: the next_cursor of the previous page. None for the first page
+    :return: a QueryPage. its places are FoundPlaces, sorted by distance
+    """
+    if (radius is None) == (box is None):
+        raise ValueError("Either a radius or a box must be given")
+    limit = limit or Config.QUERY_PAGE_SIZE
+    after = _decode_cursor(cursor) if cursor else None
+
+    shape = _Radius(radius) if radius is not None else _Box(*box)
+    found = []
+    for candidate in _get_candidates(area_name, lat, lng, shape, place_type):
+        if min_rating is not None and (candidate.rating is None or candidate.rating < min_rating):
+            continue
+        if shape.contains(lat, lng, candidate.lat, candidate.lng):
+            found.append((geohash.distance(lat, lng, candidate.lat, candidate.lng), candidate.place_id, candidate))
+    found.sort(key=lambda item: item[:2])
+
+    start = bisect.bisect_right([item[:2] for item in found], after) if after else 0
+    page = found[start:start + limit]
+    places = _get_places(area_name, [candidate for _, _, candidate in page])
+    next_cursor = _encode_cursor(*page[-1][:2]) if start + limit < len(found) else None
+    # a place is None if it was removed since its candidates were cached
+    return QueryPage(places=[FoundPlace(place_id=place_id, distance=distance, place=place)
+                             for (distance, place_id, _), place in zip(page, places) if place is not None],
+                     next_cursor=next_cursor)
+
+
+class _Radius:
+    def __init__(self, radius):
+        self.radius = radius
+
+    def contains(self, lat, lng, place_lat, place_lng):
+        return geohash.distance(lat, lng, place_lat, place_lng) <= self.radius
+
+    def expanded(self, height, width):
+        """
+        :return: a shape which contains this shape, centred anywhere in a cell of @height x @width metres
+        """
+        return _Radius((self.radius + (height ** 2 + width ** 2) ** 0.5 / 2) * _MARGIN_RATIO + _MARGIN_METRES)
+
+    def bbox(self, lat, lng):
+        return geohash.circle_bbox(lat, lng, self.radius)
+
+    def geosearch_kwargs(self):
+        return {"radius": self.radius}
+
+    def __str__(self):
+        return "r%s" % self.radius
+
+
+class _Box:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def contains(self, lat, lng, place_lat, place_lng):
+        lat_delta = abs(place_lat - lat) * geohash.METRES_PER_DEGREE
+        lng_delta = abs(place_lng - lng) * geohash.METRES_PER_DEGREE * cos(radians(lat))
+        return lat_delta <= self.height / 2 and lng_delta <= self.width / 2
+
+    def expanded(self, height, width):
+        return _Box((self.width + width) * _MARGIN_RATIO + _MARGIN_METRES,
+                    (self.height + height) * _MARGIN_RATIO + _MARGIN_METRES)
+
+    def bbox(self, lat, lng):
+        lat_delta = self.height / 2 / geohash.METRES_PER_DEGREE
+        lng_delta = self.width / 2 / (geohash.METRES_PER_DEGREE * cos(radians(lat)))
+        return lat - lat_delta, lat + lat_delta, lng - lng_delta, lng + lng_delta
+
+    def geosearch_kwargs(self):
+        return {"width": self.width, "height": self.height}
+
+    def __str__(self):
+        return "b%sx%s" % (self.width, self.height)
+
+
+def _get_candidates(area_name, lat, lng, shape, place_type) -> List[_Candidate]:
+    """
+    :return: the candidates of the query - a superset of its places. cached, if the cache is enabled
+    """
+    cell = geohash.encode(lat, lng, Config.QUERY_CACHE_PRECISION)
+    cache_key = None
+    if Config.QUERY_CACHE_TTL > 0:
+        generation = get_read_client().get(cities_generation_template_key + area_name) or 0
+        cache_key = "%s%s:%s:%s:%s:%s" % (cities_query_cache_template_key, area_name, generation, cell, shape,
+                                          place_type or "")
+        cached = get_read_client().get(cache_key)
+        if cached is not None:
+            return [_Candidate(*candidate) for candidate in deserialize(cached)]
+
+    candidates = _search_candidates(area_name, cell, shape, place_type)
+    if cache_key is not None and len(candidates) <= Config.QUERY_CACHE_MAX_CANDIDATES:
+        # replicas are read-only
+        get_client().set(cache_key, serialize([list(candidate) for candidate in candidates]),
+                         ex=Config.QUERY_CACHE_TTL)
+    return candidates
+
+
+def _search_candidates(area_name, cell, shape, place_type) -> List[_Candidate]:
+    """
+    :return: the places within @shape, expanded so that it contains @shape centred anywhere in @cell
+    """
+    lat_min, lat_max, lng_min, lng_max = geohash.bbox(cell)
+    lat, lng = (lat_min + lat_max) / 2, (lng_min + lng_max) / 2
+    search_shape = shape.expanded(height=(lat_max - lat_min) * geohash.METRES_PER_DEGREE,
+                                  width=(lng_max - lng_min) * geohash.METRES_PER_DEGREE * cos(radians(lat)))
+
+    template_key = type_template_key(place_type) if place_type else cities_coordinates_template_key
+    shards = RedisFacade.get_shards(area_name)
+    if shards:
+        # only the shards whose cells intersect the searched area
+        precision = len(next(iter(shards)))
+        searched_shards = sorted(geohash.cover(*search_shape.bbox(lat, lng), precision=precision) & shards)
+    else:
+        searched_shards = [None]
+
+    pipe = get_read_client().pipeline(transaction=False)
+    for shard in searched_shards:
+        pipe.geosearch(area_key(template_key, area_name, shard), longitude=lng, latitude=lat, unit='m',
+                       withcoord=True, **search_shape.geosearch_kwargs())
+    found = pipe.execute()
+
+    pipe = get_read_client().pipeline(transaction=False)
+    for shard, shard_found in zip(searched_shards, found):
+        if shard_found:
+            pipe.zmscore(area_key(cities_ratings_template_key, area_name, shard),
+                         [place_id for place_id, _ in shard_found])
+    ratings = iter(pipe.execute())
+
+    candidates = []
+    for shard, shard_found in zip(searched_shards, found):
+        if shard_found:
+            for (place_id, (place_lng, place_lat)), rating in zip(shard_found, next(ratings)):
+                candidates.append(_Candidate(place_id=place_id, lat=place_lat, lng=place_lng, rating=rating,
+                                             shard=shard))
+    log.debug("%i candidates for a query in %s, cell %s", len(candidates), area_name, cell)
+    return candidates
+
+
+def _get_places(area_name, candidates: List[_Candidate]) -> List[Optional[dict]]:
+    """
+    :return: the places of the candidates, in the same order. None for a place which doesn't exist anymore
+    """
+    pipe = get_read_client().pipeline(transaction=False)
+    for candidate in candidates:
+        pipe.hget(area_key(cities_places_template_key, area_name, candidate.shard), candidate.place_id)
+    return [deserialize(raw) if raw is not None else None for raw in pipe.execute()] if candidates else []
+
+
+def _encode_cursor(distance, place_id) -> str:
+    # repr - the distance must be exactly the same when decoded, to compare it with the distances of the next page
+    return "%r:%s" % (distance, place_id)
+
+
+def _decode_cursor(cursor: str):
+    try:
+        distance, place_id = cursor.split(":", 1)
+        return float(distance), place_id
+    except ValueError:
+        raise ValueError("Invalid cursor %s" % cursor)
@@ -1,23 +1,59 @@
 """
 redis-py docs https://github.com/andymccurdy/redis-py
+
+Works with a standalone Redis node or a Redis Cluster (see load_data/config.py). In a cluster:
+* the pipelines are not transactions, since a transaction can't span multiple slots
+* keys which can't be renamed in place (the temp and official keys are in different slots) are moved with DUMP+RESTORE.
+That's slow for big keys - use the sharded layout, whose keys are hash-tagged to stay in the same slot.
+* RENAME can't be pipelined (redis-py blocks it in a cluster pipeline), so the keys are renamed one by one, once the
+old keys are deleted
 """
-import json
 import logging as log
 from typing import Dict
 
-from redis import StrictRedis
+from redis.crc import key_slot
 
 from load_data.config import Config
-# instance of the redis client
+from load_data.datastore_adapter import scripts
+from load_data.datastore_adapter.connection import LazyClient, get_client, get_read_client, same_slot
 from load_data.deka_types import Metadata, LatLng
+from shared_utils import codec, geohash, profiling
 
-r = StrictRedis(host=Config.REDIS_HOST, port=Config.REDIST_PORT, db=Config.REDIS_DB, decode_responses=True)
+# the redis client for writes. it's created on first use
+r = LazyClient(get_client)
 
 cities_boundaries_template_key = "cities:boundaries:"
 # e.g. cities:places:london
 cities_places_template_key = "cities:places:"
 # e.g. cities:coordinates:london
 cities_coordinates_template_key = "cities:coordinates:"
+# e.g. cities:shards:london. a set with the geohash prefixes of the shards of the area (only for sharded areas)
+cities_shards_template_key = "cities:shards:"
+# e.g. cities:generation:london. incremented each time the area is promoted, so that cached queries are invalidated
+cities_generation_template_key = "cities:generation:"
+# e.g. cities:query_cache:london:3:sx8dcb7:r500:cafe. the cached candidates of a query (see query.py)
+cities_query_cache_template_key = "cities:query_cache:"
+
+# the indexes below are derived from the places, to answer typed/sorted queries without fetching all places
+# e.g. cities:types:bar:london. a geo set, like the coordinates, with only the places of the type
+cities_types_template_key = "cities:types:%s:"
+# e.g. cities:ratings:london. a sorted set of place_ids, the score is the rating of the place
+cities_ratings_template_key = "cities:ratings:"
+# e.g. cities:popularity:london. a sorted set of place_ids, the score is the user_ratings_total of the place
+cities_popularity_template_key = "cities:popularity:"
+
+
+def type_template_key(place_type):
+    return cities_types_template_key % place_type
+
+
+def sharded_templates():
+    """
+    :return: the templates of the keys which hold data of the places. they are split in shards,
+    when the sharded layout is used
+    """
+    return [cities_places_template_key, cities_coordinates_template_key, cities_ratings_template_key,
+            cities_popularity_template_key] + [type_template_key(place_type) for place_type in Config.PLACES_TYPES]
 
 
 class KeyConverter:
@@ -31,11 +67,54 @@ class KeyConverter:
     def from_temp(cls, k):
         return k.split(cls.temp_stage_suffix)[0]
 
+    @classmethod
+    def is_temp(cls, k):
+        return k.endswith(cls.temp_stage_suffix)
+
     @classmethod
     def get_area_name(cls, key):
-        # "cities:places:london"
+        # "cities:places:london" or a shard key - "cities:places:{london:u10j}"
+        if "{" in key:
+            return key[key.index("{") + 1:].split(":")[0]
         return key.split(":")[-1]
 
+    @classmethod
+    def to_shard(cls, template_key, area_name, shard):
+        """
+        e.g. ("cities:places:", "london", "gcpv") -> "cities:places:{london:gcpv}"
+        The {...} is a hash tag - Redis Cluster uses only it to determine the slot of the key. Thus the keys of
+        a shard are in the same slot, and different shards are spread across the cluster.
+        The temp suffix is kept out of the hash tag, so that a temp shard key is in the same slot as the official one.
+
+        :param area_name: official or temp area name
+        """
+        key = "%s{%s:%s}" % (template_key, cls.from_temp(area_name), shard)
+        return cls.to_temp(key) if cls.is_temp(area_name) else key
+
+
+def area_key(template_key, area_name, shard=None):
+    """
+    :return: the key of the area, or of one of its shards
+    """
+    if shard is None:
+        return template_key + area_name
+    return KeyConverter.to_shard(template_key, area_name, shard)
+
+
+def shard_of_place(place, precision) -> str:
+    lat_lng = extract_latlng_of_place(place)
+    return geohash.encode(lat_lng.lat, lat_lng.lng, precision)
+
+
+def split_to_shards(places: Dict, precision) -> Dict[str, Dict]:
+    """
+    :return: shard -> {place_id: place} of the places in the shard
+    """
+    shards = {}
+    for place_id, place in places.items():
+        shards.setdefault(shard_of_place(place, precision), {})[place_id] = place
+    return shards
+
 
 def load_to_datastore(places: Dict, metadata: Metadata):
     """
@@ -48,15 +127,50 @@ def load_to_datastore(places: Dict, metadata: Metadata):
 
     log.info("Begin the process of loading the new data.")
     # add all data to temporary keys
-    load_to_temporary(places, metadata)
+    with profiling.span("load_to_temporary"):
+        if Config.REDIS_ASYNC_LOAD:
+            import asyncio
+            from load_data.datastore_adapter.async_loader import load_to_temporary_async
+
+            asyncio.run(load_to_temporary_async(places, metadata))
+        else:
+            load_to_temporary(places, metadata)
 
     log.info("Begin promoting the new data.")
     # delete the old data and promote the stand-by data to official
-    promote_temp_to_official(metadata.area_name)
+    with profiling.span("promote"):
+        promote_temp_to_official(metadata.area_name)
     log.info("%i places were successfully promoted & available for the [%s] area"
              % (len(places), metadata.area_name))
 
 
+def temp_stage_keys(area_name, shards, old_shards):
+    """
+    :param shards: the shards about to be loaded
+    :param old_shards: the shards of the temp stage as it is now, e.g. left by a failed load
+    :return: all keys of the temp stage of the area, for both layouts
+    """
+    temp_name = KeyConverter.to_temp(area_name)
+    keys = [cities_boundaries_template_key + temp_name, cities_shards_template_key + temp_name]
+    for shard in [None] + sorted(set(shards) | set(old_shards)):
+        keys += [area_key(template_key, temp_name, shard) for template_key in sharded_templates()]
+    return keys
+
+
+def delete_temp_stage(area_name, shards=()):
+    """
+    Delete the temp keys of the area before loading it. The leftovers of a failed load would be promoted together
+    with the new data otherwise.
+    :param shards: the shards about to be loaded
+    """
+    old_shards = RedisFacade.get_shards(KeyConverter.to_temp(area_name), client=r)
+    pipe = r.pipeline(transaction=False)
+    # one by one, since in a cluster they are in different slots
+    for key in temp_stage_keys(area_name, shards, old_shards):
+        pipe.delete(key)
+    pipe.execute()
+
+
 def load_to_temporary(places, metadata):
     """
     load all of the data to temporary keys.
@@ -68,13 +182,22 @@ def load_to_temporary(places, metadata):
     boundaries_rectangle = metadata.bounding_rectangle
     area_name = metadata.area_name
     temp_area_name = KeyConverter.to_temp(area_name)
-    transaction = r.pipeline()
+    transaction = _pipeline()
 
     RedisFacade.add_boundaries(area_name=temp_area_name,
                                boundaries_rectangle=boundaries_rectangle,
                                pipe=transaction)
-    RedisFacade.add_places(area_name=temp_area_name, places=places, pipe=transaction)
-    RedisFacade.add_coordinates(area_name=temp_area_name, places=places, pipe=transaction)
+    if Config.SHARD_GEOHASH_PRECISION:
+        shards = split_to_shards(places, Config.SHARD_GEOHASH_PRECISION)
+        RedisFacade.add_shards(area_name=temp_area_name, shards=shards.keys(), pipe=transaction)
+        log.info("The places are split in %i shards" % len(shards))
+    else:
+        shards = {None: places}
+    delete_temp_stage(area_name, shards=[shard for shard in shards if shard is not None])
+
+    for shard, shard_places in shards.items():
+        RedisFacade.add_places_with_coordinates(area_name=temp_area_name, places=shard_places, pipe=transaction,
+                                                shard=shard)
     try:
         transaction.execute(raise_on_error=True)
         log.info("Added new data in a temporary stage [%s]" % area_name)
@@ -85,19 +208,46 @@ def load_to_temporary(places, metadata):
 
 def promote_temp_to_official(area_name):
     temp_name = KeyConverter.to_temp(area_name)
-    transaction = r.pipeline()
-
-    # delete the old keys
-    transaction.delete(
-        cities_boundaries_template_key + area_name,
-        cities_places_template_key + area_name,
-        cities_coordinates_template_key + area_name
-    )
-    # promote the new data to 'official' stage
-
-    templates = [cities_boundaries_template_key, cities_coordinates_template_key, cities_places_template_key]
-    for template_key in templates:
-        transaction.rename(template_key + temp_name, template_key + area_name)
+    # either of the layouts (sharded or not) can be replaced by either of them
+    old_shards = RedisFacade.get_shards(area_name, client=r)
+    new_shards = RedisFacade.get_shards(temp_name, client=r)
+    if Config.REDIS_CLUSTER and not new_shards:
+        log.warning("Promoting an area which is not sharded in a cluster. Its keys are copied across slots.")
+
+    # the old keys to delete
+    old_keys = [cities_boundaries_template_key + area_name, cities_shards_template_key + area_name]
+    old_keys += [area_key(template_key, area_name) for template_key in sharded_templates()]
+    old_keys += [area_key(template_key, area_name, shard) for template_key in sharded_templates() for shard in old_shards]
+
+    # the new data to promote to 'official' stage. (temp key, official key)
+    renames = [(cities_boundaries_template_key + temp_name, cities_boundaries_template_key + area_name)]
+    if new_shards:
+        renames.append((cities_shards_template_key + temp_name, cities_shards_template_key + area_name))
+    for shard in new_shards or [None]:
+        for template_key in sharded_templates():
+            renames.append((area_key(template_key, temp_name, shard), area_key(template_key, area_name, shard)))
+
+    transaction = _pipeline()
+    if Config.REDIS_USE_SCRIPTS:
+        _promote_with_script(transaction, old_keys, renames)
+    else:
+        # e.g. the index of a type without places doesn't exist and can't be renamed
+        exists = r.pipeline(transaction=False)
+        for source, destination in renames:
+            exists.exists(source)
+        renames = [rename for rename, rename_exists in zip(renames, exists.execute()) if rename_exists]
+
+        # one by one, since in a cluster they are in different slots
+        for key in old_keys:
+            transaction.delete(key)
+        if Config.REDIS_CLUSTER:
+            # the keys are renamed right away (see _rename), so the old ones must be deleted first
+            transaction.execute(raise_on_error=True)
+            transaction = _pipeline()
+        for source, destination in renames:
+            _rename(transaction, source, destination)
+    # the cached queries of the old data aren't used anymore
+    transaction.incr(cities_generation_template_key + area_name)
 
     try:
         transaction.execute(raise_on_error=True)
@@ -106,12 +256,61 @@ def promote_temp_to_official(area_name):
         raise
 
 
+def _promote_with_script(pipe, delete_keys, renames):
+    """
+    A single call of the promote script for a standalone redis.
+    In a cluster - a call for each slot (e.g. for each shard), since all keys of a script must be in the same slot.
+    The keys which must be moved across slots are moved with DUMP+RESTORE.
+    """
+    # slot -> ([keys to delete], [renames])
+    by_slot = {}
+    cross_slot_renames = []
+    for key in delete_keys:
+        by_slot.setdefault(_slot(key), ([], []))[0].append(key)
+    for source, destination in renames:
+        if not Config.REDIS_CLUSTER or same_slot(source, destination):
+            by_slot.setdefault(_slot(source), ([], []))[1].append((source, destination))
+        else:
+            cross_slot_renames.append((source, destination))
+
+    for slot_delete_keys, slot_renames in by_slot.values():
+        scripts.promote(delete_keys=slot_delete_keys, renames=slot_renames, pipe=pipe)
+    # after the old keys are deleted
+    for source, destination in cross_slot_renames:
+        _rename(pipe, source, destination)
+
+
+def _slot(key):
+    return key_slot(key.encode("utf-8")) if Config.REDIS_CLUSTER else 0
+
+
+def _pipeline():
+    # a cluster can't run a transaction across slots
+    return r.pipeline(transaction=not Config.REDIS_CLUSTER)
+
+
+def _rename(pipe, source, destination):
+    if not Config.REDIS_CLUSTER:
+        pipe.rename(source, destination)
+    elif same_slot(source, destination):
+        # a cluster pipeline can't RENAME
+        r.rename(source, destination)
+    else:
+        # RENAME can't move a key to another slot
+        dumped = r.dump(source)
+        if dumped is not None:
+            pipe.restore(destination, 0, dumped, replace=True)
+            pipe.delete(source)
+
+
 def deserialize(serialized):
-    return json.loads(serialized)
+    return codec.loads(serialized)
 
 
 def serialize(raw):
-    return json.dumps(raw)
+    # a place read from an indexed file (see IndexedPlace) already has its json
+    payload = getattr(raw, 'payload', None)
+    return payload if payload is not None else codec.dumps(raw)
 
 
 def extract_latlng_of_place(place) -> LatLng:
@@ -119,6 +318,33 @@ def extract_latlng_of_place(place) -> LatLng:
     return LatLng(lat=loc['lat'], lng=loc['lng'])
 
 
+def indexed_types_of_place(place):
+    return [place_type for place_type in place.get('types', ()) if place_type in Config.PLACES_TYPES]
+
+
+def pack_records(places: Dict, records_per_chunk):
+    """
+    Yields the places as chunks of records for the ingest script - flat lists with
+    place_id, lng, lat, <serialized place>, <type indexes>, rating, user_ratings_total, place_id, lng, lat, ...
+    The type indexes are the indexes in Config.PLACES_TYPES of the types of the place.
+    """
+    type_indexes = {place_type: str(i) for i, place_type in enumerate(Config.PLACES_TYPES)}
+    chunk = []
+    for place_id, place in places.items():
+        location = place['geometry']['location']
+        rating = place.get('rating')
+        ratings_total = place.get('user_ratings_total')
+        chunk += (place_id, location['lng'], location['lat'], serialize(place),
+                  " ".join(type_indexes[place_type] for place_type in indexed_types_of_place(place)),
+                  "" if rating is None else rating,
+                  "" if ratings_total is None else ratings_total)
+        if len(chunk) >= records_per_chunk * scripts.INGEST_RECORD_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 class RedisFacade:
     def __init__(self):
         pass
@@ -135,39 +361,162 @@ class RedisFacade:
         return pipe.set(cities_boundaries_template_key + area_name, serialize(boundaries_rectangle))
 
     @classmethod
-    def add_places(cls, area_name, places: Dict, pipe):
+    def add_shards(cls, area_name, shards, pipe):
+        """
+        :param shards: the geohash prefixes of the shards of the area
+        """
+        if not shards:
+            # an area without places. SADD needs at least one member
+            return pipe
+        return pipe.sadd(cities_shards_template_key + area_name, *shards)
+
+    @classmethod
+    def add_places(cls, area_name, places: Dict, pipe, shard=None):
         """
         Add the places to our datastore. Places is a dict with key=<a place_id> and value a place object,
         as returned by the Google Places API
         :param area_name: e.g. london
         :param places: dict with place_id-> place pairs
         :param pipe:
+        :param shard: the geohash prefix of the shard, if the places are stored in the sharded layout
         :return:
         """
+        key = area_key(cities_places_template_key, area_name, shard)
         for place_id, place in places.items():
-            pipe.hset(cities_places_template_key + area_name, place_id, serialize(place))
+            pipe.hset(key, place_id, serialize(place))
         return pipe
 
     @classmethod
-    def add_coordinates(cls, area_name, places: Dict, pipe):
+    def add_coordinates(cls, area_name, places: Dict, pipe, shard=None):
         """
         Add the coordinates of each place to a geo-optimized key (in a data structure provided by redis).
         We add [longitute, latutude, "<place_id>"] for each place
         :param area_name:
         :param places:
         :param pipe:
+        :param shard: same as in add_places
         :return:
         """
+        key = area_key(cities_coordinates_template_key, area_name, shard)
         for place_id, place in places.items():
             lat_lng = extract_latlng_of_place(place)
 
-            pipe.geoadd(cities_coordinates_template_key + area_name, lat_lng.lng, lat_lng.lat, place_id)
+            pipe.geoadd(key, [lat_lng.lng, lat_lng.lat, place_id])
+        return pipe
+
+    @classmethod
+    def add_indexes(cls, area_name, places: Dict, pipe, shard=None):
+        """
+        Add the places to the indexes derived from them - a geo set for each type and sorted sets by rating
+        and by user_ratings_total.
+        :param shard: same as in add_places
+        """
+        ratings = {}
+        popularity = {}
+        by_type = {}
+        for place_id, place in places.items():
+            if place.get('rating') is not None:
+                ratings[place_id] = place['rating']
+            if place.get('user_ratings_total') is not None:
+                popularity[place_id] = place['user_ratings_total']
+            types = indexed_types_of_place(place)
+            if types:
+                lat_lng = extract_latlng_of_place(place)
+                for place_type in types:
+                    by_type.setdefault(place_type, []).extend([lat_lng.lng, lat_lng.lat, place_id])
+
+        if ratings:
+            pipe.zadd(area_key(cities_ratings_template_key, area_name, shard), ratings)
+        if popularity:
+            pipe.zadd(area_key(cities_popularity_template_key, area_name, shard), popularity)
+        for place_type, values in by_type.items():
+            pipe.geoadd(area_key(type_template_key(place_type), area_name, shard), values)
+        return pipe
+
+    @classmethod
+    def add_places_with_coordinates(cls, area_name, places: Dict, pipe, shard=None):
+        """
+        Same as add_places + add_coordinates + add_indexes. If possible, the places are sent in chunks to the ingest
+        script (see scripts.py), which adds a whole chunk with a single call.
+        """
+        keys = [area_key(template_key, area_name, shard) for template_key in sharded_templates()]
+        if not Config.REDIS_USE_SCRIPTS or (Config.REDIS_CLUSTER and not same_slot(*keys)):
+            cls.add_places(area_name=area_name, places=places, pipe=pipe, shard=shard)
+            cls.add_coordinates(area_name=area_name, places=places, pipe=pipe, shard=shard)
+            cls.add_indexes(area_name=area_name, places=places, pipe=pipe, shard=shard)
+            return pipe
+
+        records_per_chunk = min(Config.LOAD_CHUNK_SIZE, scripts.MAX_RECORDS_PER_CHUNK)
+        for records in pack_records(places, records_per_chunk):
+            scripts.ingest(keys=keys, records=records, pipe=pipe)
         return pipe
 
     @classmethod
-    def get_place_data(cls, area_name, place_key):
-        raw = r.hget(cities_places_template_key + area_name, place_key)
-        return deserialize(raw)
+    def get_shards(cls, area_name, client=None):
+        """
+        :param client: the client to use. by default, the read client.
+        :return: the geohash prefixes of the shards of the area. empty if the area is not sharded.
+        """
+        return (client or get_read_client()).smembers(cities_shards_template_key + area_name)
+
+    @classmethod
+    def get_place_data(cls, area_name, place_key, lat_lng: LatLng = None):
+        """
+        :param lat_lng: optional. the location of the place. for sharded areas it's used to find the shard
+        of the place directly, instead of looking it up in all shards.
+        """
+        shards = cls.get_shards(area_name)
+        if not shards:
+            raw = get_read_client().hget(cities_places_template_key + area_name, place_key)
+        elif lat_lng is not None:
+            precision = len(next(iter(shards)))
+            shard = geohash.encode(lat_lng.lat, lat_lng.lng, precision)
+            raw = get_read_client().hget(area_key(cities_places_template_key, area_name, shard), place_key)
+        else:
+            pipe = get_read_client().pipeline(transaction=False)
+            for shard in shards:
+                pipe.hget(area_key(cities_places_template_key, area_name, shard), place_key)
+            raw = next((found for found in pipe.execute() if found is not None), None)
+        return deserialize(raw) if raw is not None else None
+
+    @classmethod
+    def get_place_ids_within_radius(cls, area_name, lat, lng, radius, place_type=None):
+        """
+        :param radius: in metres
+        :param place_type: optional. one of Config.PLACES_TYPES - only places of this type are returned.
+        :return: the ids of the places within the circle, sorted by distance from its centre
+        """
+        template_key = type_template_key(place_type) if place_type else cities_coordinates_template_key
+        shards = cls.get_shards(area_name)
+        if not shards:
+            keys = [template_key + area_name]
+        else:
+            # only the shards whose cells intersect the circle
+            precision = len(next(iter(shards)))
+            cells = geohash.cover(*geohash.circle_bbox(lat, lng, radius), precision=precision)
+            keys = [area_key(template_key, area_name, shard) for shard in cells & shards]
+
+        pipe = get_read_client().pipeline(transaction=False)
+        for key in keys:
+            pipe.geosearch(key, longitude=lng, latitude=lat, radius=radius, unit='m', withdist=True)
+        found = [item for shard_result in pipe.execute() for item in shard_result]
+        return [place_id for place_id, distance in sorted(found, key=lambda item: item[1])]
+
+    @classmethod
+    def iter_places(cls, area_name, count=1000):
+        """
+        Iterates over the places of the area with HSCAN - @count places per round-trip, without holding them all.
+        Note that HSCAN might return a place more than once.
+        :return: generator of (place_id, serialized place)
+        """
+        shards = cls.get_shards(area_name)
+        if shards:
+            keys = [area_key(cities_places_template_key, area_name, shard) for shard in sorted(shards)]
+        else:
+            keys = [cities_places_template_key + area_name]
+        client = get_read_client()
+        for key in keys:
+            yield from client.hscan_iter(key, count=count)
 
     @classmethod
     def get_all_places_for_area(cls, area_name):
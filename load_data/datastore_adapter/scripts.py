@@ -0,0 +1,118 @@
+"""
+Lua scripts, executed by Redis (EVALSHA - the scripts are sent once, then called by their sha1).
+https://redis.io/commands/eval
+
+INGEST - adds a chunk of places in a single call, instead of a HSET and a GEOADD per place (and a ZADD/GEOADD
+per index). The client sends a flat list of records of INGEST_RECORD_SIZE values:
+place_id, lng, lat, payload, type indexes, rating, user_ratings_total
+where the type indexes are space-separated indexes of the type keys (in KEYS) the place should be added to,
+and rating/user_ratings_total are empty strings if the place doesn't have them.
+
+PROMOTE - deletes the old keys of an area and renames the temp keys to official ones, atomically.
+A temp key which doesn't exist (e.g. an area without places) only deletes the official one.
+
+All keys of a script call must be in the same slot of a Redis Cluster. The caller takes care of that.
+A cluster pipeline can't call scripts (redis-py blocks EVALSHA in it), so in a cluster the scripts are called right
+away, outside the pipeline, on the node of the slot of their keys. The first call on a node which doesn't have the
+script yet loads it on all primaries (SCRIPT LOAD) and calls it again.
+"""
+from load_data.config import Config
+from load_data.datastore_adapter.connection import get_client
+
+INGEST_RECORD_SIZE = 7
+
+# Lua's unpack() is limited by the size of the C stack (~8000 values). A record is 3 values in GEOADD.
+MAX_RECORDS_PER_CHUNK = 2000
+
+# KEYS - places, coordinates, ratings, popularity, then a key for each type
+INGEST = """
+local places, coordinates, ratings, popularity = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local hash_args, geo_args, rating_args, popularity_args, type_args = {}, {}, {}, {}, {}
+for i = 1, #ARGV, 7 do
+    local place_id, lng, lat = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    hash_args[#hash_args + 1] = place_id
+    hash_args[#hash_args + 1] = ARGV[i + 3]
+    geo_args[#geo_args + 1] = lng
+    geo_args[#geo_args + 1] = lat
+    geo_args[#geo_args + 1] = place_id
+    for type_index in string.gmatch(ARGV[i + 4], '%d+') do
+        local key = KEYS[5 + tonumber(type_index)]
+        local args = type_args[key] or {}
+        args[#args + 1] = lng
+        args[#args + 1] = lat
+        args[#args + 1] = place_id
+        type_args[key] = args
+    end
+    if ARGV[i + 5] ~= '' then
+        rating_args[#rating_args + 1] = ARGV[i + 5]
+        rating_args[#rating_args + 1] = place_id
+    end
+    if ARGV[i + 6] ~= '' then
+        popularity_args[#popularity_args + 1] = ARGV[i + 6]
+        popularity_args[#popularity_args + 1] = place_id
+    end
+end
+if #hash_args > 0 then
+    redis.call('HSET', places, unpack(hash_args))
+    redis.call('GEOADD', coordinates, unpack(geo_args))
+end
+if #rating_args > 0 then
+    redis.call('ZADD', ratings, unpack(rating_args))
+end
+if #popularity_args > 0 then
+    redis.call('ZADD', popularity, unpack(popularity_args))
+end
+for key, args in pairs(type_args) do
+    redis.call('GEOADD', key, unpack(args))
+end
+return #ARGV / 7
+"""
+
+PROMOTE = """
+local deleted = tonumber(ARGV[1])
+for i = 1, deleted do
+    redis.call('DEL', KEYS[i])
+end
+for i = deleted + 1, #KEYS, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('RENAME', KEYS[i], KEYS[i + 1])
+    else
+        redis.call('DEL', KEYS[i + 1])
+    end
+end
+return (#KEYS - deleted) / 2
+"""
+
+_registered = {}
+
+
+def _script(source):
+    if source not in _registered:
+        _registered[source] = get_client().register_script(source)
+    return _registered[source]
+
+
+def _call(source, keys, args, pipe):
+    """
+    :return: the result of the script in a cluster. otherwise the call is queued in @pipe, which is returned
+    """
+    if Config.REDIS_CLUSTER:
+        return _script(source)(keys=keys, args=args, client=get_client())
+    return _script(source)(keys=keys, args=args, client=pipe)
+
+
+def ingest(keys, records, pipe):
+    """
+    :param keys: places, coordinates, ratings, popularity and the type keys
+    :param records: flat list of records (see the top of the module). at most MAX_RECORDS_PER_CHUNK records
+    """
+    return _call(INGEST, keys=keys, args=records, pipe=pipe)
+
+
+def promote(delete_keys, renames, pipe):
+    """
+    :param delete_keys: the keys to delete
+    :param renames: list of (temp key, official key)
+    """
+    keys = list(delete_keys) + [key for rename in renames for key in rename]
+    return _call(PROMOTE, keys=keys, args=[len(delete_keys)], pipe=pipe)
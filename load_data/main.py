@@ -2,25 +2,45 @@ import argparse
 import logging as log
 from typing import Tuple, Dict
 
-from load_data.datastore_adapter import load_to_datastore
 from load_data.deka_types import Metadata
-from shared_utils.file_utils import readJSONFileAndConvertToDict
+from shared_utils import profiling
+from shared_utils.file_utils import read_places_file, get_directory_of_file
+from shared_utils.log import init_logger
 
 
 def main():
-    places, metadata = read_input()
+    args = parse_args()
+    if args.profile:
+        profiling.enable(args.profile)
+    with profiling.process_profile("load_data"):
+        load(args)
+    if args.profile:
+        profiling.merge_profiles()
+
+
+def load(args):
+    # imported here - redis is slow to import
+    from load_data.datastore_adapter import load_to_datastore
+
+    with profiling.span("read_input"):
+        places, metadata = read_input(args)
     log.info("Loaded input file with %i places." % len(places))
     log.info("area-name = %s" % metadata.area_name)
  
     load_to_datastore(places, metadata=metadata)
 
 
-def read_input():
+def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--file', help="specify path to a local file")
+    parser.add_argument('--file', help="specify path to a local file - json or indexed (see get_places --format)")
+    parser.add_argument('--profile', help="profile the run and save the profiles to this directory. "
+                                          "see shared_utils/profiling.py")
+    return parser.parse_args()
+
 
-    args = parser.parse_args()
-    return parse_raw_input(readJSONFileAndConvertToDict(filepath=args.file))
+def read_input(args):
+    # the places of an indexed file are stored in redis with the json from the file, as is
+    return parse_raw_input(read_places_file(args.file, keep_payloads=True))
 
 
 def parse_raw_input(raw_input) -> Tuple[Dict, Metadata]:
@@ -34,4 +54,5 @@ def parse_raw_input(raw_input) -> Tuple[Dict, Metadata]:
 
 
 if __name__ == "__main__":
+    init_logger(get_directory_of_file(__file__))
     main()
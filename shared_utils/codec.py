@@ -0,0 +1,93 @@
+"""
+JSON encoding/decoding for the files we read/write and for the places we store in Redis.
+
+Uses the fastest available library - orjson, then ujson, then the stdlib json.
+Set DEKA_JSON_CODEC to "orjson", "ujson" or "json" to choose one explicitly.
+ujson is used only from version 5, which added the `default` argument.
+
+The output is always bytes (utf-8) - orjson produces bytes directly, without an intermediate str.
+"""
+import json
+import os
+from importlib import import_module
+
+_PREFERENCE = ["orjson", "ujson", "json"]
+
+# the min major version of each library. older ones don't support all the arguments we use
+_MIN_VERSIONS = {"ujson": 5}
+
+
+def _import_backend(name):
+    module = import_module(name)
+    min_version = _MIN_VERSIONS.get(name)
+    if min_version is not None and int(module.__version__.split(".")[0]) < min_version:
+        raise ImportError("%s %s is too old, at least %i is needed" % (name, module.__version__, min_version))
+    return module
+
+
+def _select_backend():
+    forced = os.environ.get("DEKA_JSON_CODEC")
+    for name in [forced] if forced else _PREFERENCE:
+        try:
+            return name, _import_backend(name)
+        except ImportError:
+            if forced:
+                raise
+    raise ImportError("No json library available")
+
+
+# the name of the library in use
+NAME, _backend = _select_backend()
+
+# the stdlib json writes in chunks of this size when streaming
+_STREAM_BUFFER_SIZE = 1 << 16
+
+
+def dumps(obj, default=None) -> bytes:
+    """
+    :param default: called for objects which can't be serialized otherwise (see json.dumps)
+    """
+    if NAME == "orjson":
+        return _backend.dumps(obj, default=default)
+    if NAME == "ujson":
+        return _backend.dumps(obj, ensure_ascii=False, default=default).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=default).encode("utf-8")
+
+
+def loads(data):
+    """
+    :param data: bytes, str or memoryview (e.g. a slice of a memory-mapped file)
+    """
+    if isinstance(data, memoryview) and NAME != "orjson":
+        # only orjson reads from a memoryview directly
+        data = data.tobytes()
+    return _backend.loads(data)
+
+
+def dump(obj, fp, default=None):
+    """
+    :param fp: a file opened in binary mode
+    """
+    if NAME != "json":
+        fp.write(dumps(obj, default=default))
+        return
+
+    # stream the chunks of the encoder, so that the whole document is never held as a single str
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+    buffer = []
+    buffered = 0
+    for chunk in encoder.iterencode(obj):
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= _STREAM_BUFFER_SIZE:
+            fp.write("".join(buffer).encode("utf-8"))
+            buffer = []
+            buffered = 0
+    fp.write("".join(buffer).encode("utf-8"))
+
+
+def load(fp):
+    """
+    :param fp: a file opened in binary mode
+    """
+    return loads(fp.read())
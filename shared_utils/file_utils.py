@@ -1,22 +1,87 @@
-import json
 import os
 from os import path, makedirs
 
+from shared_utils import codec
+from shared_utils.places_index import PlacesIndex, is_places_index
+
 
 def get_directory_of_file(file):
     return os.path.dirname(os.path.realpath(file))
 
 
 def readJSONFileAndConvertToDict(filepath):
-    return json.load(open(filepath))
+    with open(filepath, 'rb') as file:
+        return codec.load(file)
+
+
+def read_places_file(file_path, keep_payloads=False):
+    """
+    :param keep_payloads: for an indexed file - keep the json of each place (see IndexedPlace), so that it can be
+    stored without encoding the place again
+    :return: the content of an output file of get_places (json or indexed), in the json format -
+    {"metadata": ..., "places": ...}
+    """
+    if is_places_index(file_path):
+        with PlacesIndex(file_path) as index:
+            return {'metadata': index.metadata, 'places': dict(index.items(keep_payloads=keep_payloads))}
+    return readJSONFileAndConvertToDict(filepath=file_path)
 
 
-def save_dict_to_file(data, file_path):
+def save_dict_to_file(data, file_path, default=None):
+    """
+    :param default: called for objects which can't be serialized otherwise. see codec.dump
+    """
     abs_file_path = path.abspath(file_path)
     touch_directory(path.dirname(abs_file_path))
 
-    with(open(abs_file_path, 'w')) as file:
-        file.write(json.dumps(data))
+    with(open(abs_file_path, 'wb')) as file:
+        codec.dump(data, file, default=default)
+
+
+class PlacesFileWriter:
+    """
+    Writes a json output file of get_places ({"metadata": ..., "places": ...}) as the places arrive, so that they
+    don't have to be all in memory. A place whose place_id was already added is skipped.
+
+    Use as a context manager, or call close().
+    """
+
+    def __init__(self, file_path, metadata, default=None):
+        """
+        :param default: called for objects which can't be serialized otherwise. see codec.dumps
+        """
+        abs_file_path = path.abspath(file_path)
+        touch_directory(path.dirname(abs_file_path))
+        self._default = default
+        self._place_ids = set()
+        self._file = open(abs_file_path, 'wb')
+        self._file.write(b'{"metadata":' + codec.dumps(metadata) + b',"places":{')
+
+    def add(self, places):
+        """
+        :param places: place_id -> place
+        """
+        for place_id, place in places.items():
+            if place_id in self._place_ids:
+                continue
+            if self._place_ids:
+                self._file.write(b',')
+            self._place_ids.add(place_id)
+            self._file.write(codec.dumps(place_id) + b':' + codec.dumps(place, default=self._default))
+
+    def __len__(self):
+        return len(self._place_ids)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.write(b'}}')
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 def touch_directory(dir_path):
@@ -0,0 +1,127 @@
+"""
+Geohash encoding https://en.wikipedia.org/wiki/Geohash
+
+A geohash is a string, where each character narrows down the cell from the previous character. Places which share
+a geohash prefix are close to each other, which makes it a good key for splitting geographical data in shards.
+"""
+from math import cos, radians
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_BASE32_INDEX = {char: i for i, char in enumerate(_BASE32)}
+
+# roughly, the number of metres in a degree of latitude
+METRES_PER_DEGREE = 111320
+
+
+def encode(lat, lng, precision=12) -> str:
+    """
+    :return: the geohash of the point, with @precision characters
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # even bits encode the longitude
+    while len(chars) < precision:
+        if even:
+            value, value_range = lng, lng_range
+        else:
+            value, value_range = lat, lat_range
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            value_range[0] = mid
+        else:
+            bits <<= 1
+            value_range[1] = mid
+        even = not even
+
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def to_int(geohash: str) -> int:
+    """
+    :return: the bits of the geohash as an integer. ordering the integers (of geohashes with the same precision)
+    is the same as ordering the geohashes.
+    """
+    result = 0
+    for char in geohash:
+        result = (result << 5) | _BASE32_INDEX[char]
+    return result
+
+
+def bbox(geohash: str):
+    """
+    :return: (lat_min, lat_max, lng_min, lng_max) of the cell of the geohash
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        bits = _BASE32_INDEX[char]
+        for shift in range(4, -1, -1):
+            value_range = lng_range if even else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            even = not even
+    return lat_range[0], lat_range[1], lng_range[0], lng_range[1]
+
+
+def cell_size(precision):
+    """
+    :return: (height, width) in degrees of a cell with @precision characters
+    """
+    bits = 5 * precision
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def circle_bbox(lat, lng, radius_m):
+    """
+    :return: (lat_min, lat_max, lng_min, lng_max) of a rectangle surrounding the circle. it's an approximation,
+    good enough away from the poles.
+    """
+    lat_delta = radius_m / METRES_PER_DEGREE
+    lng_delta = radius_m / (METRES_PER_DEGREE * max(cos(radians(lat)), 0.01))
+    return lat - lat_delta, lat + lat_delta, lng - lng_delta, lng + lng_delta
+
+
+def distance(lat_a, lng_a, lat_b, lng_b):
+    """
+    :return: the distance in metres between the two points. an equirectangular approximation, good enough for
+    the short distances (up to a few km) we deal with
+    """
+    lat_delta = (lat_b - lat_a) * METRES_PER_DEGREE
+    lng_delta = (lng_b - lng_a) * METRES_PER_DEGREE * cos(radians((lat_a + lat_b) / 2))
+    return (lat_delta ** 2 + lng_delta ** 2) ** 0.5
+
+
+def cover(lat_min, lat_max, lng_min, lng_max, precision):
+    """
+    :return: the set of geohashes (with @precision characters) of all cells which intersect the rectangle
+    """
+    height, width = cell_size(precision)
+    lats = _steps(max(lat_min, -90.0), min(lat_max, 90.0), height)
+    lngs = _steps(max(lng_min, -180.0), min(lng_max, 180.0), width)
+    return {encode(lat, lng, precision) for lat in lats for lng in lngs}
+
+
+def _steps(start, end, step):
+    # a point in each cell between start and end, including the cell of end
+    points = []
+    current = start
+    while current < end:
+        points.append(current)
+        current += step
+    points.append(end)
+    return points
@@ -1,18 +1,113 @@
+"""
+Logging of the entry points.
+
+The records of all processes (including the worker processes of parallelise, which are forked and inherit this setup)
+are put on a multiprocessing queue - logging a record only costs a put. A single listener, a thread of the main
+process, writes them to the console and to the log file. Thus the I/O doesn't hold up the crawling threads, and
+the lines of different processes don't interleave.
+
+The log file has a json object per line - time, level, process, thread, logger, message and the `extra` fields of
+the record. The console gets the usual human-readable lines.
+
+Pass the arguments of a message to the logging call (log.debug("%s", x)) rather than formatting it in place - the
+message is then formatted only if the record is logged. Very frequent debug records (e.g. one per request) should be
+logged with a sampled_logger().
+"""
+import atexit
+import itertools
 import logging as log
+import os
 from datetime import datetime as dt
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Queue
 from os import environ
+
+from shared_utils import codec
 from shared_utils.file_utils import touch_directory
 
+_CONSOLE_FORMAT = '[%(levelname)s::%(asctime)s] %(message)s'
+
+# the attributes every LogRecord has. the rest are the `extra` fields of the record
+_RECORD_ATTRIBUTES = set(vars(log.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+# the listener of the main process, and the pid of the main process
+_listener = None
+_listener_pid = None
+
+
+class JsonFormatter(log.Formatter):
+    def format(self, record):
+        entry = {
+            "time": dt.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "process": record.processName,
+            "pid": record.process,
+            "thread": record.threadName,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        return codec.dumps(entry, default=str).decode("utf-8")
+
+
+class SamplingFilter(log.Filter):
+    """
+    Lets through one of every @every records below WARNING. Warnings and errors always pass.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(int(every), 1)
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        return record.levelno >= log.WARNING or next(self._counter) % self.every == 0
+
+
+def sampled_logger(name, every=None):
+    """
+    :param every: log one of every @every debug/info records. DEKA_LOG_SAMPLE_EVERY (100) by default
+    :return: a logger which samples its debug and info records
+    """
+    logger = log.getLogger(name)
+    if not any(isinstance(existing, SamplingFilter) for existing in logger.filters):
+        logger.addFilter(SamplingFilter(every or int(environ.get("DEKA_LOG_SAMPLE_EVERY", 100))))
+    return logger
+
 
 def init_logger(output_dir):
+    global _listener, _listener_pid
     log_dir = "%s/%s" % (output_dir, 'log')
     touch_directory(log_dir)
 
-    log.basicConfig(
-        level=getattr(log, environ.get("LOG_LEVEL", "INFO")),
-        format='[%(levelname)s::%(asctime)s] %(message)s',
-        handlers=[
-            log.FileHandler("{0}/{1}.log".format(log_dir, 'deka_minion_%s' % dt.now().isoformat().replace(":", "_"))),
-            log.StreamHandler()
-        ]
-    )
+    file_handler = log.FileHandler(
+        "{0}/{1}.log".format(log_dir, 'deka_minion_%s' % dt.now().isoformat().replace(":", "_")))
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = log.StreamHandler()
+    console_handler.setFormatter(log.Formatter(_CONSOLE_FORMAT))
+
+    queue = Queue(-1)
+    _listener = QueueListener(queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+    atexit.register(stop_logger)
+
+    root = log.getLogger()
+    root.setLevel(getattr(log, environ.get("LOG_LEVEL", "INFO")))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(queue))
+
+
+def stop_logger():
+    """
+    Write the remaining records and stop the listener. Called at exit.
+    """
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,272 @@
+"""
+An indexed file format for a set of places (an alternative to the monolithic json output of get_places).
+The file is memory-mapped when read, so finding a place or iterating over a part of the places doesn't require
+parsing (or even reading) the whole file.
+
+Layout (all integers are little-endian):
+* header - HEADER_FORMAT. the magic, version, number of places and the offsets of the sections below.
+* metadata - the metadata of the area, as json.
+* records - for each place: its place_id (utf-8) immediately followed by the place, as json.
+* id index - an entry (ID_ENTRY_FORMAT) for each place, sorted by place_id:
+  offset of the record, length of the place_id, length of the json, hash of the json.
+* geo index - an entry (GEO_ENTRY_FORMAT) for each place, sorted by the geohash of the place:
+  the geohash (GEOHASH_PRECISION characters) as an integer, the number of the place's entry in the id index.
+
+The hash of the json lets us compare two files place by place, without decoding the places (see diff_places).
+"""
+import mmap
+import struct
+from bisect import bisect_left
+from hashlib import blake2b
+from typing import Dict
+
+from shared_utils import codec, geohash
+
+MAGIC = b"DKPLACES"
+VERSION = 1
+FILE_EXTENSION = ".dkp"
+
+# magic, version, number of places, metadata offset, metadata length, id index offset, geo index offset
+HEADER_FORMAT = "<8sIIQQQQ"
+ID_ENTRY_FORMAT = "<QIIQ"
+GEO_ENTRY_FORMAT = "<QI"
+_HEADER = struct.Struct(HEADER_FORMAT)
+_ID_ENTRY = struct.Struct(ID_ENTRY_FORMAT)
+_GEO_ENTRY = struct.Struct(GEO_ENTRY_FORMAT)
+
+GEOHASH_PRECISION = 12
+# the geohash of places without a location. it's bigger than the geohash of any location
+_NO_LOCATION = (1 << 64) - 1
+
+
+def content_hash(payload) -> int:
+    return int.from_bytes(blake2b(payload, digest_size=8).digest(), 'little')
+
+
+def _geohash_of(place) -> int:
+    location = place.get('geometry', {}).get('location') if isinstance(place, dict) else None
+    if not location:
+        return _NO_LOCATION
+    return geohash.to_int(geohash.encode(location['lat'], location['lng'], GEOHASH_PRECISION))
+
+
+def write_places_index(file_path, places: Dict, metadata, default=None):
+    """
+    :param places: place_id -> place
+    :param metadata: the metadata of the area (json-serializable)
+    :param default: same as in codec.dumps. used for the places
+    """
+    with PlacesIndexWriter(file_path, metadata=metadata, default=default) as writer:
+        writer.add(places)
+
+
+class PlacesIndexWriter:
+    """
+    Writes a places index file as the places arrive (e.g. in chunks, from the crawler). The places are written right
+    away - only a small entry per place is kept until close(), which writes the indexes. A place whose place_id was
+    already added is skipped.
+
+    Use as a context manager, or call close().
+    """
+
+    def __init__(self, file_path, metadata, default=None):
+        """
+        :param metadata: the metadata of the area (json-serializable)
+        :param default: same as in codec.dumps. used for the places
+        """
+        self._default = default
+        # place_id as bytes -> (record offset, id length, json length, hash, geohash)
+        self._entries = {}
+        self._file = open(file_path, 'wb')
+        self._file.write(b"\0" * _HEADER.size)  # the header is written last, once the offsets are known
+        self._metadata_offset = self._file.tell()
+        encoded_metadata = codec.dumps(metadata)
+        self._metadata_length = len(encoded_metadata)
+        self._file.write(encoded_metadata)
+
+    def add(self, places: Dict):
+        """
+        :param places: place_id -> place
+        """
+        for place_id, place in places.items():
+            encoded_id = place_id.encode('utf-8')
+            if encoded_id in self._entries:
+                continue
+            payload = codec.dumps(place, default=self._default)
+            located = self._default(place) if self._default is not None and not isinstance(place, dict) else place
+            self._entries[encoded_id] = (self._file.tell(), len(encoded_id), len(payload), content_hash(payload),
+                                         _geohash_of(located))
+            self._file.write(encoded_id)
+            self._file.write(payload)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        if self._file.closed:
+            return
+        file = self._file
+        entries = sorted(self._entries.items())
+        id_index_offset = file.tell()
+        for _, (offset, id_length, payload_length, payload_hash, _) in entries:
+            file.write(_ID_ENTRY.pack(offset, id_length, payload_length, payload_hash))
+
+        geo_index_offset = file.tell()
+        by_geohash = sorted(range(len(entries)), key=lambda i: entries[i][1][4])
+        for i in by_geohash:
+            file.write(_GEO_ENTRY.pack(entries[i][1][4], i))
+
+        file.seek(0)
+        file.write(_HEADER.pack(MAGIC, VERSION, len(entries), self._metadata_offset, self._metadata_length,
+                                id_index_offset, geo_index_offset))
+        file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class IndexedPlace(dict):
+    """
+    A place read from a PlacesIndex, with its json as stored in the file (a memoryview). The place can be stored
+    elsewhere (e.g. in Redis) as is, without encoding it again.
+    """
+    __slots__ = ('payload',)
+
+
+def is_places_index(file_path) -> bool:
+    with open(file_path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+class PlacesIndex:
+    """
+    Read-only access to a file written by write_places_index. The payloads are returned as memoryviews of the
+    memory-mapped file - no copies are made until they are decoded. A payload is valid even after close().
+
+    Use as a context manager, or call close().
+    """
+
+    def __init__(self, file_path):
+        self._file = open(file_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if len(self._mmap) < _HEADER.size:
+            self.close()
+            raise ValueError("%s is not a places index file" % file_path)
+        (magic, version, self._count, metadata_offset, metadata_length,
+         self._id_index_offset, self._geo_index_offset) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("%s is not a places index file (version %i)" % (file_path, VERSION))
+        self.metadata = codec.loads(bytes(self._view[metadata_offset:metadata_offset + metadata_length]))
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # a payload is still referenced. the mapping is released when the payload is garbage collected
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, i):
+        """
+        :return: (place_id as bytes, payload memoryview, hash) of the i-th place in the id index
+        """
+        offset, id_length, payload_length, payload_hash = _ID_ENTRY.unpack_from(
+            self._mmap, self._id_index_offset + i * _ID_ENTRY.size)
+        payload_offset = offset + id_length
+        return (self._mmap[offset:payload_offset], self._view[payload_offset:payload_offset + payload_length],
+                payload_hash)
+
+    def _id_at(self, i):
+        offset, id_length, _, _ = _ID_ENTRY.unpack_from(self._mmap, self._id_index_offset + i * _ID_ENTRY.size)
+        return self._mmap[offset:offset + id_length]
+
+    def _find(self, place_id):
+        encoded_id = place_id.encode('utf-8')
+        i = bisect_left(_LazySequence(self._count, self._id_at), encoded_id)
+        if i < self._count and self._id_at(i) == encoded_id:
+            return i
+        return None
+
+    def __contains__(self, place_id):
+        return self._find(place_id) is not None
+
+    def get_payload(self, place_id):
+        """
+        :return: the json of the place as a memoryview, or None
+        """
+        i = self._find(place_id)
+        return None if i is None else self._entry(i)[1]
+
+    def get(self, place_id):
+        payload = self.get_payload(place_id)
+        return None if payload is None else codec.loads(payload)
+
+    def iter_entries(self):
+        """
+        Yields (place_id, hash of the json, json memoryview) for all places, sorted by place_id.
+        """
+        for i in range(self._count):
+            encoded_id, payload, payload_hash = self._entry(i)
+            yield encoded_id.decode('utf-8'), payload_hash, payload
+
+    def items(self, keep_payloads=False):
+        """
+        Yields (place_id, place) for all places, sorted by place_id
+        :param keep_payloads: if true, the places are IndexedPlaces - they keep their json
+        """
+        for place_id, _, payload in self.iter_entries():
+            place = codec.loads(payload)
+            if keep_payloads:
+                place = IndexedPlace(place)
+                place.payload = payload
+            yield place_id, place
+
+    def items_within(self, geohash_prefix):
+        """
+        Yields (place_id, place) for the places whose geohash starts with @geohash_prefix
+        """
+        shift = 5 * (GEOHASH_PRECISION - len(geohash_prefix))
+        low = geohash.to_int(geohash_prefix) << shift
+        high = (geohash.to_int(geohash_prefix) + 1) << shift
+
+        def geohash_at(i):
+            return _GEO_ENTRY.unpack_from(self._mmap, self._geo_index_offset + i * _GEO_ENTRY.size)[0]
+
+        geohashes = _LazySequence(self._count, geohash_at)
+        for i in range(bisect_left(geohashes, low), bisect_left(geohashes, high)):
+            _, id_entry = _GEO_ENTRY.unpack_from(self._mmap, self._geo_index_offset + i * _GEO_ENTRY.size)
+            encoded_id, payload, _ = self._entry(id_entry)
+            yield encoded_id.decode('utf-8'), codec.loads(payload)
+
+
+class _LazySequence:
+    """
+    A sequence whose items are computed on access. lets us bisect the indexes without reading them in a list.
+    """
+
+    def __init__(self, length, get_item):
+        self._length = length
+        self._get_item = get_item
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        return self._get_item(i)
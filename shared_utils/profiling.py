@@ -0,0 +1,225 @@
+"""
+Opt-in profiling of the crawl and load runs. Enabled with --profile <directory> on the entry points (or with the
+DEKA_PROFILE_DIR environment variable, which is how the worker processes inherit it). When disabled, the hooks below
+do nothing.
+
+Each process profiled with process_profile() writes to the directory:
+* <name>_<pid>.prof - cProfile stats of the main thread of the process and of the threads started with
+profiled_thread_target(). cProfile only sees the thread it's enabled in, hence the wrapper.
+* <name>_<pid>.collapsed - the stacks of all threads of the process, sampled every DEKA_PROFILE_INTERVAL_MS (10ms),
+in the collapsed format of flamegraph.pl (https://github.com/brendangregg/FlameGraph) - "frame;frame;frame <count>".
+The samples show where the wall time goes, including the waits (HTTP, IPC) which cProfile attributes poorly.
+* spans_<pid>.json - the wall time of the stages of the run (see span()).
+
+merge_profiles() combines the files of all processes into merged.prof, merged.collapsed and spans.json.
+"""
+import cProfile
+import glob
+import json
+import logging as log
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+PROFILE_DIR_VARIABLE = "DEKA_PROFILE_DIR"
+_SAMPLE_INTERVAL = float(os.environ.get("DEKA_PROFILE_INTERVAL_MS", 10)) / 1000
+
+
+def enable(directory):
+    """
+    Profile this process and the processes it starts from now on.
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.environ[PROFILE_DIR_VARIABLE] = os.path.abspath(directory)
+
+
+def profile_dir():
+    """
+    :return: the directory of the profiles. None if profiling is disabled
+    """
+    return os.environ.get(PROFILE_DIR_VARIABLE)
+
+
+class _ProcessProfile:
+    """
+    The profile of the current process - a cProfile per profiled thread and a sampler of all threads.
+    """
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = directory
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._thread_stats = []
+        self._samples = Counter()
+        self._spans = []
+        self._stop_sampling = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def add_thread_profile(self, profile: cProfile.Profile):
+        with self._lock:
+            self._thread_stats.append(profile)
+
+    def add_span(self, name, start, duration):
+        with self._lock:
+            self._spans.append({"name": name, "pid": self.pid, "start": start, "seconds": duration})
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop_sampling.wait(_SAMPLE_INTERVAL):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self._samples[_collapse(frame)] += 1
+
+    def stop(self):
+        self._stop_sampling.set()
+        self._sampler.join()
+        prefix = os.path.join(self.directory, "%s_%i" % (self.name, self.pid))
+        with self._lock:
+            if self._thread_stats:
+                stats = pstats.Stats(self._thread_stats[0])
+                for profile in self._thread_stats[1:]:
+                    stats.add(profile)
+                stats.dump_stats(prefix + ".prof")
+            with open(prefix + ".collapsed", "w") as file:
+                for stack, count in self._samples.items():
+                    file.write("%s %i\n" % (stack, count))
+            if self._spans:
+                with open(os.path.join(self.directory, "spans_%i.json" % self.pid), "w") as file:
+                    json.dump(self._spans, file)
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("%s (%s:%i)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+# the profile of this process, while process_profile() is active
+_current = None
+
+
+@contextmanager
+def process_profile(name):
+    """
+    Profile the current process (the calling thread with cProfile, all threads with the sampler) until the
+    block exits. Does nothing if profiling is disabled.
+    :param name: e.g. "main", "worker". used in the names of the files
+    """
+    global _current
+    directory = profile_dir()
+    if directory is None or (_current is not None and _current.pid == os.getpid()):
+        # disabled, or the process is already profiled
+        yield
+        return
+
+    _current = _ProcessProfile(name, directory)
+    _current.start()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _current.add_thread_profile(profile)
+        _current.stop()
+        _current = None
+
+
+def profiled_process(name):
+    """
+    Decorator. Same as process_profile, for the whole function - e.g. the target of a worker process.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with process_profile(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def profiled_thread_target(function):
+    """
+    Wrap the target of a thread to profile it with cProfile too (the sampler sees all threads anyway).
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        current = _current
+        if current is None or current.pid != os.getpid():
+            return function(*args, **kwargs)
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            current.add_thread_profile(profile)
+
+    return wrapper
+
+
+@contextmanager
+def span(name):
+    """
+    Record the wall time of a stage of the run, e.g. with span("query"): ...
+    """
+    current = _current
+    if current is None or current.pid != os.getpid():
+        yield
+        return
+    start, started = time.time(), time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        current.add_span(name, start, duration)
+        log.info("[profile] %s took %.3fs" % (name, duration))
+
+
+def merge_profiles(directory=None):
+    """
+    Combine the profiles of all processes in @directory into merged.prof, merged.collapsed and spans.json.
+    """
+    directory = directory or profile_dir()
+    prof_files = sorted(path for path in glob.glob(os.path.join(directory, "*.prof"))
+                        if os.path.basename(path) != "merged.prof")
+    if prof_files:
+        stats = pstats.Stats(*prof_files)
+        stats.dump_stats(os.path.join(directory, "merged.prof"))
+
+    samples = Counter()
+    for path in glob.glob(os.path.join(directory, "*.collapsed")):
+        if os.path.basename(path) == "merged.collapsed":
+            continue
+        with open(path) as file:
+            for line in file:
+                stack, count = line.rstrip("\n").rsplit(" ", 1)
+                samples[stack] += int(count)
+    with open(os.path.join(directory, "merged.collapsed"), "w") as file:
+        for stack, count in samples.most_common():
+            file.write("%s %i\n" % (stack, count))
+
+    spans = []
+    for path in glob.glob(os.path.join(directory, "spans_*.json")):
+        with open(path) as file:
+            spans += json.load(file)
+    spans.sort(key=lambda recorded: recorded["start"])
+    with open(os.path.join(directory, "spans.json"), "w") as file:
+        json.dump(spans, file, indent=2)
+    log.info("Merged the profiles of %i processes in %s" % (len(prof_files), directory))
@@ -0,0 +1,109 @@
+import copy
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from diff_places.diff import diff_places, ChangeKind, PlaceChange, cell_of_place
+from diff_places.sources import DictSource, IndexedFileSource, RedisAreaSource, open_source
+from load_data.datastore_adapter import load_to_datastore
+from load_data.datastore_adapter.redis import r
+from load_data.main import parse_raw_input
+from shared_utils.file_utils import save_dict_to_file
+from shared_utils.places_index import write_places_index
+from tests.test_load_data.test_data import dummy_data_leuven
+from tests.test_load_data.test_redis_adapter import ensure_correct_redis_db_during_testing, drop_db
+
+
+def changed_places(places):
+    """
+    :return: a copy of @places with two places removed, one added and one changed, and the expected changes
+    """
+    new = copy.deepcopy(places)
+    removed_ids = sorted(new)[:2]
+    for place_id in removed_ids:
+        del new[place_id]
+    changed_id = sorted(new)[0]
+    new[changed_id]['name'] = "renamed"
+    added = copy.deepcopy(new[changed_id])
+    added['place_id'] = "new_place"
+    new["new_place"] = added
+
+    expected = [PlaceChange(ChangeKind.removed, place_id, places[place_id], None) for place_id in removed_ids]
+    expected.append(PlaceChange(ChangeKind.changed, changed_id, places[changed_id], new[changed_id]))
+    expected.append(PlaceChange(ChangeKind.added, "new_place", None, added))
+    return new, expected
+
+
+class TestDiff(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.old = dummy_data_leuven['places']
+        cls.new, cls.expected = changed_places(cls.old)
+
+    def setUp(self):
+        self.dir = TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def indexed(self, places, name):
+        path = os.path.join(self.dir.name, name)
+        write_places_index(path, places, dummy_data_leuven['metadata'])
+        return IndexedFileSource(path)
+
+    def check(self, old_source, new_source):
+        diff = diff_places(old_source, new_source)
+        self.assertEqual(sorted(self.expected), sorted(diff))
+        self.assertEqual({ChangeKind.added: 1, ChangeKind.removed: 2, ChangeKind.changed: 1,
+                          'unchanged': len(self.old) - 3}, diff.counts)
+        self.assertEqual(len(self.old), sum(cell.old_count for cell in diff.cells.values()))
+        self.assertEqual(len(self.new), sum(cell.new_count for cell in diff.cells.values()))
+        for change in self.expected:
+            cell = diff.cells[cell_of_place(change.new or change.old, diff.cell_precision)]
+            self.assertGreater(cell.churn, 0)
+        return diff
+
+    def test_dicts(self):
+        self.check(DictSource(self.old), DictSource(self.new))
+
+    def test_indexed_files(self):
+        old, new = self.indexed(self.old, "old.dkp"), self.indexed(self.new, "new.dkp")
+        self.assertTrue(old.sorted_by_id and new.sorted_by_id)
+        self.check(old, new)
+        old.close()
+        new.close()
+
+    def test_mixed(self):
+        old = self.indexed(self.old, "old.dkp")
+        self.check(old, DictSource(self.new))
+        old.close()
+
+    def test_identical(self):
+        diff = diff_places(DictSource(self.old), DictSource(copy.deepcopy(self.old))).run()
+        self.assertEqual(len(self.old), diff.counts['unchanged'])
+        self.assertTrue(all(cell.churn == 0 for cell in diff.cells.values()))
+
+    def test_open_source(self):
+        json_path = os.path.join(self.dir.name, "old.json")
+        save_dict_to_file(dummy_data_leuven, json_path)
+        self.assertIsInstance(open_source(json_path), DictSource)
+        self.indexed(self.old, "old.dkp").close()
+        self.assertIsInstance(open_source(os.path.join(self.dir.name, "old.dkp")), IndexedFileSource)
+        self.assertIsInstance(open_source("redis:leuven"), RedisAreaSource)
+
+
+class TestDiffWithRedis(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        ensure_correct_redis_db_during_testing()
+
+    def tearDown(self):
+        drop_db(r)
+
+    def test_redis_area(self):
+        places, metadata = parse_raw_input(dummy_data_leuven)
+        load_to_datastore(places, metadata)
+        new, expected = changed_places(places)
+
+        diff = diff_places(RedisAreaSource(metadata.area_name), DictSource(new))
+        self.assertEqual(sorted(expected), sorted(diff))
@@ -0,0 +1,56 @@
+from multiprocessing import Process
+from unittest import TestCase
+
+from deka_types import Circle
+from get_places.google_places_wrapper.dedup import SeenPlacesIndex, OverlapStats
+
+
+def mark_seen(index, place_ids):
+    index.drop_seen({place_id: {} for place_id in place_ids})
+
+
+class TestSeenPlacesIndex(TestCase):
+    def test_drop_seen(self):
+        index = SeenPlacesIndex(capacity=100)
+        circle_a = Circle(lat=1, lng=1, radius=100)
+        circle_b = Circle(lat=1, lng=2, radius=100)
+
+        first = index.drop_seen({"a": {}, "b": {}}, circle=circle_a)
+        second = index.drop_seen({"b": {}, "c": {}}, circle=circle_b)
+
+        self.assertEqual({"a", "b"}, set(first))
+        self.assertEqual({"c"}, set(second))
+        self.assertEqual(3, len(index))
+        self.assertEqual((2, 0), index.overlap[circle_a][:2])
+        self.assertEqual((2, 1), index.overlap[circle_b][:2])
+
+    def test_result_hash(self):
+        index = SeenPlacesIndex(capacity=100)
+        circle_a = Circle(lat=1, lng=1, radius=100)
+        circle_b = Circle(lat=1, lng=2, radius=100)
+
+        index.drop_seen({"a": {}, "b": {}}, circle=circle_a)
+        index.drop_seen({"b": {}, "a": {}}, circle=circle_b)
+        # the duplicates count too - the hash is of the whole result of the circle
+        self.assertEqual(index.overlap[circle_a].result_hash, index.overlap[circle_b].result_hash)
+
+        index.record_overlap(circle_b, fetched=0, duplicates=0, saturated=True)
+        index.drop_seen({"c": {}}, circle=circle_b)
+        self.assertNotEqual(index.overlap[circle_a].result_hash, index.overlap[circle_b].result_hash)
+        self.assertEqual(OverlapStats(fetched=3, duplicates=2, result_hash=index.overlap[circle_b].result_hash,
+                                      saturated=True), index.overlap[circle_b])
+        self.assertFalse(index.overlap[circle_a].saturated)
+
+    def test_shared_between_processes(self):
+        index = SeenPlacesIndex(capacity=100)
+        p = Process(target=mark_seen, args=(index, ["a", "b"]))
+        p.start()
+        p.join()
+
+        self.assertEqual({"c"}, set(index.drop_seen({"a": {}, "b": {}, "c": {}})))
+
+    def test_full_index_keeps_places(self):
+        index = SeenPlacesIndex(capacity=2)
+        place_ids = [str(i) for i in range(10)]
+        # when full, places are treated as unseen rather than dropped
+        self.assertEqual(set(place_ids), set(index.drop_seen({place_id: {} for place_id in place_ids})))
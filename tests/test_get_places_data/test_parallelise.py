@@ -1,11 +1,21 @@
-from multiprocessing import Value, Lock, Manager
+import glob
+import os
+from functools import partial
+from io import StringIO
+from multiprocessing import Value, Lock, Manager, active_children
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 from unittest.mock import patch
 from uuid import uuid4 as _uuid4
 
 from deka_types import Circle
+from get_places.config import Config
+from get_places.deka_utils.misc import split_to_batches
+from get_places.get_places_data import crawl, parse_args
+from get_places.google_places_wrapper.parallelise import parallelise, iter_parallelise
 from get_places.google_places_wrapper.wrapper import interesting_venue_types, query_google_places, \
     MAX_RESULTS_PER_QUERY, _query_single_circle, handle_busy_circle
+from shared_utils.file_utils import PlacesFileWriter, save_dict_to_file
 
 
 def uuid4():
@@ -80,6 +90,19 @@ class TestParallelise(TestCase):
         self.assertEqual(len(dict), len(dummy_tasks),
                          "Looks like the query method was called with the same argument twice")
 
+    def test_duplicate_circles_queried_once(self, patched_single_query):
+        counter = Value('i', 0)
+
+        def fake_single_request(circle):
+            with counter.get_lock():
+                counter.value += 1
+            return {}
+
+        patched_single_query.side_effect = fake_single_request
+
+        query_google_places(circles_coords=dummy_tasks + dummy_tasks[:10])
+        self.assertEqual(len(dummy_tasks), counter.value)
+
 
 # TODO DRY mocking. really nice article https://makina-corpus.com/blog/metier/2013/dry-up-mock-instanciation-with-addcleanup
 class TestBusyCircle(TestCase):
@@ -128,3 +151,122 @@ class TestBusyCircle(TestCase):
         self.assertEqual(len(interesting_venue_types) * self.items_per_place_type_returned_by_api, len(places),
                          "Method should have returned the combined results of sequential queries for "
                          "different places types")
+
+
+def fake_places_of_circle(circle):
+    # two places per circle. the second one is shared with the next circle, i.e. the circles overlap
+    return {"%s-own" % circle.radius: {"radius": circle.radius},
+            "%s-shared" % (circle.radius // 2): {"radius": circle.radius // 2}}
+
+
+class TestResultChannel(TestCase):
+    def test_all_results_merged(self):
+        batches = split_to_batches(dummy_tasks, items_per_batch=len(dummy_tasks) // 4)
+        expected = {}
+        for circle in dummy_tasks:
+            expected.update(fake_places_of_circle(circle))
+
+        self.assertEqual(expected, parallelise(batches, single_query_function=fake_places_of_circle))
+
+    @patch('get_places.google_places_wrapper.parallelise.CHUNK_SIZE', 3)
+    def test_results_sent_in_chunks(self):
+        batches = split_to_batches(dummy_tasks, items_per_batch=len(dummy_tasks) // 4)
+        self.assertEqual(len(dummy_tasks) + len(dummy_tasks) // 2,
+                         len(parallelise(batches, single_query_function=fake_places_of_circle)))
+
+
+def large_places_of_circle(circle, counter):
+    with counter.get_lock():
+        counter.value += 1
+    # big enough to fill the pipe of a worker with a few chunks
+    return {"%s-own" % circle.radius: {"payload": "x" * 10000}}
+
+
+def places_of_circle_within_credits(circle, counter, consumed, violations, max_chunks_in_flight):
+    with counter.get_lock():
+        counter.value += 1
+        # one chunk per circle and one thread - the chunks sent before this query are counter.value - 1, and at most
+        # max_chunks_in_flight more than the ones taken (consumed.value - 1)
+        if counter.value > consumed.value + max_chunks_in_flight:
+            violations.value += 1
+    return {"%s-own" % circle.radius: {}}
+
+
+class TestStreaming(TestCase):
+    circles = [Circle(lat=0, lng=0, radius=i) for i in range(2000)]
+
+    @patch('get_places.google_places_wrapper.parallelise.CHUNK_SIZE', 1)
+    @patch('get_places.google_places_wrapper.parallelise.MAX_CHUNKS_IN_FLIGHT', 2)
+    def test_slow_consumer_throttles_workers(self):
+        # less than 30 circles - a single thread, which sends a chunk per circle
+        circles = self.circles[:20]
+        queried, consumed, violations = Value('i', 0), Value('i', 0), Value('i', 0)
+        chunks = iter_parallelise([circles], single_query_function=partial(
+            places_of_circle_within_credits, counter=queried, consumed=consumed, violations=violations,
+            max_chunks_in_flight=2))
+
+        places = {}
+        while True:
+            # the chunks requested so far, including this one
+            with consumed.get_lock():
+                consumed.value += 1
+            try:
+                places.update(next(chunks))
+            except StopIteration:
+                break
+        # the worker never sent more than 2 chunks which weren't requested yet
+        self.assertEqual(0, violations.value)
+        self.assertEqual(len(circles), queried.value)
+        self.assertEqual(len(circles), len(places))
+
+    @patch('get_places.google_places_wrapper.parallelise.CHUNK_SIZE', 1)
+    def test_stopped_early(self):
+        # e.g. the Manager processes of other tests
+        other_processes = set(active_children())
+        queried = Value('i', 0)
+        batches = split_to_batches(self.circles, items_per_batch=len(self.circles) // 4)
+        chunks = iter_parallelise(batches, single_query_function=partial(large_places_of_circle, counter=queried))
+        next(chunks)
+        workers = set(active_children()) - other_processes
+        chunks.close()
+        self.assertEqual(set(), set(active_children()) - other_processes)
+        # the workers stopped by themselves, they weren't terminated
+        self.assertEqual({0}, {worker.exitcode for worker in workers})
+        self.assertLess(queried.value, len(self.circles))
+
+    @patch('get_places.google_places_wrapper.parallelise.CHUNK_SIZE', 1)
+    def test_saving_fails(self):
+        other_processes = set(active_children())
+        add = PlacesFileWriter.add
+        added, queried = Value('i', 0), Value('i', 0)
+
+        def failing_add(writer, places):
+            added.value += 1
+            if added.value == 2:
+                raise OSError("No space left on device")
+            add(writer, places)
+
+        def places_of_circle(circle, type=None, seen_index=None):
+            return large_places_of_circle(circle, counter=queried)
+
+        with TemporaryDirectory() as directory, \
+                patch.object(Config, 'output_folder', directory), \
+                patch('get_places.google_places_wrapper.wrapper._query_single_circle', places_of_circle), \
+                patch.object(PlacesFileWriter, 'add', failing_add), \
+                patch('sys.stdout', new_callable=StringIO):
+            input_path = os.path.join(directory, "input.json")
+            save_dict_to_file({"area_name": "leuven", "circle_radius": 150, "bounding_rectangle": {},
+                               "coordinates": [{"lat": circle.lat, "lng": circle.radius / 1000} for circle in self.circles]},
+                              input_path)
+            error = None
+            with patch('sys.argv', ["get_places_data.py", "--file", input_path]):
+                try:
+                    crawl(parse_args())
+                except OSError as ex:
+                    # keeps the traceback (and the frames of crawl) alive, like an unhandled error at exit
+                    error = ex
+            self.assertIsNotNone(error)
+            # the workers were stopped, the crawl doesn't hang
+            self.assertEqual(set(), set(active_children()) - other_processes)
+            self.assertEqual([], glob.glob(os.path.join(directory, "leuven_*")))
+            self.assertEqual([], glob.glob(os.path.join(directory, ".*.partial")))
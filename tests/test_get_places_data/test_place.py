@@ -0,0 +1,34 @@
+from unittest import TestCase
+
+from get_places.google_places_wrapper.parallelise import _encode_places, _decode_places
+from get_places.google_places_wrapper.place import CompactPlace
+
+api_place = {
+    "place_id": "ChIJ1",
+    "name": "Bar",
+    "geometry": {"location": {"lat": 42.69, "lng": 23.32},
+                 "viewport": {"northeast": {"lat": 42.7, "lng": 23.33}, "southwest": {"lat": 42.68, "lng": 23.31}}},
+    "types": ["bar", "point_of_interest"],
+    "vicinity": "Sofia",
+    "rating": 4.5,
+    "user_ratings_total": 10,
+    "photos": [{"photo_reference": "abc", "html_attributions": []}],
+    "icon": "https://maps.gstatic.com/bar.png",
+}
+
+
+class TestCompactPlace(TestCase):
+    def test_to_dict_keeps_only_needed_fields(self):
+        self.assertEqual({
+            "place_id": "ChIJ1",
+            "name": "Bar",
+            "geometry": {"location": {"lat": 42.69, "lng": 23.32}},
+            "types": ["bar", "point_of_interest"],
+            "vicinity": "Sofia",
+            "rating": 4.5,
+            "user_ratings_total": 10,
+        }, CompactPlace.from_api(api_place).to_dict())
+
+    def test_sent_between_processes(self):
+        places = {"ChIJ1": CompactPlace.from_api(api_place), "other": {"place_id": "other"}}
+        self.assertEqual(places, _decode_places(_encode_places(places)))
@@ -0,0 +1,130 @@
+import os
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from deka_types import Circle
+from get_places.config import Config
+from get_places.google_places_wrapper.dedup import OverlapStats, SeenPlacesIndex
+from get_places.google_places_wrapper.place import CompactPlace
+from get_places.google_places_wrapper.wrapper import _query_single_circle, _request_params, \
+    NEXT_PAGE_TOKEN_REQUEST_KEY, NEXT_PAGE_TOKEN_RESPONSE_KEY
+from get_places.recrawl import CrawlHistory, merge_with_previous, succeeded_circles
+
+now = datetime(2020, 1, 1)
+circles = [Circle(lat=50.87, lng=4.70 + i * 0.01, radius=150) for i in range(4)]
+
+
+def place(place_id, lat, lng):
+    return {'place_id': place_id, 'geometry': {'location': {'lat': lat, 'lng': lng}}}
+
+
+@patch.object(Config, 'recrawl_min_age_days', 7)
+@patch.object(Config, 'recrawl_max_age_days', 56)
+@patch.object(Config, 'recrawl_churn_smoothing', 0.5)
+class TestCrawlHistory(TestCase):
+    def crawl(self, history, crawled, when, hashes=None, saturated=()):
+        overlap = {circle: OverlapStats(fetched=1, duplicates=0, result_hash=(hashes or {}).get(circle, 1),
+                                        saturated=circle in saturated) for circle in crawled}
+        history.update(crawled, overlap, now=when)
+
+    def test_never_crawled_are_due(self):
+        history = CrawlHistory()
+        self.assertEqual(circles, history.due_circles(circles, now=now))
+        self.assertEqual(circles[:2], history.due_circles(circles, now=now, max_circles=2))
+
+    def test_due_by_churn(self):
+        history = CrawlHistory()
+        self.crawl(history, circles, now)
+        # the result of circles[0] changes, the rest are stable
+        self.crawl(history, circles, now + timedelta(days=40), hashes={circles[0]: 2})
+        later = now + timedelta(days=40)
+        self.assertEqual([], history.due_circles(circles, now=later + timedelta(days=10)))
+        # churn of circles[0] is 0.75 -> refreshed after ~20 days, the rest (0.25) after ~44 days
+        self.assertEqual([circles[0]], history.due_circles(circles, now=later + timedelta(days=21)))
+        self.assertEqual(circles, history.due_circles(circles, now=later + timedelta(days=45)))
+
+    def test_saturated_use_min_age(self):
+        history = CrawlHistory()
+        self.crawl(history, circles, now, saturated={circles[1]})
+        self.assertEqual([circles[1]], history.due_circles(circles, now=now + timedelta(days=8)))
+
+    def test_failed_circles_stay_due(self):
+        history = CrawlHistory()
+        history.update(circles, {circles[0]: OverlapStats(fetched=1, duplicates=0)}, now=now)
+        self.assertEqual(circles[1:], history.due_circles(circles, now=now))
+
+    def test_save_load(self):
+        history = CrawlHistory()
+        self.crawl(history, circles, now, saturated={circles[1]})
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, "history.json")
+            history.save(path)
+            self.assertEqual(history.circles, CrawlHistory.load(path).circles)
+            self.assertEqual(0, len(CrawlHistory.load(os.path.join(directory, "missing.json"))))
+
+
+class TestMergeWithPrevious(TestCase):
+    def test_merge(self):
+        crawled = circles[:1]
+        previous = {
+            # within the crawled circle. gone in the fresh results
+            "closed": place("closed", circles[0].lat, circles[0].lng + 0.001),
+            # within the crawled circle, and in the fresh results
+            "updated": place("updated", circles[0].lat, circles[0].lng),
+            # within a circle which wasn't crawled
+            "kept": place("kept", circles[1].lat, circles[1].lng),
+        }
+        fresh = {"updated": CompactPlace("updated", name="new name", lat=circles[0].lat, lng=circles[0].lng),
+                 "opened": CompactPlace("opened", lat=circles[0].lat, lng=circles[0].lng)}
+
+        merged = merge_with_previous(previous, fresh, crawled)
+        self.assertEqual({"updated", "opened", "kept"}, set(merged))
+        self.assertEqual("new name", merged["updated"].name)
+        self.assertIs(previous["kept"], merged["kept"])
+
+    def test_nothing_crawled(self):
+        previous = {"kept": place("kept", circles[0].lat, circles[0].lng)}
+        self.assertEqual(previous, merge_with_previous(previous, {}, []))
+
+
+class TestFailedQueries(TestCase):
+    def setUp(self):
+        keep_all = patch('get_places.google_places_wrapper.wrapper.should_keep_place', return_value=True)
+        keep_all.start()
+        self.addCleanup(keep_all.stop)
+
+    def test_failed_circle_not_crawled(self):
+        failing, ok = circles[0], circles[1]
+        first_page = {"results": [place("fetched", failing.lat, failing.lng)], "status": "OK",
+                      NEXT_PAGE_TOKEN_RESPONSE_KEY: "next"}
+
+        def request(params):
+            if params.get('location') == _request_params(ok)['location']:
+                return {"results": [place("ok", ok.lat, ok.lng)], "status": "OK"}
+            if NEXT_PAGE_TOKEN_REQUEST_KEY in params:
+                raise Exception("timeout")
+            return first_page
+
+        seen_index = SeenPlacesIndex(capacity=100)
+        with patch('get_places.google_places_wrapper.wrapper._make_coalesced_request', side_effect=request):
+            fresh = {}
+            for circle in [failing, ok]:
+                fresh.update(_query_single_circle(circle, seen_index=seen_index))
+
+        # the places fetched before the failure are kept
+        self.assertEqual({"fetched", "ok"}, set(fresh))
+        self.assertTrue(seen_index.overlap[failing].failed)
+        self.assertFalse(seen_index.overlap[ok].failed)
+        crawled = succeeded_circles([failing, ok], seen_index.overlap)
+        self.assertEqual([ok], crawled)
+
+        history = CrawlHistory()
+        history.update([failing, ok], seen_index.overlap, now=now)
+        self.assertEqual([failing], history.due_circles([failing, ok], now=now))
+
+        # the previous places within the failed circle are not dropped
+        previous = {"closed": place("closed", failing.lat, failing.lng + 0.0001),
+                    "gone": place("gone", ok.lat, ok.lng + 0.0001)}
+        self.assertEqual({"closed", "fetched", "ok"}, set(merge_with_previous(previous, fresh, crawled)))
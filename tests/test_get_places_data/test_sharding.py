@@ -0,0 +1,81 @@
+import glob
+import os
+import random
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from deka_types import Circle
+from get_places.config import Config
+from get_places.get_places_data import crawl, parse_args
+from get_places.sharding import Shard, parse_shard, shard_circles, merge_shard_outputs
+from shared_utils.file_utils import save_dict_to_file, read_places_file
+
+circles = [Circle(lat=50.8 + (i // 10) * 0.002, lng=4.6 + (i % 10) * 0.002, radius=150) for i in range(100)]
+
+
+def fake_query_google_places(circles_coords, seen_index=None):
+    # a place of its own for each circle, and one shared with the neighbouring circle
+    places = {}
+    for circle in circles_coords:
+        for lat in [circle.lat, round(circle.lat, 2)]:
+            place_id = "%s,%s" % (lat, circle.lng)
+            places[place_id] = {'place_id': place_id, 'geometry': {'location': {'lat': lat, 'lng': circle.lng}}}
+    return places
+
+
+def fake_iter_google_places(circles_coords, seen_index=None):
+    # a chunk per circle - the places shared by neighbouring circles are in more than one chunk
+    for circle in circles_coords:
+        yield fake_query_google_places([circle])
+
+
+class TestSharding(TestCase):
+    def test_parse_shard(self):
+        self.assertEqual(Shard(index=1, count=4), parse_shard("1/4"))
+        for invalid in ["4/4", "-1/4", "1", "a/b"]:
+            with self.assertRaises(ValueError):
+                parse_shard(invalid)
+
+    def test_partition(self):
+        shuffled = list(circles)
+        random.Random(0).shuffle(shuffled)
+        shards = [shard_circles(circles, Shard(index=i, count=3)) for i in range(3)]
+
+        self.assertEqual(sorted(circles), sorted(circle for shard in shards for circle in shard))
+        self.assertEqual([33, 33, 34], [len(shard) for shard in shards])
+        # deterministic - independent of the order of the input
+        self.assertEqual(shards, [shard_circles(shuffled, Shard(index=i, count=3)) for i in range(3)])
+
+    def test_crawl_shards_and_merge(self):
+        with TemporaryDirectory() as directory, \
+                patch.object(Config, 'output_folder', directory), \
+                patch('get_places.get_places_data.iter_google_places', fake_iter_google_places), \
+                patch('sys.stdout', new_callable=StringIO):
+            input_path = os.path.join(directory, "input.json")
+            save_dict_to_file({
+                "area_name": "leuven", "circle_radius": 150,
+                "bounding_rectangle": {"northwest": {"lat": 51, "lng": 4.5}, "southeast": {"lat": 50.7, "lng": 4.8}},
+                "coordinates": [{"lat": circle.lat, "lng": circle.lng} for circle in circles]
+            }, input_path)
+
+            for i in range(4):
+                with patch('sys.argv', ["get_places_data.py", "--file", input_path, "--shard", "%i/4" % i,
+                                        "--format", "indexed" if i % 2 else "json"]):
+                    crawl(parse_args())
+            outputs = [path for path in glob.glob(os.path.join(directory, "leuven_*")) if "overlap" not in path]
+            self.assertEqual(4, len(outputs))
+            # the files are renamed once they are written
+            self.assertEqual([], glob.glob(os.path.join(directory, ".*.partial")))
+
+            places, metadata = merge_shard_outputs(outputs)
+            self.assertEqual(fake_query_google_places(circles), places)
+            self.assertEqual("leuven", metadata['area_name'])
+            self.assertNotIn('shard', metadata)
+
+            self.assertEqual("0/4", read_places_file(sorted(outputs)[0])['metadata']['shard'])
+            with self.assertRaises(ValueError):
+                merge_shard_outputs(outputs[:3])
+            with self.assertRaises(ValueError):
+                merge_shard_outputs(outputs + outputs[:1])
@@ -0,0 +1,102 @@
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from deka_types import Circle
+from get_places.config import Config
+from get_places.google_places_wrapper.single_flight import SingleFlight
+from get_places.google_places_wrapper.wrapper import _request_params, _make_coalesced_request
+
+
+class TestSingleFlight(TestCase):
+    def _call_concurrently(self, single_flight, function, threads=10):
+        """
+        :return: the results (or exceptions) of @threads concurrent calls of @function, with the same key
+        """
+        outcomes = []
+        started = threading.Barrier(threads)
+
+        def call():
+            started.wait()
+            try:
+                outcomes.append(single_flight.do("key", function))
+            except Exception as ex:
+                outcomes.append(ex)
+
+        workers = [threading.Thread(target=call) for _ in range(threads)]
+        [t.start() for t in workers]
+        [t.join() for t in workers]
+        return outcomes
+
+    def _slow(self, result):
+        calls = []
+        release = threading.Event()
+
+        def function():
+            calls.append(1)
+            # hold the call in flight until all threads have joined it
+            release.wait(1)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return function, calls, release
+
+    def test_concurrent_calls_coalesced(self):
+        single_flight = SingleFlight()
+        function, calls, release = self._slow({"status": "OK"})
+        threading.Timer(0.2, release.set).start()
+
+        outcomes = self._call_concurrently(single_flight, function)
+        self.assertEqual(1, len(calls))
+        self.assertEqual([{"status": "OK"}] * 10, outcomes)
+        self.assertEqual(9, single_flight.coalesced)
+
+    def test_error_shared(self):
+        single_flight = SingleFlight()
+        error = ValueError("failed")
+        function, calls, release = self._slow(error)
+        threading.Timer(0.2, release.set).start()
+
+        outcomes = self._call_concurrently(single_flight, function)
+        self.assertEqual(1, len(calls))
+        self.assertEqual([error] * 10, outcomes)
+
+    def test_done_calls_not_cached(self):
+        single_flight = SingleFlight()
+        results = iter(range(3))
+        self.assertEqual([0, 1, 2], [single_flight.do("key", lambda: next(results)) for _ in range(3)])
+        self.assertEqual(0, single_flight.coalesced)
+
+    def test_different_keys(self):
+        single_flight = SingleFlight()
+        self.assertEqual(["a", "b"], [single_flight.do(key, lambda key=key: key) for key in ["a", "b"]])
+
+
+class TestCoalescedRequests(TestCase):
+    @patch.object(Config, 'request_location_precision', 3)
+    def test_request_key(self):
+        circle = Circle(lat=42.6093271, lng=23.2514391, radius=500)
+        nearby = Circle(lat=42.6093002, lng=23.2514004, radius=500)
+        self.assertEqual(_request_params(circle), _request_params(nearby))
+        self.assertEqual({"location": "42.609,23.251", "radius": 500, "type": "bar", "pagetoken": "next"},
+                         _request_params(circle, type="bar", next_page_token="next"))
+        self.assertNotEqual(_request_params(circle, type="bar"), _request_params(nearby, type="cafe"))
+        self.assertNotEqual(_request_params(circle), _request_params(circle._replace(radius=600)))
+
+    @patch('get_places.google_places_wrapper.wrapper._build_api_url', lambda params: str(sorted(params.items())))
+    @patch('get_places.google_places_wrapper.wrapper._make_http_request')
+    def test_identical_requests_sent_once(self, mocked_http_request):
+        release = threading.Event()
+
+        def slow_request(url):
+            release.wait(1)
+            return {"results": [], "status": "OK"}
+
+        mocked_http_request.side_effect = slow_request
+        params = [_request_params(Circle(lat=1, lng=2, radius=100), type=type) for type in ["bar"] * 5 + ["cafe"] * 5]
+        threads = [threading.Thread(target=_make_coalesced_request, args=(p,)) for p in params]
+        [t.start() for t in threads]
+        threading.Timer(0.2, release.set).start()
+        [t.join() for t in threads]
+        self.assertEqual(2, mocked_http_request.call_count)
@@ -0,0 +1,111 @@
+from math import cos, radians
+from unittest.mock import patch
+
+from load_data.config import Config
+from load_data.datastore_adapter import load_to_datastore, search_places
+from load_data.datastore_adapter import query
+from load_data.datastore_adapter.redis import extract_latlng_of_place
+from shared_utils import geohash
+from tests.test_load_data.test_redis_adapter import TestRedisMixin
+
+
+class TestSearchPlaces(TestRedisMixin):
+    radius = 2000
+
+    def setUp(self):
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        self.area_name = self.metadata_sofia.area_name
+        self.centre = extract_latlng_of_place(next(iter(self.places_sofia.values())))
+
+    def expected_ids(self, within, place_filter=lambda place: True):
+        """
+        :param within: (lat, lng) -> bool
+        :return: the ids of the places for which @within is true, sorted by distance from the centre
+        """
+        found = []
+        for place_id, place in self.places_sofia.items():
+            lat_lng = extract_latlng_of_place(place)
+            if within(lat_lng.lat, lat_lng.lng) and place_filter(place):
+                found.append((geohash.distance(self.centre.lat, self.centre.lng, lat_lng.lat, lat_lng.lng), place_id))
+        return [place_id for _, place_id in sorted(found)]
+
+    def within_radius(self, lat, lng):
+        return geohash.distance(self.centre.lat, self.centre.lng, lat, lng) <= self.radius
+
+    def search_all_pages(self, **kwargs):
+        """
+        :return: the places of all pages of the query
+        """
+        found, cursor = [], None
+        while True:
+            page = search_places(self.area_name, self.centre.lat, self.centre.lng, cursor=cursor, **kwargs)
+            self.assertLessEqual(len(page.places), kwargs.get('limit', Config.QUERY_PAGE_SIZE))
+            found += page.places
+            cursor = page.next_cursor
+            if cursor is None:
+                return found
+
+    def test_radius(self):
+        expected = self.expected_ids(self.within_radius)
+        self.assertGreater(len(expected), 3)
+        for limit in [1, 3, 100]:
+            with self.subTest(limit=limit):
+                found = self.search_all_pages(radius=self.radius, limit=limit)
+                self.assertEqual(expected, [place.place_id for place in found])
+                self.assertEqual([self.places_sofia[place_id] for place_id in expected],
+                                 [place.place for place in found])
+                self.assertEqual(sorted(place.distance for place in found), [place.distance for place in found])
+
+    def test_box(self):
+        width, height = 3000, 1000
+
+        def within_box(lat, lng):
+            return abs(lat - self.centre.lat) * geohash.METRES_PER_DEGREE <= height / 2 and \
+                   abs(lng - self.centre.lng) * geohash.METRES_PER_DEGREE * cos(radians(self.centre.lat)) <= width / 2
+
+        expected = self.expected_ids(within_box)
+        self.assertTrue(expected)
+        self.assertEqual(expected, [place.place_id for place in self.search_all_pages(box=(width, height), limit=2)])
+
+    def test_filters(self):
+        expected = self.expected_ids(self.within_radius,
+                                     lambda place: 'restaurant' in place['types'] and place.get('rating', 0) >= 4)
+        self.assertTrue(expected)
+        found = self.search_all_pages(radius=self.radius, place_type='restaurant', min_rating=4, limit=2)
+        self.assertEqual(expected, [place.place_id for place in found])
+
+    def test_sharded_layout(self):
+        expected = [place.place_id for place in self.search_all_pages(radius=self.radius)]
+        with patch.object(Config, 'SHARD_GEOHASH_PRECISION', 6):
+            load_to_datastore(self.places_sofia, self.metadata_sofia)
+        self.assertEqual(expected, [place.place_id for place in self.search_all_pages(radius=self.radius, limit=3)])
+
+    def test_cached_until_promotion(self):
+        with patch.object(query, '_search_candidates', wraps=query._search_candidates) as searched:
+            search_places(self.area_name, self.centre.lat, self.centre.lng, radius=self.radius)
+            # another point in the same cell
+            nearby = search_places(self.area_name, self.centre.lat + 0.00001, self.centre.lng, radius=self.radius)
+            self.assertEqual(1, searched.call_count)
+            self.assertEqual(len(self.expected_ids(self.within_radius)), len(nearby.places))
+
+            # the area is promoted with other places
+            kept = dict(list(self.places_sofia.items())[:3])
+            load_to_datastore(kept, self.metadata_sofia)
+            found = search_places(self.area_name, self.centre.lat, self.centre.lng, radius=self.radius)
+            self.assertEqual(2, searched.call_count)
+            self.assertEqual(set(kept), {place.place_id for place in found.places})
+
+    @patch.object(Config, 'QUERY_CACHE_TTL', 0)
+    def test_cache_disabled(self):
+        with patch.object(query, '_search_candidates', wraps=query._search_candidates) as searched:
+            search_places(self.area_name, self.centre.lat, self.centre.lng, radius=self.radius)
+            search_places(self.area_name, self.centre.lat, self.centre.lng, radius=self.radius)
+            self.assertEqual(2, searched.call_count)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            search_places(self.area_name, self.centre.lat, self.centre.lng)
+        with self.assertRaises(ValueError):
+            search_places(self.area_name, self.centre.lat, self.centre.lng, radius=1, box=(1, 1))
+        with self.assertRaises(ValueError):
+            search_places(self.area_name, self.centre.lat, self.centre.lng, radius=1, cursor="not a cursor")
@@ -1,11 +1,26 @@
 import json
-from unittest import TestCase
+import gc
+import os
+from itertools import product
+from argparse import Namespace
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
 from uuid import uuid4
 
+from redis.cluster import RedisCluster
+from redis.exceptions import ResponseError
+
+from load_data.config import Config
 from load_data.datastore_adapter import load_to_datastore, RedisFacade
+from load_data.datastore_adapter.connection import reset_clients
 from load_data.datastore_adapter.redis import r, cities_boundaries_template_key, cities_places_template_key, \
-    cities_coordinates_template_key
-from load_data.main import parse_raw_input
+    cities_coordinates_template_key, cities_shards_template_key, split_to_shards, extract_latlng_of_place, \
+    type_template_key, cities_ratings_template_key, cities_popularity_template_key, cities_generation_template_key, \
+    load_to_temporary, KeyConverter
+from load_data.main import parse_raw_input, read_input
+from shared_utils import codec
+from shared_utils.places_index import write_places_index
 from tests.test_load_data.test_data import dummy_data_sofia, dummy_data_leuven
 from . import test_redis_db
 
@@ -27,8 +42,9 @@ class TestRedisAdapter(TestRedisMixin):
         # dummy_data was loaded from a file with the same format as original data.
         load_to_datastore(self.places_sofia, self.metadata_sofia)
         CommonAssertions.check_exclusive_correct_top_level_keys_loaded_in_redis(tester=self,
-                                                                                expected_areas=[
-                                                                                    self.metadata_sofia.area_name])
+                                                                                expected_areas={
+                                                                                    self.metadata_sofia.area_name:
+                                                                                        self.places_sofia})
 
     def test_correct_data_under_boundaries(self):
         """
@@ -118,10 +134,238 @@ class TestMultipleGeoAreas(TestRedisMixin, ):
         for metadata, places in data:
             print("run all tests for %s" % metadata.area_name)
             CommonAssertions.run_all_tests_single_area_loaded(tester=self, places=places, metadata=metadata)
-            CommonAssertions.check_exclusive_correct_top_level_keys_loaded_in_redis(tester=self, expected_areas=[
-                self.metadata_leuven.area_name,
-                self.metadata_sofia.area_name,
-            ])
+            CommonAssertions.check_exclusive_correct_top_level_keys_loaded_in_redis(tester=self, expected_areas={
+                self.metadata_leuven.area_name: self.places_leuven,
+                self.metadata_sofia.area_name: self.places_sofia,
+            })
+
+
+class TestIndexes(TestRedisMixin):
+    def test_types(self):
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        area_name = self.metadata_sofia.area_name
+
+        for place_type in Config.PLACES_TYPES:
+            expected = {place_id for place_id, place in self.places_sofia.items() if place_type in place['types']}
+            self.assertEqual(expected, set(r.zrange(type_template_key(place_type) + area_name, 0, -1)))
+
+    def test_typed_query(self):
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        place = next(place for place in self.places_sofia.values() if 'cafe' in place['types'])
+        lat_lng = extract_latlng_of_place(place)
+
+        cafes = RedisFacade.get_place_ids_within_radius(self.metadata_sofia.area_name, lat=lat_lng.lat,
+                                                        lng=lat_lng.lng, radius=5000, place_type='cafe')
+        self.assertIn(place['place_id'], cafes)
+        self.assertTrue(all('cafe' in self.places_sofia[place_id]['types'] for place_id in cafes))
+
+    def test_ratings(self):
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        area_name = self.metadata_sofia.area_name
+
+        expected = {place_id: place['rating'] for place_id, place in self.places_sofia.items() if 'rating' in place}
+        self.assertEqual(expected, dict(r.zrange(cities_ratings_template_key + area_name, 0, -1, withscores=True)))
+
+    def test_indexes_replaced(self):
+        # the indexes of the old data are replaced too
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        only_cafes = {place_id: place for place_id, place in self.places_sofia.items() if 'cafe' in place['types']}
+        load_to_datastore(only_cafes, self.metadata_sofia)
+
+        CommonAssertions.check_exclusive_correct_top_level_keys_loaded_in_redis(
+            tester=self, expected_areas={self.metadata_sofia.area_name: only_cafes})
+
+
+class TestShardedLayout(TestRedisMixin):
+    shard_precision = 5
+
+    def setUp(self):
+        sharded = patch.object(Config, 'SHARD_GEOHASH_PRECISION', self.shard_precision)
+        sharded.start()
+        self.addCleanup(sharded.stop)
+
+    def test_keys_are_sharded(self):
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        area_name = self.metadata_sofia.area_name
+        shards = split_to_shards(self.places_sofia, self.shard_precision)
+
+        expected_keys = {cities_boundaries_template_key + area_name, cities_shards_template_key + area_name,
+                         cities_generation_template_key + area_name}
+        for shard, shard_places in shards.items():
+            expected_keys.add("%s{%s:%s}" % (cities_places_template_key, area_name, shard))
+            expected_keys.add("%s{%s:%s}" % (cities_coordinates_template_key, area_name, shard))
+            expected_keys.update(expected_index_keys("{%s:%s}" % (area_name, shard), shard_places))
+
+        self.assertEqual(expected_keys, set(r.keys("*")))
+        self.assertEqual(set(shards), RedisFacade.get_shards(area_name))
+
+    def test_read_places(self):
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        area_name = self.metadata_sofia.area_name
+
+        for place_id, place in self.places_sofia.items():
+            self.assertEqual(place, RedisFacade.get_place_data(area_name=area_name, place_key=place_id))
+            self.assertEqual(place, RedisFacade.get_place_data(area_name=area_name, place_key=place_id,
+                                                               lat_lng=extract_latlng_of_place(place)))
+            lat_lng = extract_latlng_of_place(place)
+            self.assertIn(place_id, RedisFacade.get_place_ids_within_radius(area_name, lat=lat_lng.lat,
+                                                                            lng=lat_lng.lng, radius=1))
+
+    def test_area_without_places(self):
+        load_to_datastore({}, self.metadata_sofia)
+        self.assertEqual(set(), RedisFacade.get_shards(self.metadata_sofia.area_name))
+        with patch.object(Config, 'REDIS_ASYNC_LOAD', True):
+            load_to_datastore({}, self.metadata_sofia)
+        self.assertEqual(set(), RedisFacade.get_shards(self.metadata_sofia.area_name))
+
+    def test_switch_layout(self):
+        # the old layout is fully replaced, whichever it is
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        with patch.object(Config, 'SHARD_GEOHASH_PRECISION', 0):
+            load_to_datastore(self.places_sofia, self.metadata_sofia)
+            CommonAssertions.check_exclusive_correct_top_level_keys_loaded_in_redis(
+                tester=self, expected_areas={self.metadata_sofia.area_name: self.places_sofia})
+
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        self.test_keys_are_sharded()
+
+
+class TestLoadingModes(TestRedisMixin):
+    def check_loaded(self):
+        load_to_datastore(self.places_sofia, self.metadata_sofia)
+        CommonAssertions.run_all_tests_single_area_loaded(tester=self, places=self.places_sofia,
+                                                          metadata=self.metadata_sofia)
+        CommonAssertions.check_exclusive_correct_top_level_keys_loaded_in_redis(
+            tester=self, expected_areas={self.metadata_sofia.area_name: self.places_sofia})
+
+    def test_script_with_multiple_chunks(self):
+        with patch.object(Config, 'LOAD_CHUNK_SIZE', 3):
+            self.check_loaded()
+
+    def test_without_scripts(self):
+        with patch.object(Config, 'REDIS_USE_SCRIPTS', False):
+            self.check_loaded()
+
+    def test_leftovers_of_failed_load_not_promoted(self):
+        area_name = self.metadata_sofia.area_name
+        fewer = dict(list(self.places_sofia.items())[:3])
+        for async_load in [False, True]:
+            for shard_precision in [0, 5]:
+                with self.subTest(async_load=async_load, shard_precision=shard_precision), \
+                        patch.object(Config, 'REDIS_ASYNC_LOAD', async_load):
+                    # a load which failed before promoting left its temp keys, sharded and not
+                    with patch.object(Config, 'SHARD_GEOHASH_PRECISION', 5):
+                        load_to_temporary(self.places_sofia, self.metadata_sofia)
+                    load_to_temporary(self.places_sofia, self.metadata_sofia)
+
+                    with patch.object(Config, 'SHARD_GEOHASH_PRECISION', shard_precision):
+                        load_to_datastore(fewer, self.metadata_sofia)
+                    self.assertFalse([key for key in r.keys("*") if KeyConverter.is_temp(key)])
+                    found = {place_id for place_id, _ in RedisFacade.iter_places(area_name)}
+                    self.assertEqual(set(fewer), found)
+                    drop_db(r)
+
+    def test_from_indexed_file(self):
+        # the places are stored with their json from the file - they aren't encoded again
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sofia.dkp")
+            write_places_index(path, self.places_sofia, dummy_data_sofia['metadata'])
+            places, metadata = read_input(Namespace(file=path))
+        for use_scripts in [True, False]:
+            with self.subTest(use_scripts=use_scripts), patch.object(Config, 'REDIS_USE_SCRIPTS', use_scripts), \
+                    patch('shared_utils.codec.dumps', wraps=codec.dumps) as dumps:
+                load_to_datastore(places, metadata)
+                # only the boundaries
+                self.assertEqual(1, dumps.call_count)
+                CommonAssertions.run_all_tests_single_area_loaded(tester=self, places=self.places_sofia,
+                                                                  metadata=self.metadata_sofia)
+
+    @patch.object(Config, 'REDIS_ASYNC_LOAD', True)
+    @patch.object(Config, 'ASYNC_MAX_PIPELINES', 2)
+    @patch.object(Config, 'LOAD_CHUNK_SIZE', 3)
+    def test_async(self):
+        self.check_loaded()
+        with patch.object(Config, 'REDIS_USE_SCRIPTS', False):
+            self.check_loaded()
+        with patch.object(Config, 'SHARD_GEOHASH_PRECISION', 5):
+            load_to_datastore(self.places_sofia, self.metadata_sofia)
+            area_name = self.metadata_sofia.area_name
+            self.assertEqual(set(split_to_shards(self.places_sofia, 5)), RedisFacade.get_shards(area_name))
+            for place_id, place in self.places_sofia.items():
+                self.assertEqual(place, RedisFacade.get_place_data(area_name=area_name, place_key=place_id))
+
+    @patch.object(Config, 'REDIS_ASYNC_LOAD', True)
+    @patch.object(Config, 'REDIS_USE_SCRIPTS', False)
+    @patch.object(Config, 'LOAD_CHUNK_SIZE', 1)
+    def test_async_failure(self):
+        add_places = RedisFacade.add_places
+        chunks = []
+
+        def failing_add_places(area_name, places, pipe, shard=None):
+            chunks.append(places)
+            if len(chunks) == 2:
+                # fails on execution
+                pipe.hset("not_a_counter", "a", "b")
+                pipe.incr("not_a_counter")
+            elif len(chunks) > 2:
+                # still in flight when the failure is noticed
+                pipe.blpop(["nothing"], timeout=0.2)
+            return add_places(area_name=area_name, places=places, pipe=pipe, shard=shard)
+
+        with patch.object(RedisFacade, 'add_places', failing_add_places), self.assertNoLogs('asyncio'):
+            with self.assertRaises(ResponseError):
+                load_to_datastore(self.places_sofia, self.metadata_sofia)
+            # the tasks of the pipelines were all awaited - none has an exception which wasn't retrieved
+            gc.collect()
+        self.assertEqual(set(), RedisFacade.get_shards(self.metadata_sofia.area_name))
+        self.assertFalse(r.exists(cities_places_template_key + self.metadata_sofia.area_name))
+
+
+@skipUnless(os.environ.get("DEKA_TEST_REDIS_CLUSTER"),
+            "set DEKA_TEST_REDIS_CLUSTER=<host>:<port> of a node of a test Redis Cluster. it's flushed")
+class TestCluster(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.places_sofia, cls.metadata_sofia = parse_raw_input(dummy_data_sofia)
+
+    def setUp(self):
+        host, port = os.environ["DEKA_TEST_REDIS_CLUSTER"].rsplit(":", 1)
+        for name, value in [('REDIS_CLUSTER', True), ('REDIS_HOST', host), ('REDIST_PORT', int(port)),
+                            ('REDIS_DB', 0)]:
+            patched = patch.object(Config, name, value)
+            patched.start()
+            self.addCleanup(patched.stop)
+        reset_clients()
+        self.addCleanup(reset_clients)
+        self.addCleanup(drop_cluster)
+        drop_cluster()
+
+    def check_loaded(self):
+        area_name = self.metadata_sofia.area_name
+        found = {place_id for place_id, _ in RedisFacade.iter_places(area_name)}
+        self.assertEqual(set(self.places_sofia), found)
+        for place_id, place in self.places_sofia.items():
+            self.assertEqual(place, RedisFacade.get_place_data(area_name=area_name, place_key=place_id))
+            lat_lng = extract_latlng_of_place(place)
+            self.assertIn(place_id, RedisFacade.get_place_ids_within_radius(area_name, lat=lat_lng.lat,
+                                                                            lng=lat_lng.lng, radius=1))
+        keys = r.keys("*", target_nodes=RedisCluster.PRIMARIES)
+        self.assertFalse([key for key in keys if KeyConverter.is_temp(key)])
+
+    def test_load(self):
+        for use_scripts, async_load, shard_precision in product([True, False], [False, True], [0, 5]):
+            with self.subTest(use_scripts=use_scripts, async_load=async_load, shard_precision=shard_precision), \
+                    patch.object(Config, 'REDIS_USE_SCRIPTS', use_scripts), \
+                    patch.object(Config, 'REDIS_ASYNC_LOAD', async_load), \
+                    patch.object(Config, 'SHARD_GEOHASH_PRECISION', shard_precision):
+                # the nodes don't have the scripts yet
+                r.execute_command("SCRIPT FLUSH", target_nodes=RedisCluster.PRIMARIES)
+                load_to_datastore(self.places_sofia, self.metadata_sofia)
+                # replaces the area
+                load_to_datastore(self.places_sofia, self.metadata_sofia)
+                self.check_loaded()
+                self.assertEqual(set(split_to_shards(self.places_sofia, shard_precision)) if shard_precision else set(),
+                                 RedisFacade.get_shards(self.metadata_sofia.area_name))
 
 
 class CommonAssertions:
@@ -143,29 +387,33 @@ class CommonAssertions:
         """
         only the keys for the selected areas are allowed. e.g. if for a given area there're extra keys, this
         check will bark
+
+        :param expected_areas: area_name -> the places loaded for the area
         """
         expected_keys = []
-        for area_name in expected_areas:
+        for area_name, places in expected_areas.items():
             # we expect each of the keys below for each area
             expected_keys.append("%s%s" % (cities_boundaries_template_key, area_name))
             expected_keys.append("%s%s" % (cities_places_template_key, area_name))
             expected_keys.append("%s%s" % (cities_coordinates_template_key, area_name))
+            expected_keys.append("%s%s" % (cities_generation_template_key, area_name))
+            # and the indexes, which are not empty for the places
+            expected_keys += expected_index_keys(area_name, places)
 
         tester.assertEqual(set(expected_keys), set(r.keys("*")))
 
     @staticmethod
     def check_correct_boundaries_for_area(tester, metadata):
         area_name = metadata.area_name
-        expected_boundary_rectangle = json.dumps(
-            {
-                "northwest": {"lat": metadata.bounding_rectangle["northwest"]["lat"],
-                              "lng": metadata.bounding_rectangle["northwest"]["lng"]},
-                "southeast": {"lat": metadata.bounding_rectangle["southeast"]["lat"],
-                              "lng": metadata.bounding_rectangle["southeast"]["lng"]},
-            }
-        )
+        expected_boundary_rectangle = {
+            "northwest": {"lat": metadata.bounding_rectangle["northwest"]["lat"],
+                          "lng": metadata.bounding_rectangle["northwest"]["lng"]},
+            "southeast": {"lat": metadata.bounding_rectangle["southeast"]["lat"],
+                          "lng": metadata.bounding_rectangle["southeast"]["lng"]},
+        }
 
-        loaded_value = r.get(cities_boundaries_template_key + area_name)
+        # the formatting of the json depends on the json library in use (see shared_utils/codec.py)
+        loaded_value = json.loads(r.get(cities_boundaries_template_key + area_name))
 
         tester.assertEqual(expected_boundary_rectangle, loaded_value)
 
@@ -206,10 +454,26 @@ class CommonAssertions:
             tester.assertIn(place['place_id'], db_items_ids)
 
 
+def expected_index_keys(area_name, places):
+    keys = set()
+    for place in places.values():
+        keys.update(type_template_key(place_type) + area_name for place_type in place.get('types', [])
+                    if place_type in Config.PLACES_TYPES)
+        if place.get('rating') is not None:
+            keys.add(cities_ratings_template_key + area_name)
+        if place.get('user_ratings_total') is not None:
+            keys.add(cities_popularity_template_key + area_name)
+    return keys
+
+
 def drop_db(redis_client):
     [redis_client.delete(key) for key in redis_client.keys("*")]
 
 
+def drop_cluster():
+    r.flushall(target_nodes=RedisCluster.PRIMARIES)
+
+
 def ensure_correct_redis_db_during_testing():
     # we want to verify that we are using a testing db namespace, to avoid polluting the development one
     # we determine that we are connected to the correct namespace by setting a dummy value,
@@ -0,0 +1,42 @@
+import json
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from shared_utils import codec
+
+data = {"places": {"id%i" % i: {"name": "Café №%i" % i, "rating": i / 10, "types": ["bar"]} for i in range(1000)}}
+
+
+class TestCodec(TestCase):
+    def test_round_trip(self):
+        encoded = codec.dumps(data)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(data, codec.loads(encoded))
+        self.assertEqual(data, codec.loads(encoded.decode("utf-8")))
+
+    def test_default(self):
+        self.assertEqual({"a": [1, 2]}, codec.loads(codec.dumps({"a": {2, 1}}, default=sorted)))
+
+    @patch("shared_utils.codec._STREAM_BUFFER_SIZE", 100)
+    def test_streaming_dump(self):
+        for name in ["json", codec.NAME]:
+            with patch("shared_utils.codec.NAME", name):
+                file = BytesIO()
+                codec.dump(data, file)
+                file.seek(0)
+                self.assertEqual(data, codec.load(file))
+
+    def test_old_ujson_not_used(self):
+        modules = {"orjson": None, "ujson": SimpleNamespace(__version__="4.3.0"), "json": json}
+
+        def fake_import(name):
+            if modules[name] is None:
+                raise ImportError(name)
+            return modules[name]
+
+        with patch("shared_utils.codec.import_module", fake_import), patch.dict("os.environ", {"DEKA_JSON_CODEC": ""}):
+            self.assertEqual(("json", json), codec._select_backend())
+            modules["ujson"] = SimpleNamespace(__version__="5.1.0")
+            self.assertEqual("ujson", codec._select_backend()[0])
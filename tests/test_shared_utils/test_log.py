@@ -0,0 +1,79 @@
+import glob
+import json
+import logging
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from shared_utils.log import SamplingFilter, sampled_logger
+
+sources_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# logs from the main process and from forked worker processes, like parallelise does
+_LOGGING_SCRIPT = """
+import logging as log
+import sys
+from multiprocessing import Process
+from shared_utils.log import init_logger
+
+def worker(i):
+    for j in range(100):
+        log.info("worker %%i line %%i", i, j, extra={"worker": i})
+
+init_logger(%r)
+log.info("main %%s", "started")
+workers = [Process(target=worker, args=(i,)) for i in range(4)]
+[p.start() for p in workers]
+[p.join() for p in workers]
+try:
+    raise ValueError("failed")
+except ValueError:
+    log.exception("main failed")
+"""
+
+
+class TestLog(TestCase):
+    def test_records_of_all_processes(self):
+        with TemporaryDirectory() as directory:
+            subprocess.run([sys.executable, "-c", _LOGGING_SCRIPT % directory], cwd=sources_root, check=True,
+                           env=dict(os.environ, PYTHONPATH=sources_root, LOG_LEVEL="INFO"),
+                           stderr=subprocess.DEVNULL)
+            [log_file] = glob.glob(os.path.join(directory, "log", "*.log"))
+            with open(log_file) as file:
+                # each line is a whole json record - the lines of the processes don't interleave
+                records = [json.loads(line) for line in file]
+
+        self.assertEqual(1 + 4 * 100 + 1, len(records))
+        # the records of different processes can reach the queue in any order
+        self.assertIn("main started", [record["message"] for record in records])
+        worker_records = [record for record in records if "worker" in record]
+        self.assertEqual(400, len(worker_records))
+        self.assertEqual(4, len({record["pid"] for record in worker_records}))
+        self.assertEqual({"worker %i line 99" % i for i in range(4)},
+                         {record["message"] for record in worker_records if record["message"].endswith("99")})
+        self.assertEqual("ERROR", records[-1]["level"])
+        self.assertIn("ValueError: failed", records[-1]["message"])
+
+    def test_sampling(self):
+        logger = logging.getLogger("test_sampling")
+        logger.addFilter(SamplingFilter(every=10))
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+
+        for i in range(100):
+            logger.debug("request %i", i)
+        logger.warning("always")
+        self.assertEqual(["request %i" % i for i in range(0, 100, 10)] + ["always"],
+                         [record.getMessage() for record in records])
+
+    def test_sampled_logger(self):
+        logger = sampled_logger("test_sampled_logger", every=5)
+        self.assertIs(logger, sampled_logger("test_sampled_logger"))
+        self.assertEqual(1, len(logger.filters))
+        self.assertEqual(5, logger.filters[0].every)
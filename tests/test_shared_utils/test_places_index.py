@@ -0,0 +1,92 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from shared_utils import codec, geohash
+from shared_utils.places_index import PlacesIndex, write_places_index, is_places_index, content_hash, \
+    IndexedPlace, PlacesIndexWriter
+from tests.test_load_data.test_data import dummy_data_leuven
+
+
+class TestPlacesIndex(TestCase):
+    def setUp(self):
+        self.dir = TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "leuven.dkp")
+        self.places = dummy_data_leuven['places']
+        write_places_index(self.path, self.places, dummy_data_leuven['metadata'])
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        self.assertTrue(is_places_index(self.path))
+        with PlacesIndex(self.path) as index:
+            self.assertEqual(dummy_data_leuven['metadata'], index.metadata)
+            self.assertEqual(len(self.places), len(index))
+            self.assertEqual(self.places, dict(index.items()))
+            self.assertEqual(sorted(self.places), [place_id for place_id, _, _ in index.iter_entries()])
+
+    def test_get(self):
+        place_id = next(iter(self.places))
+        with PlacesIndex(self.path) as index:
+            self.assertIn(place_id, index)
+            self.assertEqual(self.places[place_id], index.get(place_id))
+            self.assertNotIn("missing", index)
+            self.assertIsNone(index.get("missing"))
+            payload = index.get_payload(place_id)
+        # the payload outlives the index
+        self.assertEqual(self.places[place_id], codec.loads(payload))
+
+    def test_items_within(self):
+        place = next(iter(self.places.values()))
+        location = place['geometry']['location']
+        cell = geohash.encode(location['lat'], location['lng'], 6)
+        expected = {place_id: place for place_id, place in self.places.items()
+                    if geohash.encode(place['geometry']['location']['lat'],
+                                      place['geometry']['location']['lng'], 6) == cell}
+        with PlacesIndex(self.path) as index:
+            self.assertEqual(expected, dict(index.items_within(cell)))
+            self.assertEqual(self.places, dict(index.items_within("")))
+
+    def test_hashes(self):
+        with PlacesIndex(self.path) as index:
+            for _, payload_hash, payload in index.iter_entries():
+                self.assertEqual(content_hash(payload), payload_hash)
+
+    def test_not_an_index(self):
+        other = os.path.join(self.dir.name, "places.json")
+        with open(other, 'wb') as file:
+            file.write(b"{}")
+        self.assertFalse(is_places_index(other))
+        with self.assertRaises(ValueError):
+            PlacesIndex(other)
+
+    def test_keep_payloads(self):
+        with PlacesIndex(self.path) as index:
+            places = dict(index.items(keep_payloads=True))
+        self.assertEqual(self.places, places)
+        for place_id, place in places.items():
+            self.assertIsInstance(place, IndexedPlace)
+            self.assertEqual(self.places[place_id], codec.loads(place.payload))
+
+    def test_places_without_default(self):
+        # not dicts, and no default to convert them. they have no location
+        write_places_index(self.path, {"a": [1, 2], "b": "text"}, {})
+        with PlacesIndex(self.path) as index:
+            self.assertEqual({"a": [1, 2], "b": "text"}, dict(index.items()))
+            self.assertEqual({}, dict(index.items_within("")))
+
+    def test_written_in_chunks(self):
+        place_ids = sorted(self.places)
+        # overlapping chunks - a place in more than one chunk is written once
+        chunks = [{place_id: self.places[place_id] for place_id in place_ids[start:start + 3]}
+                  for start in range(0, len(place_ids), 2)]
+        chunked_path = os.path.join(self.dir.name, "chunked.dkp")
+        with PlacesIndexWriter(chunked_path, metadata=dummy_data_leuven['metadata']) as writer:
+            for chunk in chunks:
+                writer.add(chunk)
+        self.assertEqual(len(self.places), len(writer))
+
+        with PlacesIndex(chunked_path) as chunked, PlacesIndex(self.path) as index:
+            self.assertEqual(dict(index.items()), dict(chunked.items()))
+            self.assertEqual(list(index.items_within("")), list(chunked.items_within("")))
@@ -0,0 +1,65 @@
+import glob
+import json
+import os
+import pstats
+import time
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from get_places.deka_utils.misc import split_to_batches
+from get_places.google_places_wrapper.parallelise import parallelise
+from shared_utils import profiling
+from tests.test_get_places_data.test_parallelise import dummy_tasks, fake_places_of_circle
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        self.dir = TemporaryDirectory()
+        environment = patch.dict(os.environ)
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.addCleanup(self.dir.cleanup)
+
+    def test_disabled(self):
+        os.environ.pop(profiling.PROFILE_DIR_VARIABLE, None)
+        with profiling.process_profile("main"), profiling.span("stage"):
+            busy_wait(0.01)
+        self.assertIsNone(profiling._current)
+
+    def test_process_and_threads(self):
+        profiling.enable(self.dir.name)
+        with profiling.process_profile("main"):
+            with profiling.span("stage"):
+                thread = Thread(target=profiling.profiled_thread_target(busy_wait), args=(0.1,))
+                thread.start()
+                thread.join()
+        profiling.merge_profiles()
+
+        stats = pstats.Stats(os.path.join(self.dir.name, "merged.prof"))
+        self.assertTrue(any(function == "busy_wait" for _, _, function in stats.stats))
+        with open(os.path.join(self.dir.name, "merged.collapsed")) as file:
+            self.assertIn("busy_wait (test_profiling.py:", file.read())
+        with open(os.path.join(self.dir.name, "spans.json")) as file:
+            spans = json.load(file)
+        self.assertEqual(["stage"], [recorded["name"] for recorded in spans])
+        self.assertGreaterEqual(spans[0]["seconds"], 0.1)
+
+    def test_worker_processes(self):
+        profiling.enable(self.dir.name)
+        batches = split_to_batches(dummy_tasks, items_per_batch=len(dummy_tasks) // 4)
+        with profiling.process_profile("main"):
+            parallelise(batches, single_query_function=fake_places_of_circle)
+        profiling.merge_profiles()
+
+        self.assertEqual(len(batches), len(glob.glob(os.path.join(self.dir.name, "worker_*.prof"))))
+        self.assertEqual(1, len(glob.glob(os.path.join(self.dir.name, "main_*.prof"))))
+        stats = pstats.Stats(os.path.join(self.dir.name, "merged.prof"))
+        self.assertTrue(any(function == "fake_places_of_circle" for _, _, function in stats.stats))
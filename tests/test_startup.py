@@ -0,0 +1,75 @@
+"""
+The entry points are run by many short-lived jobs, where the startup time dominates small runs.
+Importing them should be quick - it should neither load the heavy dependencies (they are imported when used) nor have
+side effects.
+"""
+import os
+import subprocess
+import sys
+import time
+from unittest import TestCase
+
+from shared_utils import codec
+
+sources_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+ENTRY_POINTS = ["get_places.get_places_data", "load_data.main", "diff_places.main", "save_places.main"]
+# the slow imports (boto3 alone takes a few hundred ms) - and their dependencies, in case they are imported directly
+HEAVY_MODULES = ["boto3", "botocore", "redis", "requests", "urllib3"]
+
+# the startup of an entry point (importing it), relative to the startup of a bare interpreter. generous, so that it
+# holds on a loaded machine - an entry point takes ~2.5x, one which imports redis or requests ~4-6x
+MAX_STARTUP_RATIO = 4
+# the best of that many runs is compared
+STARTUP_RUNS = 5
+
+_IMPORT_SCRIPT = """
+import json, logging, os, sys
+created = []
+os.makedirs = lambda *args, **kwargs: created.append(args[0])
+import %s
+print(json.dumps({
+    "heavy_modules": [module for module in %r if module in sys.modules],
+    "created_directories": created,
+    "log_handlers": len(logging.getLogger().handlers),
+}))
+"""
+
+
+def _env():
+    env = {key: value for key, value in os.environ.items() if key != "DEKA_GOOGLE_ACCESS_KEY"}
+    env["PYTHONPATH"] = sources_root
+    return env
+
+
+def import_in_subprocess(module):
+    output = subprocess.check_output([sys.executable, "-c", _IMPORT_SCRIPT % (module, HEAVY_MODULES)],
+                                     cwd=sources_root, env=_env())
+    return codec.loads(output.splitlines()[-1])
+
+
+def startup_seconds(code):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, "-c", code], cwd=sources_root, env=_env())
+    return time.perf_counter() - start
+
+
+class TestStartup(TestCase):
+    def test_entry_points(self):
+        for module in ENTRY_POINTS:
+            with self.subTest(module=module):
+                result = import_in_subprocess(module)
+                self.assertEqual([], result["heavy_modules"])
+                self.assertEqual([], result["created_directories"])
+                self.assertEqual(0, result["log_handlers"])
+
+    def test_startup_time(self):
+        codes = ["pass"] + ["import %s" % module for module in ENTRY_POINTS]
+        best = {code: float("inf") for code in codes}
+        # interleaved, so that a slow period of the machine affects all of them
+        for _ in range(STARTUP_RUNS):
+            for code in codes:
+                best[code] = min(best[code], startup_seconds(code))
+        for module in ENTRY_POINTS:
+            with self.subTest(module=module):
+                self.assertLess(best["import %s" % module], best["pass"] * MAX_STARTUP_RATIO)